@@ -6,9 +6,14 @@ import argparse
 from blackduck import Client
 from blackduck.Client import HubSession
 from blackduck.Authentication import BearerAuth, CookieAuth
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
 import logging
+import os
+import re
+from sage_scheduler import RequestScheduler, add_scheduler_arguments
 import sys
+import threading
 
 logging.basicConfig(
     level=logging.INFO,
@@ -23,6 +28,116 @@ def check_for_columns(column_names, fieldnames):
             sys.exit(-1)
 
 
+class ProgressLog(object):
+    """Append-only log of 'kind,id,status' lines which survives a crash and lets a restarted run
+    skip work that was already done.
+
+    A codelocation is logged as 'pending' before the version it is mapped to is deleted so that
+    the cascade step can still find it if the run dies in between.
+    """
+    DONE = ('deleted', 'not_found', 'remapped')
+
+    def __init__(self, path):
+        self.path = path
+        self.status = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    parts = line.strip().split(',')
+                    if len(parts) == 3:
+                        self.status[(parts[0], parts[1])] = parts[2]
+        self.f = open(path, 'a')
+
+    def is_done(self, kind, entity_id):
+        return self.status.get((kind, entity_id)) in ProgressLog.DONE
+
+    def pending(self, kind):
+        return [i for (k, i), s in self.status.items() if k == kind and s not in ProgressLog.DONE]
+
+    def record(self, kind, entity_id, status):
+        with self.lock:
+            self.status[(kind, entity_id)] = status
+            self.f.write("{},{},{}\n".format(kind, entity_id, status))
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        self.f.close()
+
+
+def delete_url(session, url):
+    """DELETE url and map the response onto a progress status"""
+    response = session.delete(url)
+    if response.status_code == 204:
+        return 'deleted'
+    elif response.status_code == 404:
+        return 'not_found'
+    logging.error("DELETE %s returned %s", url, response.status_code)
+    return 'error_{}'.format(response.status_code)
+
+
+def version_codelocation_ids(bd, pv_url):
+    # Same media type dance as sage.py uses to list the codelocations of a version
+    headers = {'accept': "application/json",
+               'content-type': "application/vnd.blackducksoftware.scan-4+json"}
+    return [re.match(r".*/codelocations/(.*)", cl['_meta']['href']).group(1)
+            for cl in bd.get_items(pv_url + "/codelocations", headers=headers)]
+
+
+def delete_version(bd, base_url, row, progress, cascade):
+    pv_url = base_url + "/api/projects/" + row['projectId'] + "/versions/" + row['versionId']
+    if cascade:
+        try:
+            for codelocation_id in version_codelocation_ids(bd, pv_url):
+                if not progress.is_done('codelocation', codelocation_id):
+                    progress.record('codelocation', codelocation_id, 'pending')
+        except Exception:
+            logging.exception("Failed to list codelocations of project:%s version:%s", row['project'], row['version'])
+    status = delete_url(bd.session, pv_url)
+    progress.record('version', row['versionId'], status)
+    return status
+
+
+def delete_unmapped_codelocation(bd, base_url, codelocation_id, progress):
+    cl_url = base_url + "/api/codelocations/" + codelocation_id
+    response = bd.session.get(cl_url, headers={'accept': "application/vnd.blackducksoftware.scan-4+json"})
+    if response.status_code == 404:
+        status = 'not_found'
+    elif response.status_code != 200:
+        status = 'error_{}'.format(response.status_code)
+    elif response.json().get('mappedProjectVersion'):
+        # re-mapped to another version since we looked, so it is no longer ours to delete
+        status = 'remapped'
+    else:
+        status = delete_url(bd.session, cl_url)
+    progress.record('codelocation', codelocation_id, status)
+    return status
+
+
+def read_manifest(path):
+    """Codelocation IDs listed one per line, as written by sage.py --unmapped-manifest"""
+    with open(path, 'r') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+def run_concurrently(fn, work, workers):
+    """Apply fn to every item of work using a pool of threads and tally the resulting statuses"""
+    tally = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, item) for item in work]
+        for n, future in enumerate(as_completed(futures), 1):
+            try:
+                status = future.result()
+            except Exception:
+                logging.exception("Unexpected failure")
+                status = 'exception'
+            tally[status] = tally.get(status, 0) + 1
+            if n % 100 == 0 or n == len(futures):
+                logging.info("Processed %i/%i: %s", n, len(futures), tally)
+    return tally
+
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Delete project versions from Hub")
@@ -36,14 +151,24 @@ if __name__ == '__main__':
 
     parser.add_argument('--one', dest='one', action='store_true', default=None, help="Exit after processing one row")
 
+    parser.add_argument('--workers', dest='workers', type=int, default=4, help="Number of concurrent deletions (default: 4)")
+    parser.add_argument('--progress-log', dest='progress_log', default=None,
+                        help="File recording completed deletions so an interrupted run can be resumed (default: INPUT.progress)")
+    parser.add_argument('--cascade-codelocations', dest='cascade', action='store_true', default=False,
+                        help="Also delete the codelocations left unmapped by deleting the versions")
+    add_scheduler_arguments(parser, default_rps=5.0)
+
     group1 = parser.add_argument_group('required arguments')
-    group1.add_argument('--input', dest='csv_file_input', required=True, help="Input CSV file")
+    inputs = group1.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', dest='csv_file_input', help="Input CSV file of project versions")
+    inputs.add_argument('--codelocations', dest='manifest', help="File of unmapped codelocation IDs, one per line, e.g. from sage.py --unmapped-manifest")
     group1.add_argument('--mode', dest='mode', required=True, help="One of list, delete")
 
     args = parser.parse_args()
 
     verify = False  # TLS certificate verification
     session = HubSession(args.base_url, timeout=15.0, retries=3, verify=verify)
+    RequestScheduler.from_args(args).install(session)
 
     # De-tangle the possibilities of specifying credentials
     if args.token_file:
@@ -61,6 +186,29 @@ if __name__ == '__main__':
         print("Error: must specify --mode to be one of: list or delete")
         sys.exit(-1)
 
+    if args.manifest:
+        codelocation_ids = read_manifest(args.manifest)
+        if args.one:
+            codelocation_ids = codelocation_ids[:1]
+        if args.mode == 'list':
+            for codelocation_id in codelocation_ids:
+                print("[DRY-RUN] codelocation:{}".format(codelocation_id))
+            sys.exit(0)
+        print("Deleting {} unmapped codelocations (any that have been mapped since are left alone)".format(len(codelocation_ids)))
+        print("WARNING: deletion cannot be undone!")
+        confirm = input("Do you want to proceed (type 'yes' to DELETE)? ")
+        if confirm != "yes":
+            print("Exiting")
+            sys.exit(0)
+        progress = ProgressLog(args.progress_log or args.manifest + ".progress")
+        todo = [i for i in codelocation_ids if not progress.is_done('codelocation', i)]
+        logging.info("%i of %i codelocations already deleted according to %s", len(codelocation_ids) - len(todo), len(codelocation_ids), progress.path)
+        cl_tally = run_concurrently(
+            lambda cl_id: delete_unmapped_codelocation(bd, args.base_url, cl_id, progress), todo, args.workers)
+        progress.close()
+        print("Deleted", cl_tally.get('deleted', 0), "codelocations.")
+        sys.exit(0)
+
     input_file = open(args.csv_file_input, 'r')
     reader = csv.DictReader(input_file)
 
@@ -97,32 +245,39 @@ if __name__ == '__main__':
         print("Error: unknown mode: " + args.mode)
         sys.exit(-1)
 
-    num_deleted = 0
-    row_num = 0  # csv module will skip header row automatically
+    rows = []
     for row in reader:
-        row_num += 1
-        print("Row {} ".format(row_num), end='')
-        pv_url = args.base_url + "/api/projects/" + row['projectId'] + "/versions/" + row['versionId']
-        if args.mode == 'delete':
-            print("- deleting project:{}  version:{}".format(row['project'], row['version']))
-            response = bd.session.delete(pv_url)
-            if response.status_code == 204:
-                # success
-                num_deleted += 1
-            elif response.status_code == 404:
-                print("  Error: response status code returned: 404 Not Found")
-                print("  Does the project version still exist?")
-                print("  " + pv_url)
-            else:
-                print("  Error: response status code returned: " + str(response.status_code))
-                print("  An unexpected error occurred. Check the project version?")
-                print("  " + pv_url)
-        else:
-            print("[DRY-RUN] project:{}  version:{}".format(row['project'], row['version']))
+        rows.append(row)
         if args.one:
-            print("Exiting after processing one row")
+            print("Processing one row only")
             break
 
-    if args.mode == 'delete' and num_deleted > 0:
+    if args.mode == 'list':
+        for row_num, row in enumerate(rows, 1):
+            print("Row {} [DRY-RUN] project:{}  version:{}".format(row_num, row['project'], row['version']))
+        sys.exit(0)
+
+    progress = ProgressLog(args.progress_log or args.csv_file_input + ".progress")
+
+    todo = [row for row in rows if not progress.is_done('version', row['versionId'])]
+    logging.info("%i of %i project versions already deleted according to %s", len(rows) - len(todo), len(rows), progress.path)
+
+    tally = run_concurrently(
+        lambda row: delete_version(bd, args.base_url, row, progress, args.cascade), todo, args.workers)
+    num_deleted = tally.get('deleted', 0)
+
+    if args.cascade:
+        # includes codelocations left pending by an earlier, interrupted run
+        codelocation_ids = progress.pending('codelocation')
+        logging.info("Deleting %i codelocations unmapped by the version deletions", len(codelocation_ids))
+        cl_tally = run_concurrently(
+            lambda cl_id: delete_unmapped_codelocation(bd, args.base_url, cl_id, progress),
+            codelocation_ids, args.workers)
+        print("Deleted", cl_tally.get('deleted', 0), "codelocations.")
+
+    progress.close()
+
+    if num_deleted > 0:
         print("Deleted", num_deleted, "project versions.")
-        print("Note storage usage is not updated until unmapped scans are removed.")
+        if not args.cascade:
+            print("Note storage usage is not updated until unmapped scans are removed.")
@@ -3,23 +3,373 @@
 # filter_activity.py
 
 import argparse
-import arrow
 import csv
-import datetime
-import logging
+from datetime import datetime, timezone
+from dateutil.parser import isoparse
+from itertools import islice
+import operator
 import os.path
-from pprint import pprint
 import re
 import sys
 
+WHERE_HELP = """Keep only the rows matching EXPRESSION. Columns are referred to by name, e.g.
+  --where "phase not in ('RELEASED', 'ARCHIVED')"
+  --where "now - createdAt > 100d"
+  --where "createdAt < date('2019-03')"
+  --where "(latestSummary is null or latestSummary < date('2019-11-01')) and latestNotableActivity is null"
+Durations are written as a number followed by s, m, h, d or w. Comparisons against an empty cell are false,
+use 'is null' / 'is not null' to test for empty cells."""
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<dur>\d+(?:\.\d+)?[smhdw])\b |
+        (?P<num>\d+(?:\.\d+)?) |
+        (?P<str>'[^']*'|"[^"]*") |
+        (?P<op><=|>=|==|!=|<|>|=|\+|-|\(|\)|,) |
+        (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+    )""", re.VERBOSE)
+
+KEYWORDS = ('and', 'or', 'not', 'in', 'is', 'null', 'now', 'date')
+
+COMPARISONS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+
+class FilterSyntaxError(Exception):
+    pass
+
+
+def parse_date(value):
+    """Parse an ISO 8601 timestamp into epoch seconds, treating naive timestamps as UTC"""
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        # partial dates such as '2019-03' need the more lenient parser
+        dt = isoparse(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def parse_date_or_none(value):
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
+
+
+def parse_number(value):
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        m = TOKEN_RE.match(text, pos)
+        if not m:
+            raise FilterSyntaxError("Unexpected input at: {}".format(text[pos:]))
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'name' and value.lower() in KEYWORDS:
+            kind, value = 'kw', value.lower()
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+
+class Parser(object):
+    """Recursive descent parser turning a --where expression into a tuple based syntax tree
+
+        expr    := and ('or' and)*
+        and     := not ('and' not)*
+        not     := 'not' not | compare
+        compare := sum (OP sum | ['not'] 'in' '(' literal (',' literal)* ')' | 'is' ['not'] 'null')?
+        sum     := atom (('+' | '-') atom)*
+        atom    := column | number | 'string' | duration | 'now' | 'date' '(' 'string' ')' | '(' expr ')'
+    """
+
+    def __init__(self, text):
+        self.tokens = tokenize(text)
+        self.pos = 0
+
+    def peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def accept(self, kind, value=None):
+        token = self.peek()
+        if token[0] == kind and (value is None or token[1] == value):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value=None):
+        if not self.accept(kind, value):
+            raise FilterSyntaxError("Expected {} but found {}".format(value or kind, self.peek()[1]))
+
+    def parse(self):
+        tree = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise FilterSyntaxError("Unexpected {} at end of expression".format(self.peek()[1]))
+        return tree
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.accept('kw', 'or'):
+            node = ('or', node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.accept('kw', 'and'):
+            node = ('and', node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.accept('kw', 'not'):
+            return ('not', self.parse_not())
+        return self.parse_compare()
+
+    def parse_compare(self):
+        left = self.parse_sum()
+        kind, value = self.peek()
+        if kind == 'op' and value in COMPARISONS:
+            self.next()
+            return ('cmp', value, left, self.parse_sum())
+        if self.accept('kw', 'is'):
+            negate = self.accept('kw', 'not')
+            self.expect('kw', 'null')
+            return ('null', negate, left)
+        if (kind, value) == ('kw', 'in') or ((kind, value) == ('kw', 'not') and self.peek(1) == ('kw', 'in')):
+            negate = self.accept('kw', 'not')
+            self.expect('kw', 'in')
+            self.expect('op', '(')
+            values = [self.parse_literal()]
+            while self.accept('op', ','):
+                values.append(self.parse_literal())
+            self.expect('op', ')')
+            return ('in', negate, left, values)
+        return left
+
+    def parse_literal(self):
+        kind, value = self.next()
+        if kind == 'str':
+            return value[1:-1]
+        if kind == 'num':
+            return float(value)
+        raise FilterSyntaxError("Expected a string or number in set but found {}".format(value))
+
+    def parse_sum(self):
+        node = self.parse_atom()
+        while self.peek() in (('op', '+'), ('op', '-')):
+            node = ('arith', self.next()[1], node, self.parse_atom())
+        return node
+
+    def parse_atom(self):
+        kind, value = self.next()
+        if kind == 'name':
+            return ('col', value)
+        if kind == 'num':
+            return ('const', 'number', float(value))
+        if kind == 'str':
+            return ('const', 'string', value[1:-1])
+        if kind == 'dur':
+            return ('const', 'duration', float(value[:-1]) * DURATION_UNITS[value[-1]])
+        if (kind, value) == ('kw', 'now'):
+            return ('const', 'date', datetime.now(timezone.utc).timestamp())
+        if (kind, value) == ('kw', 'date'):
+            self.expect('op', '(')
+            kind, literal = self.next()
+            if kind != 'str':
+                raise FilterSyntaxError("date() takes a quoted ISO 8601 date")
+            self.expect('op', ')')
+            return ('const', 'date', parse_date(literal[1:-1]))
+        if (kind, value) == ('op', '('):
+            node = self.parse_or()
+            self.expect('op', ')')
+            return node
+        raise FilterSyntaxError("Unexpected {}".format(value or "end of expression"))
+
+
+class Filter(object):
+    """A --where expression compiled once into functions that evaluate a whole batch of rows at a time.
+
+    Every column the expression refers to is given a type (date, number or string) from the
+    context it is used in, e.g. 'now - createdAt' makes createdAt a date. A batch is a dict
+    of column name -> list of cells already parsed to that type (None for empty cells), so
+    each cell is parsed exactly once and the per-row work is a single list comprehension step.
+    """
+
+    def __init__(self, text):
+        self.column_types = {}
+        self.null_checked = set()
+        tree = Parser(text).parse()
+        self._infer(tree)
+        for name in self.null_checked:
+            # columns only ever tested for being empty need no parsing
+            self.column_types.setdefault(name, 'string')
+        self.evaluate = self._compile(tree)
+
+    def _set_type(self, name, col_type):
+        if self.column_types.setdefault(name, col_type) != col_type:
+            raise FilterSyntaxError("Column {} is used both as a {} and as a {}".format(
+                name, self.column_types[name], col_type))
+
+    def _infer(self, node, hint=None):
+        """Return the type of node, typing any column found along the way"""
+        kind = node[0]
+        if kind == 'const':
+            return node[1]
+        if kind == 'col':
+            if hint:
+                self._set_type(node[1], hint)
+            return self.column_types.get(node[1], hint)
+        if kind == 'arith':
+            left, right = self._infer(node[2]), self._infer(node[3])
+            if left is None and right is None:
+                raise FilterSyntaxError("Cannot do arithmetic on two columns of unknown type")
+            if left is None:
+                left = self._infer(node[2], 'number' if right == 'number' else 'date')
+            if right is None:
+                right = self._infer(node[3], 'number' if left == 'number' else ('duration' if node[1] == '+' else 'date'))
+            if (left, right) == ('date', 'date') and node[1] == '-':
+                return 'duration'
+            if left == 'date' and right == 'duration':
+                return 'date'
+            if left == right and left in ('duration', 'number'):
+                return left
+            raise FilterSyntaxError("Cannot compute {} {} {}".format(left, node[1], right))
+        if kind == 'cmp':
+            left, right = self._infer(node[2]), self._infer(node[3])
+            if left is None:
+                left = self._infer(node[2], right or 'string')
+            if right is None:
+                right = self._infer(node[3], left)
+            if left != right:
+                raise FilterSyntaxError("Cannot compare a {} with a {}".format(left, right))
+            return 'bool'
+        if kind == 'in':
+            self._infer(node[2], 'number' if all(isinstance(v, float) for v in node[3]) else 'string')
+            return 'bool'
+        if kind == 'null':
+            if node[2][0] == 'col':
+                self.null_checked.add(node[2][1])
+            else:
+                self._infer(node[2])
+            return 'bool'
+        for child in node[1:]:
+            if self._infer(child) != 'bool':
+                raise FilterSyntaxError("Operands of {} must be conditions".format(kind))
+        return 'bool'
+
+    @staticmethod
+    def _binary(fn, left, right, default):
+        """Combine two compiled operands, either of which may be a constant, element-wise"""
+        lconst, lvalue = left
+        rconst, rvalue = right
+        if lconst and rconst:
+            return (True, fn(lvalue, rvalue))
+        if lconst:
+            return (False, lambda batch: [default if b is None else fn(lvalue, b) for b in rvalue(batch)])
+        if rconst:
+            return (False, lambda batch: [default if a is None else fn(a, rvalue) for a in lvalue(batch)])
+        return (False, lambda batch: [
+            default if a is None or b is None else fn(a, b) for a, b in zip(lvalue(batch), rvalue(batch))])
+
+    def _operand(self, node):
+        """Compile a value node into (is_constant, value or function of batch)"""
+        kind = node[0]
+        if kind == 'const':
+            return (True, node[2])
+        if kind == 'col':
+            name = node[1]
+            return (False, lambda batch: batch[name])
+        if kind == 'arith':
+            fn = operator.add if node[1] == '+' else operator.sub
+            return self._binary(fn, self._operand(node[2]), self._operand(node[3]), None)
+        raise FilterSyntaxError("A condition cannot be used as a value")
+
+    def _compile(self, node):
+        """Compile a condition node into a function of batch returning a list of booleans"""
+        kind = node[0]
+        if kind == 'cmp':
+            const, value = self._binary(COMPARISONS[node[1]], self._operand(node[2]), self._operand(node[3]), False)
+            if const:
+                # both sides were folded into a single boolean when the expression was compiled
+                return lambda batch: [value] * batch['#rows']
+            return value
+        if kind == 'in':
+            values = frozenset(node[3])
+            const, operand = self._operand(node[2])
+            if const:
+                value = operand is not None and (operand not in values if node[1] else operand in values)
+                return lambda batch: [value] * batch['#rows']
+            if node[1]:
+                return lambda batch: [v is not None and v not in values for v in operand(batch)]
+            return lambda batch: [v in values for v in operand(batch)]
+        if kind == 'null':
+            const, operand = self._operand(node[2])
+            if const:
+                value = (operand is not None) == node[1]
+                return lambda batch: [value] * batch['#rows']
+            if node[1]:
+                return lambda batch: [v is not None for v in operand(batch)]
+            return lambda batch: [v is None for v in operand(batch)]
+        if kind == 'not':
+            inner = self._compile(node[1])
+            return lambda batch: [not v for v in inner(batch)]
+        if kind in ('and', 'or'):
+            left, right = self._compile(node[1]), self._compile(node[2])
+            if kind == 'and':
+                return lambda batch: [a and b for a, b in zip(left(batch), right(batch))]
+            return lambda batch: [a or b for a, b in zip(left(batch), right(batch))]
+        raise FilterSyntaxError("Expression must be a condition, e.g. a comparison")
+
+    def make_batch(self, rows, column_index):
+        """Transpose rows into the parsed columns this filter needs"""
+        parsers = {'date': parse_date_or_none, 'duration': parse_number, 'number': parse_number, 'string': None}
+        batch = {'#rows': len(rows)}
+        for name, col_type in self.column_types.items():
+            idx = column_index[name]
+            parse = parsers[col_type]
+            if parse:
+                batch[name] = [parse(r[idx]) if r[idx] else None for r in rows]
+            else:
+                batch[name] = [r[idx] or None for r in rows]
+        return batch
+
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description="Filter input file")
+    parser = argparse.ArgumentParser(description="Filter input file", formatter_class=argparse.RawTextHelpFormatter)
 
-    parser.add_argument('--output', dest='csv_file_output', default=None, help="Output CSV file (STDOUT if None)");
+    parser.add_argument('--output', dest='csv_file_output', default=None, help="Output CSV file (STDOUT if None)")
+    parser.add_argument('--where', dest='where', default=None, help=WHERE_HELP)
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=10000,
+                        help="Number of rows read and evaluated at a time (default: 10000)")
 
     group1 = parser.add_argument_group('required arguments')
-    group1.add_argument('--input', dest='csv_file_input', required=True, help="Input CSV file");
+    group1.add_argument('--input', dest='csv_file_input', required=True, help="Input CSV file")
 
     args = parser.parse_args()
 
@@ -28,7 +378,21 @@ if __name__ == '__main__':
             print("Error, input and output file cannot be the same")
             sys.exit(-1)
 
-    reader = csv.DictReader(open(args.csv_file_input))
+    try:
+        row_filter = Filter(args.where) if args.where else None
+    except FilterSyntaxError as e:
+        print("Error, invalid --where expression:", e)
+        sys.exit(-1)
+
+    reader = csv.reader(open(args.csv_file_input, newline='', encoding='utf-8'))
+    fieldnames = next(reader)
+
+    if row_filter:
+        missing = [c for c in row_filter.column_types if c not in fieldnames]
+        if missing:
+            print("Error, input CSV file does not have column(s)", ", ".join(missing))
+            sys.exit(-1)
+        column_index = {name: fieldnames.index(name) for name in row_filter.column_types}
 
     if args.csv_file_output:
         f = open(args.csv_file_output, 'w', newline='', encoding='utf-8')
@@ -36,33 +400,13 @@ if __name__ == '__main__':
     else:
         w = csv.writer(sys.stdout)
 
-    w.writerow(reader.fieldnames)
-
-    for row in reader:
-        # TODO: add your filtering and processing here
-        # pprint(row)
-
-        # Example: omit row if phase in ['RELEASED', 'ARCHIVED']
-        # if row['phase'] in ['RELEASED', 'ARCHIVED']:
-        #    continue
-
-        # Example: omit row if createdAt is within 100 days
-        # if arrow.now() - arrow.get(row['createdAt']) < datetime.timedelta(days=int(100)):
-        #    continue
-
-        # Example: omit row if createdAt is after 2019-03
-        # if arrow.get(row['createdAt']) > arrow.get("2019-03"):
-        #    continue
-
-        # Example: omit row if latestSummary or latestScanEvent is after 2019-11-01
-        # cutoff = arrow.get("2019-11-01")
-        # if row['latestSummary'] and arrow.get(row['latestSummary']) > cutoff:
-        #    continue
-        # if row['latestScanEvent'] and arrow.get(row['latestScanEvent']) > cutoff:
-        #    continue
-
-        # Example: omit row if latestNotableActivity is not empty
-        # if row['latestNotableActivity']:
-        #    continue
+    w.writerow(fieldnames)
 
-        w.writerow(row.values())
+    while True:
+        rows = list(islice(reader, args.chunk_size))
+        if not rows:
+            break
+        if row_filter:
+            keep = row_filter.evaluate(row_filter.make_batch(rows, column_index))
+            rows = [row for row, k in zip(rows, keep) if k]
+        w.writerows(rows)
@@ -1,18 +1,30 @@
 import argparse
-from blackduck import Client
-from blackduck.Client import HubSession
-from blackduck.Authentication import BearerAuth, CookieAuth
-from datetime import datetime, timedelta
+import bisect
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
 from dateutil import parser as dt_parser
+import hashlib
+import heapq
+import itertools
 import json
 import logging
+import math
 import os
 from pathlib import Path
+import random
+import re
+from sage_io import COMPRESSIONS, last_id, load_report, open_report, report_from_entities, write_report
+from sage_metrics import MetricsFile, set_report_metrics, set_run_metrics
+from sage_progress import Progress, add_progress_arguments
+from sage_scheduler import RequestScheduler, add_scheduler_arguments
+from sage_similarity import NameClusterer
+from sage_tables import CsvTables
+from statistics import NormalDist
 import sys
+import time
+import zlib
 
 # TODO: Find scans (code locations) whose scan frequency is higher than we recommend
-# TODO: Find signature scans taking a long time to complete (e.g. > 30m ) and suggest they be optimized, e.g. by splitting things up
-# TODO: Find signature scans that are particular large and should possibly be split up
 # TODO: Find projects that don't have any Released versions
 # TODO: Find Released versions that don't have any reports
 # TODO: Analyze versions and their reports to see if customer is using them
@@ -34,6 +46,7 @@ class BlackDuckSage(object):
         'matchCount',
         'name',
         'num_bom_scans',
+        'num_scan_summaries',
         'num_scans',
         'num_versions',
         'phase',
@@ -51,29 +64,101 @@ class BlackDuckSage(object):
         'versionName',
         'versions',
     ]
+    TOTALS = [
+        'total_projects',
+        'total_versions',
+        'total_scans',
+        'total_scan_size',
+        'total_unmapped_scans',
+        'number_signature_scans',
+        'number_bom_scans',
+    ]
+    # finding -> (entity type, key of the message explaining it)
+    FINDINGS = {
+        'projects_with_too_many_versions': ('project', 'too_many_versions_message'),
+        'projects_without_an_owner': ('project', 'no_owner_message'),
+        'projects_with_version_churn': ('project', 'version_churn_message'),
+        'versions_with_too_many_scans': ('version', 'too_many_scans_message'),
+        'versions_with_zero_scans': ('version', 'zero_scans_message'),
+        'versions_with_similar_scans': ('version', 'similar_scans_message'),
+        'unmapped_scans': ('codelocation', 'unmapped_scan_message'),
+        'old_unmapped_scans': ('codelocation', 'old_unmapped_scan_message'),
+        'high_frequency_scans': ('codelocation', 'high_freq_scan_message'),
+        'slow_scans': ('codelocation', 'slow_scan_message'),
+        'scans_to_split': ('codelocation', 'split_scan_message'),
+        'redundant_scans': ('codelocation', 'redundant_scan_message'),
+    }
 
     def __init__(self, hub_instance, **kwargs):
-        assert isinstance(hub_instance, Client)
+        # no hub, nor the blackduck library, is needed when (re-)analyzing data that was collected earlier
+        if hub_instance is not None:
+            from blackduck import Client
+            assert isinstance(hub_instance, Client)
         self.hub = hub_instance
         self.file = kwargs.get("file", "/var/log/sage_says.json")
         self._check_file_permissions()
         self.max_versions_per_project = kwargs.get('max_versions_per_project', 20)
         self.max_scans_per_version = kwargs.get('max_scans_per_version', 10)
         self.max_age_for_unmapped_scans = kwargs.get('max_age_unmapped_scans', 365)  # days
+        self.unmapped_manifest = kwargs.get("unmapped_manifest")  # file to write the IDs of old unmapped scans into
+        manifest_min_age = kwargs.get("manifest_min_age")
+        self.manifest_min_age = self.max_age_for_unmapped_scans if manifest_min_age is None else manifest_min_age  # days
         self.min_time_between_versions = kwargs.get("min_time_between_versions", 1)  # hour
+        self.high_frequency_window = kwargs.get("high_frequency_window", 24)  # hours
+        self.latest_summaries = kwargs.get("latest_summaries")  # number of the newest scan summaries to fetch per codelocation, None for all
         self.min_ratio_of_released_versions = kwargs.get("min_ratio_of_released_versions", 0.1)  # min ratio of RELEASED versions to the total
+        self.max_version_burst = kwargs.get("max_version_burst", 5)  # versions created in a row, less than min_time_between_versions apart
         self.max_recommended_projects = int(kwargs.get("max_recommended_projects", 1000))
         self.max_time_to_retrieve_projects = int(kwargs.get("max_time_to_retrieve_projects", 60))
+        self.max_scan_duration = kwargs.get("max_scan_duration", 30)  # minutes
+        self.max_recommended_scan_size = kwargs.get("max_recommended_scan_size", 5 * 1024 ** 3)  # bytes
+        self.max_recommended_file_count = kwargs.get("max_recommended_file_count", 1000000)
+        self.top_n = kwargs.get("top_n", 10)
+        self.similar_name_threshold = kwargs.get("similar_name_threshold", 0.7)  # estimated Jaccard similarity of name trigrams
+        self.preflight_samples = kwargs.get("preflight_samples", 5)  # projects and codelocations sampled by preflight()
+        self.seed = kwargs.get("seed")  # of the random samples taken by preflight() and the sample mode
+        self.sample = kwargs.get("sample")  # number of projects and of codelocations to collect instead of all of them
+        self.confidence = kwargs.get("confidence", 0.95)  # of the intervals estimated from a sample
+        self.max_runtime = kwargs.get("max_runtime", 8)  # hours a single collection should take
+        self.progress = kwargs.get("progress") or Progress()
+        self.peak_load_factor = kwargs.get("peak_load_factor", 1.5)  # times the load of an average hour
+        self.min_peak_share = kwargs.get("min_peak_share", 0.1)  # of peak-hour scans before recommending a submitter moves
         self.analyze_jobs_flag = kwargs.get("analyze_jobs", True)
+        self.job_history_file = kwargs.get("job_history")
+        self.max_job_failure_rate = kwargs.get("max_job_failure_rate", 0.05)
+        self.max_job_backlog = kwargs.get("max_job_backlog", 50)
+        self.job_run_time_share = kwargs.get("job_run_time_share", 0.25)  # share of all job processing time
+        csv_dir = kwargs.get("csv_dir")
+        self.tables = CsvTables(csv_dir) if csv_dir else None
+        self.compression = kwargs.get("compression")  # gzip, xz, bz2 or None to go by the file extension
+        self.shard = kwargs.get("shard")  # (index, count) to collect only one slice of the hub
+        # only collect the projects, versions and codelocations matching these
+        self.scope = {
+            'include_projects': kwargs.get("include_projects"),  # project name regex
+            'exclude_projects': kwargs.get("exclude_projects"),  # project name regex
+            'phases': kwargs.get("phases"),  # list of version phases
+            'distributions': kwargs.get("distributions"),  # list of version distributions
+            'updated_since': kwargs.get("updated_since"),  # ISO date or time
+        }
+        if self.scope['updated_since']:
+            self._updated_since = self._parse_timestamp(self.scope['updated_since'])
         self.data = {}
+        self._timings = []
+        self._summary_cache = {}  # codelocation url -> (updatedAt, scan summaries, number of them) of the previous collection
+        self.scheduler = kwargs.get("scheduler")  # the RequestScheduler installed on the hub's session, for its stats
+        metrics_file = kwargs.get("metrics_file")
+        self.metrics = MetricsFile(metrics_file, {'hub': hub_instance.base_url} if hub_instance else {}) if metrics_file else None
+        self.started = time.monotonic()
 
     def _check_file_permissions(self):
         '''Test that we can write to the file path given and if there is an issue let the user know
         '''
         f = Path(self.file)
-        # Doing this the pythonic way of just opening the file to write and checking for exceptions
+        # Doing this the pythonic way of just opening the file to write and checking for exceptions,
+        # appending so that an existing report, which may be the input being re-analyzed, survives
         try:
-            open(self.file, "w")
+            with open(self.file, "a"):
+                pass
         except:
             if f.is_dir():
                 logging.error(f"Sage must be given a file to write results into, but {self.file} is a directory")
@@ -100,10 +185,23 @@ class BlackDuckSage(object):
             common_attribute_key_values[k] = v
         return common_attribute_key_values
 
+    def _export_run_metrics(self, phase, finished=False):
+        if self.metrics:
+            set_run_metrics(self.metrics, phase, self.started, self.scheduler.stats if self.scheduler else None, finished)
+            self.metrics.write()
+
     def _write_results(self):
-        with open(self.file, 'w') as f:
+        with open_report(self.file, 'w', self.compression) as f:
             logging.info("Writing results to {}".format(self.file))
-            f.write(json.dumps(self.data))
+            write_report(self.data, f)
+        if self.metrics:
+            if 'hub_url' in self.data:
+                self.metrics.labels['hub'] = self.data['hub_url']
+            set_report_metrics(self.metrics, {t: self.data[t] for t in BlackDuckSage.TOTALS if t in self.data},
+                               {f: len(self.data[f]) for f in BlackDuckSage.FINDINGS if f in self.data})
+            self._export_run_metrics('total', finished=True)
+        if self.unmapped_manifest and 'unmapped_scan_ages' in self.data:
+            self._write_unmapped_manifest()
 
         logging.info("Wrote results to {}".format(self.file))
 
@@ -120,7 +218,57 @@ class BlackDuckSage(object):
         return len(list(filter(lambda s: s['name'].lower().endswith('bom'), scans)))
 
     @staticmethod
-    def get_hub_version_info():
+    def _shard_of(url, shard_count):
+        # crc32 rather than hash() so every process, on every machine, agrees on the partitioning
+        return zlib.crc32(last_id(url).encode('utf-8')) % shard_count
+
+    def _scoped(self):
+        return any(self.scope.values())
+
+    def _project_query(self):
+        '''Server side name filter for the project listing, which can only do a substring match, so
+        only a plain-text include pattern is passed on; _project_in_scope checks the pattern anyway
+        '''
+        pattern = self.scope['include_projects']
+        if pattern and re.escape(pattern) == pattern:
+            return {'q': "name:{}".format(pattern)}
+        return {}
+
+    def _project_in_scope(self, project):
+        scope = self.scope
+        if scope['include_projects'] and not re.search(scope['include_projects'], project['name']):
+            return False
+        if scope['exclude_projects'] and re.search(scope['exclude_projects'], project['name']):
+            return False
+        return not scope['updated_since'] or self._updated_since_cutoff(project)
+
+    def _version_in_scope(self, version):
+        scope = self.scope
+        if scope['phases'] and version.get('phase') not in scope['phases']:
+            return False
+        if scope['distributions'] and version.get('distribution') not in scope['distributions']:
+            return False
+        return True
+
+    def _codelocation_in_scope(self, codelocation, version_urls):
+        mapped = codelocation.get('mappedProjectVersion')
+        if mapped:
+            return mapped in version_urls
+        scope = self.scope
+        if scope['include_projects'] or scope['exclude_projects'] or scope['phases'] or scope['distributions']:
+            # can't tell which project an unmapped scan belongs to
+            return False
+        return self._updated_since_cutoff(codelocation)
+
+    def _updated_since_cutoff(self, obj):
+        updated_at = obj.get('updatedAt', obj.get('createdAt'))
+        return updated_at is None or self._parse_timestamp(updated_at) >= self._updated_since
+
+    def _in_shard(self, obj):
+        return self.shard is None or self._shard_of(obj['_meta']['href'], self.shard[1]) == self.shard[0]
+
+    @staticmethod
+    def get_hub_version_info(hub):
         headers = {'accept': "application/vnd.blackducksoftware.status-4+json"}
         return hub.get_json("/api/current-version", headers=headers)
 
@@ -131,27 +279,41 @@ class BlackDuckSage(object):
         subsequent analysis.
         '''
         logging.info("Fetching projects...")
-        projects = list(hub.get_resource('projects', headers={'accept': "application/vnd.blackducksoftware.project-detail-4+json"}))
+        project_headers = {'accept': "application/vnd.blackducksoftware.project-detail-4+json"}
+        if self.sample:
+            projects = self._sample_listing('projects', project_headers)
+        else:
+            projects = list(self.hub.get_resource('projects', headers=project_headers, params=self._project_query()))
         logging.info("Fetched %i projects", len(projects))
+        if self._scoped():
+            self.data['scope'] = self.scope
+            projects = list(filter(self._project_in_scope, projects))
+            logging.info("%i projects are in scope", len(projects))
+        if self.shard:
+            # the full listing order lets a merge put the shards back together in the original order
+            self.data['shard'] = "{}/{}".format(*self.shard)
+            self.data['project_urls'] = [p['_meta']['href'] for p in projects]
+            projects = list(filter(self._in_shard, projects))
+            logging.info("Collecting %i projects in shard %s", len(projects), self.data['shard'])
         total_versions = 0
         project_count = 0
+        self.progress.start('projects', len(projects))
         for project in projects:
             project_count += 1
             project_name = project['name']
-            print("Project ({}/{}): {};  versions:".format(project_count, len(projects), project_name), end='', flush=True)
-            versions = list(hub.get_resource('versions', project, headers={'accept': "application/vnd.blackducksoftware.project-detail-5+json"}))
-            print(len(versions))
+            versions = list(self.hub.get_resource('versions', project, headers={'accept': "application/vnd.blackducksoftware.project-detail-5+json"}))
+            versions = list(filter(self._version_in_scope, versions))
+            mapped_scans = 0
             for version in versions:
                 version_name = version['versionName']
-                print("  {};  codelocations:".format(version_name), end='', flush=True)
                 # Using key 'accept' on its own returns http response status code 406 on 2020.12, 2020.2
                 # Using key 'content-type' on its own will actually use the internal proprietary content-type:
                 #   application/vnd.blackducksoftware.internal-1+json.
                 # So we need both.
                 headers = {'accept': "application/json",
                            'content-type': "application/vnd.blackducksoftware.scan-4+json"}
-                scans = list(hub.get_resource('codelocations', version, headers=headers))
-                print(len(scans))
+                scans = list(self.hub.get_resource('codelocations', version, headers=headers))
+                mapped_scans += len(scans)
                 scans = [self._copy_common_attributes(s, version_name=version_name, project_name=project_name) for s in scans]
                 version['scans'] = scans
                 version['num_bom_scans'] = self._number_bom_scans(scans)
@@ -160,26 +322,64 @@ class BlackDuckSage(object):
             project['versions'] = versions
             project['num_versions'] = len(versions)
             total_versions += len(versions)
-        projects = [self._copy_common_attributes(p) for p in projects]
+            projects[project_count - 1] = project = self._copy_common_attributes(project)
+            if self.tables:
+                for version in versions:
+                    self.tables.write_version(version)
+                self.tables.write_project(project)
+            self.progress.update('projects', versions=len(versions), codelocations=mapped_scans)
+        self.progress.finish('projects')
         self.data['projects'] = projects
 
-        logging.info("Fetching policies...")
-        # note using key 'content-type' does not work with 2020.12
-        self.data['policies'] = list(hub.get_resource('policyRules', headers={'accept': "application/vnd.blackducksoftware.policy-5+json"}))
-        logging.info("Fetched %i policies", len(self.data['policies']))
+        if self.shard and self.shard[0] != 0:
+            self.data['policies'] = []  # shard 0 collects the hub-wide data
+        else:
+            logging.info("Fetching policies...")
+            # note using key 'content-type' does not work with 2020.12
+            self.data['policies'] = list(self.hub.get_resource('policyRules', headers={'accept': "application/vnd.blackducksoftware.policy-5+json"}))
+            logging.info("Fetched %i policies", len(self.data['policies']))
 
         logging.info("Fetching codelocations...")
-        scans = list(hub.get_resource('codeLocations', headers={'accept': "application/vnd.blackducksoftware.scan-4+json"}))
+        codelocation_headers = {'accept': "application/vnd.blackducksoftware.scan-4+json"}
+        if self.sample:
+            scans = self._sample_listing('codeLocations', codelocation_headers)
+        else:
+            scans = list(self.hub.get_resource('codeLocations', headers=codelocation_headers))
         logging.info("Fetched %i codelocations", len(scans))
+        if self._scoped():
+            version_urls = set(v['url'] for p in projects for v in p['versions'])
+            scans = [s for s in scans if self._codelocation_in_scope(s, version_urls)]
+            logging.info("%i codelocations are in scope", len(scans))
+        if self.shard:
+            self.data['scan_urls'] = [s['_meta']['href'] for s in scans]
+            scans = list(filter(self._in_shard, scans))
+            logging.info("Collecting %i codelocations in shard %s", len(scans), self.data['shard'])
         codelocation_count = 0
+        reused = 0
+        summary_cache = {}
+        self.progress.start('codelocations', len(scans))
         for scan in scans:
             codelocation_count += 1
-            print("Codelocation ({}/{}): {};  scan-summaries:".format(codelocation_count, len(scans), scan['name']), end='', flush=True)
-            scan_summaries = list(hub.get_resource('scans', scan, headers={'accept': "application/vnd.blackducksoftware.scan-4+json"}))
-            print(len(scan_summaries))
-            scan_summaries = [self._copy_common_attributes(ss) for ss in scan_summaries]
+            # a codelocation's updatedAt changes with every scan into it, so unchanged ones can keep their summaries
+            cached = self._summary_cache.get(scan['_meta']['href'])
+            if cached and cached[0] == scan.get('updatedAt'):
+                _, scan_summaries, num_summaries = cached
+                reused += 1
+            else:
+                scan_summaries, num_summaries = self._get_scan_summaries(scan)
+                scan_summaries = [self._copy_common_attributes(ss) for ss in scan_summaries]
+            summary_cache[scan['_meta']['href']] = (scan.get('updatedAt'), scan_summaries, num_summaries)
             scan['scan_summaries'] = scan_summaries
-        scans = [self._copy_common_attributes(s) for s in scans]
+            if self.latest_summaries:
+                scan['num_scan_summaries'] = num_summaries
+            scans[codelocation_count - 1] = scan = self._copy_common_attributes(scan)
+            if self.tables:
+                self.tables.write_codelocation(scan)
+            self.progress.update('codelocations', scan_summaries=len(scan_summaries))
+        self.progress.finish('codelocations')
+        if reused:
+            logging.info("Reused the scan summaries of %i codelocations not updated since the previous collection", reused)
+        self._summary_cache = summary_cache
         self.data['scans'] = scans
 
         self.data['total_projects'] = len(projects)
@@ -188,6 +388,19 @@ class BlackDuckSage(object):
 
         logging.info("Elapsed time to get data: %s", datetime.now() - start_time)
 
+    def _get_scan_summaries(self, scan):
+        '''The scan summaries of a codelocation, and how many it has in all. With latest_summaries
+        only the newest N are fetched, in a single request.
+        '''
+        headers = {'accept': "application/vnd.blackducksoftware.scan-4+json"}
+        if self.latest_summaries:
+            page = self.hub.get_resource('scans', scan, items=False, headers=headers,
+                                         params={'offset': 0, 'limit': self.latest_summaries, 'sort': "createdAt DESC"})
+            summaries = page.get('items', [])
+            return summaries, page.get('totalCount', len(summaries))
+        summaries = list(self.hub.get_resource('scans', scan, headers=headers))
+        return summaries, len(summaries)
+
     def _find_projects_with_too_many_versions(self):
         self.data['projects_with_too_many_versions'] = list(filter(
             lambda p: p['num_versions'] > self.max_versions_per_project, self.data['projects']))
@@ -214,6 +427,47 @@ class BlackDuckSage(object):
                 vulnerability or serious legal compliance issue.""".format(project['name'])
             project['no_owner_message'] = self._remove_white_space(project['no_owner_message'])
 
+    def _find_projects_with_version_churn(self):
+        '''Find projects creating versions in bursts, closer together than min_time_between_versions,
+        typically a new version for every CI build, while releasing few of them.
+        '''
+        min_gap = self.min_time_between_versions * 3600
+        churning_projects = []
+        for project in self.data['projects']:
+            versions = project['versions']
+            created = sorted([int(self._parse_timestamp(v['createdAt']).timestamp()) for v in versions if 'createdAt' in v])
+            if len(created) < 2:
+                continue
+            bursts = []
+            burst = 1
+            for gap in [b - a for a, b in zip(created, created[1:])] + [min_gap]:
+                if gap < min_gap:
+                    burst += 1
+                else:
+                    if burst > 1:
+                        bursts.append(burst)
+                    burst = 1
+            if not bursts:
+                continue
+            released = sum([1 for v in versions if v.get('phase') == 'RELEASED'])
+            released_ratio = released / len(versions)
+            largest_burst = max(bursts)
+            if released_ratio >= self.min_ratio_of_released_versions and largest_burst < self.max_version_burst:
+                continue
+            project['version_churn'] = {
+                'versions_in_bursts': sum(bursts),
+                'largest_burst': largest_burst,
+                'released_ratio': released_ratio,
+            }
+            project['version_churn_message'] = """Project {} created {} of its {} versions within {} hour(s) of another
+                version, up to {} in a row, and only {:.0%} of its versions are RELEASED. Creating a version for every
+                build makes the Hub store and process a BOM per build and degrades its performance. Scan builds into
+                one version per development branch and create new versions for releases only.""".format(
+                    project['name'], sum(bursts), len(versions), self.min_time_between_versions, largest_burst, released_ratio)
+            project['version_churn_message'] = self._remove_white_space(project['version_churn_message'])
+            churning_projects.append(project)
+        self.data['projects_with_version_churn'] = churning_projects
+
     def _find_versions_with_too_many_scans(self):
         versions_with_too_many_scans = []
         for p in self.data['projects']:
@@ -249,37 +503,405 @@ class BlackDuckSage(object):
                     v['project_name'], v['versionName'])
             v['zero_scans_message'] = self._remove_white_space(v['zero_scans_message'])
 
+    def _scan_cluster(self, scans):
+        '''Summarize a cluster of similarly named scans, keeping the most recently updated one'''
+        keep = max(scans, key=lambda s: s.get('updatedAt', ''))
+        total = sum([s.get('scanSize', 0) for s in scans])
+        return {
+            'names': [s['name'] for s in scans],
+            'urls': [s['url'] for s in scans],
+            'keep': keep['name'],
+            'scanSize': total,
+            'wasted_scan_size': total - keep.get('scanSize', 0),
+        }
+
+    def _find_similar_scan_names(self):
+        '''Cluster codelocations with near-duplicate names, across the hub and within each version.
+        Typically these are the same thing scanned under names that differ by a build number or
+        path, and all but the most recent are redundant.
+        '''
+        clusterer = NameClusterer(threshold=self.similar_name_threshold)
+        scans = self.data['scans']
+        hub_clusters = [self._scan_cluster([scans[i] for i in keys])
+                        for keys in clusterer.clusters({i: s['name'] for i, s in enumerate(scans)})]
+        hub_clusters.sort(key=lambda c: c['wasted_scan_size'], reverse=True)
+
+        versions_with_similar_scans = []
+        for p in self.data['projects']:
+            for v in p['versions']:
+                if len(v['scans']) < 2:
+                    continue
+                clusters = [self._scan_cluster([v['scans'][i] for i in keys])
+                            for keys in clusterer.clusters({i: s['name'] for i, s in enumerate(v['scans'])})]
+                if not clusters:
+                    continue
+                clusters.sort(key=lambda c: c['wasted_scan_size'], reverse=True)
+                v['similar_scans'] = clusters
+                v['similar_scans_message'] = """Project {}, version {} has {} groups of scans with nearly the same
+                    name, e.g. {}, holding {} bytes of scans that are probably redundant. Keep the most recent scan of
+                    each group, delete the others and use --detect.code.location.name with Synopsys detect to give
+                    repeat scans the same name so that they replace each other.""".format(
+                        v['project_name'], v['versionName'], len(clusters), ", ".join(clusters[0]['names'][:3]),
+                        sum([c['wasted_scan_size'] for c in clusters]))
+                v['similar_scans_message'] = self._remove_white_space(v['similar_scans_message'])
+                versions_with_similar_scans.append(v)
+
+        self.data['similar_scan_names'] = {
+            'clusters': hub_clusters,
+            'wasted_scan_size': sum([c['wasted_scan_size'] for c in hub_clusters]),
+        }
+        self.data['versions_with_similar_scans'] = versions_with_similar_scans
+
+    UNMAPPED_AGE_BUCKETS = [30, 90, 180, 365, 730]  # days
+
+    def _analysis_time(self):
+        if 'time_of_analysis' in self.data:
+            # written by datetime.now().isoformat(), i.e. local time
+            return datetime.fromisoformat(self.data['time_of_analysis']).astimezone(timezone.utc)
+        return datetime.now(timezone.utc)
+
     def _find_unmapped_scans(self):
         self.data['unmapped_scans'] = list(filter(
             lambda s: s.get('mappedProjectVersion') is None, self.data['scans']))
         self.data['total_unmapped_scans'] = len(self.data['unmapped_scans'])
+
+        now = self._analysis_time()
+        limits = sorted(set(BlackDuckSage.UNMAPPED_AGE_BUCKETS + [self.max_age_for_unmapped_scans]))
+        buckets = [{'scans': 0, 'scanSize': 0} for _ in range(len(limits) + 1)]
+        index = []
+        old_unmapped_scans = []
         for ums in self.data['unmapped_scans']:
+            # the last time anything was scanned into it
+            last_scanned = ums.get('updatedAt', ums.get('createdAt'))
+            age = (now - self._parse_timestamp(last_scanned)).total_seconds() / 86400 if last_scanned else math.inf
+            bucket = buckets[bisect.bisect_left(limits, age)]
+            bucket['scans'] += 1
+            bucket['scanSize'] += ums.get('scanSize', 0)
+            index.append((age, last_id(ums['url']), ums.get('scanSize', 0)))
             ums['unmapped_scan_message'] = """This scan, {}, is not mapped to any project-version in the system. It should
                 either be mapped to something or deleted to reclaim space and reduce clutter.""".format(ums['name'])
             ums['unmapped_scan_message'] = self._remove_white_space(ums['unmapped_scan_message'])
+            if age > self.max_age_for_unmapped_scans:
+                ums['old_unmapped_scan_message'] = """This scan, {}, has not been mapped to any project-version, nor
+                    had anything scanned into it, for more than {} days, after which unmapped scans should be deleted. Deleting it
+                    reclaims {} bytes.""".format(ums['name'], self.max_age_for_unmapped_scans, ums.get('scanSize', 0))
+                ums['old_unmapped_scan_message'] = self._remove_white_space(ums['old_unmapped_scan_message'])
+                old_unmapped_scans.append(ums)
+
+        # sorted by age, with the total scan size of everything at least as old, so that the scans
+        # older than any age, and the space deleting them reclaims, are a bisect away
+        index.sort()
+        self._unmapped_ages = [age for age, _, _ in index]
+        self._unmapped_ids = [codelocation_id for _, codelocation_id, _ in index]
+        self._unmapped_sizes_from = list(itertools.accumulate(reversed([size for _, _, size in index])))[::-1] + [0]
+
+        labels = ["{}-{} days".format(low, high) for low, high in zip([0] + limits, limits)] + ["over {} days".format(limits[-1])]
+        self.data['unmapped_scan_ages'] = {
+            'max_age_days': self.max_age_for_unmapped_scans,
+            'buckets': [dict(b, age=label) for label, b in zip(labels, buckets)],
+            'reclaimable_scan_size': self._unmapped_older_than(self.max_age_for_unmapped_scans)[1],
+        }
+        self.data['old_unmapped_scans'] = old_unmapped_scans
+
+    def _unmapped_older_than(self, days):
+        '''(codelocation ids, total scan size) of the unmapped scans older than days'''
+        start = bisect.bisect_right(self._unmapped_ages, days)
+        return self._unmapped_ids[start:], self._unmapped_sizes_from[start]
+
+    def _write_unmapped_manifest(self):
+        ids, scan_size = self._unmapped_older_than(self.manifest_min_age)
+        with open(self.unmapped_manifest + ".tmp", 'w') as f:
+            f.writelines(i + "\n" for i in ids)
+        os.replace(self.unmapped_manifest + ".tmp", self.unmapped_manifest)
+        logging.info("Wrote the IDs of %i unmapped scans older than %s days (%i bytes) to %s",
+                     len(ids), self.manifest_min_age, scan_size, self.unmapped_manifest)
+
+    def _shortest_scan_interval(self, scan):
+        '''Shortest time, in hours, between two scans into a codelocation, None with fewer than two scans.
+
+        When only the newest of its scan summaries were collected (--latest-summaries) this is the
+        shortest interval among them or, if shorter, the average interval between all its scans
+        since the codelocation was created, which the shortest one cannot exceed. A burst of scans
+        further back than the newest summaries is missed unless it brings that average down.
+        '''
+        # found there can be scan summaries that don't have a createdAt so filter those out
+        created = sorted([self._parse_timestamp(ss['createdAt']) for ss in scan.get('scan_summaries', []) if 'createdAt' in ss])
+        intervals = [(b - a).total_seconds() / 3600 for a, b in zip(created, created[1:])]
+        total = scan.get('num_scan_summaries', len(created))
+        if total > len(created) and created and 'createdAt' in scan:
+            span = (created[-1] - self._parse_timestamp(scan['createdAt'])).total_seconds() / 3600
+            intervals.append(max(0.0, span) / (total - 1))
+        return min(intervals) if intervals else None
 
     def _find_high_frequency_scans(self):
         high_freq_scans = []
         for scan in self.data['scans']:
-            if scan.get('scan_summaries') and len(scan['scan_summaries']) > 1:
-                # found there can be scan summaries that don't have a createdAt so filter those out
-                scans_with_created_at = list(filter(lambda s: 'createdAt' in s, scan['scan_summaries']))
-                scan_create_dts = sorted([dt_parser.parse(s['createdAt']) for s in scans_with_created_at])
-                if len(scan_create_dts) < 2:
-                    continue
-                total_span_less_than_24h = (scan_create_dts[-1] - scan_create_dts[0]) < timedelta(days=1)
-                spans = [
-                    scan_create_dts[i] - scan_create_dts[i-1] for i in range(1, len(scan_create_dts))
-                ]
-                any_span_less_than_24h = any([s < timedelta(days=1) for s in spans])
-                if any_span_less_than_24h or total_span_less_than_24h:
-                    scan['high_freq_scan_message'] = """This scan (aka code location) has two or more scans (out of {}) that
-                        were run within 24 hours of each other which may indicate a scan that is being run too
-                        often. Consider reducing the frequency to once per day.""".format(len(scan_create_dts))
-                    scan['high_freq_scan_message'] = self._remove_white_space(scan['high_freq_scan_message'])
-                    high_freq_scans.append(scan)
+            interval = self._shortest_scan_interval(scan)
+            if interval is not None and interval < self.high_frequency_window:
+                num_scans = scan.get('num_scan_summaries', len([ss for ss in scan['scan_summaries'] if 'createdAt' in ss]))
+                scan['high_freq_scan_message'] = """This scan (aka code location) has two or more scans (out of {}) that
+                    were run within {} hours of each other which may indicate a scan that is being run too
+                    often. Consider reducing the frequency to once every {} hours.""".format(
+                        num_scans, self.high_frequency_window, self.high_frequency_window)
+                scan['high_freq_scan_message'] = self._remove_white_space(scan['high_freq_scan_message'])
+                high_freq_scans.append(scan)
         self.data['high_frequency_scans'] = high_freq_scans
 
+    def sweep(self, thresholds):
+        '''What each value of each threshold would flag, as {threshold: [(value, entities flagged, their scan size)]}.
+
+        thresholds maps max_versions_per_project, max_scans_per_version and high_frequency_window
+        to the values to try. The per-entity counts are sorted once, with running totals of scan
+        size, so every value is answered with a binary search.
+        '''
+        self._calc_scan_sizes()
+        versions = [v for p in self.data['projects'] for v in p['versions']]
+        intervals = [(self._shortest_scan_interval(s), s.get('scanSize', 0)) for s in self.data['scans']]
+        intervals = sorted((i, size) for i, size in intervals if i is not None)
+        # entities flagged by exceeding a threshold are a suffix of their sorted counts, frequent scans a prefix
+        indexes = {
+            'max_versions_per_project': (sorted((p['num_versions'], p.get('scanSize', 0)) for p in self.data['projects']), False),
+            'max_scans_per_version': (sorted((v['num_scans'], v.get('scanSize', 0)) for v in versions), False),
+            'high_frequency_window': (intervals, True),
+        }
+        results = {}
+        for threshold, values in thresholds.items():
+            counts, prefix = indexes[threshold]
+            keys = [c for c, _ in counts]
+            sizes = [0] + list(itertools.accumulate(size for _, size in counts))
+            results[threshold] = []
+            for value in values:
+                if prefix:
+                    n = bisect.bisect_left(keys, value)
+                    results[threshold].append((value, n, sizes[n]))
+                else:
+                    n = bisect.bisect_right(keys, value)
+                    results[threshold].append((value, len(keys) - n, sizes[-1] - sizes[n]))
+        return results
+
+    @staticmethod
+    def _parse_timestamp(timestamp):
+        # fromisoformat is much faster than dateutil but only understands a trailing Z from python 3.11
+        try:
+            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        except ValueError:
+            dt = dt_parser.parse(timestamp)
+        return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+    @staticmethod
+    def _percentile(sorted_values, p):
+        # nearest-rank percentile
+        if not sorted_values:
+            return None
+        return sorted_values[max(0, math.ceil(p / 100.0 * len(sorted_values)) - 1)]
+
+    def _scan_durations(self, scan):
+        '''Processing time, in seconds, of each completed scan summary of a codelocation'''
+        durations = []
+        for ss in scan.get('scan_summaries', []):
+            if 'createdAt' not in ss or 'updatedAt' not in ss or ss.get('status', 'COMPLETE') != 'COMPLETE':
+                continue
+            duration = (self._parse_timestamp(ss['updatedAt']) - self._parse_timestamp(ss['createdAt'])).total_seconds()
+            if duration >= 0:
+                durations.append((duration, ss['createdAt']))
+        return durations
+
+    def _analyze_scan_processing(self):
+        '''Find scans that take long to process or are so large they should be split, and the ones
+        using most of the Hub's scan processing time. Top-N lists are kept in bounded heaps so
+        they cost O(n log N) however many scans there are.
+        '''
+        all_durations = []
+        slowest = []  # heap of the top_n longest individual scans
+        busiest = []  # heap of the top_n codelocations by total processing time
+        slow_scans = []
+        scans_to_split = []
+        max_duration = self.max_scan_duration * 60
+        for n, scan in enumerate(self.data['scans']):
+            durations = self._scan_durations(scan)
+            if durations:
+                seconds = sorted(d for d, _ in durations)
+                all_durations.extend(seconds)
+                scan['processing_time'] = {
+                    'scans': len(seconds),
+                    'total': sum(seconds),
+                    'p50': self._percentile(seconds, 50),
+                    'p90': self._percentile(seconds, 90),
+                    'max': seconds[-1],
+                }
+                for duration, created_at in durations:
+                    entry = (duration, n, created_at)
+                    if len(slowest) < self.top_n:
+                        heapq.heappush(slowest, entry)
+                    elif entry > slowest[0]:
+                        heapq.heapreplace(slowest, entry)
+                entry = (scan['processing_time']['total'], n)
+                if len(busiest) < self.top_n:
+                    heapq.heappush(busiest, entry)
+                elif entry > busiest[0]:
+                    heapq.heapreplace(busiest, entry)
+                if scan['processing_time']['p50'] > max_duration:
+                    scan['slow_scan_message'] = """This scan (aka code location) typically takes {:.0f} minutes to process
+                        (longest {:.0f} minutes) which is more than the recommended {} minutes. Long running scans tie up
+                        the Hub's job queue and delay results for everyone. Consider excluding directories that don't need
+                        scanning, or splitting the scan up into smaller ones.""".format(
+                            scan['processing_time']['p50'] / 60, seconds[-1] / 60, self.max_scan_duration)
+                    scan['slow_scan_message'] = self._remove_white_space(scan['slow_scan_message'])
+                    slow_scans.append(scan)
+
+            reasons = []
+            if scan.get('scanSize', 0) > self.max_recommended_scan_size:
+                reasons.append("its size of {:.1f} GB is above the recommended {:.1f} GB".format(
+                    scan['scanSize'] / 1024 ** 3, self.max_recommended_scan_size / 1024 ** 3))
+            if scan.get('fileCount', 0) > self.max_recommended_file_count:
+                reasons.append("its {} files are more than the recommended {}".format(
+                    scan['fileCount'], self.max_recommended_file_count))
+            if reasons:
+                scan['split_scan_message'] = """This scan (aka code location) should be split up because {}.
+                    Large scans take a long time to process, hold up other scans in the Hub's job queue and are
+                    expensive to re-scan. Scan the sub-projects or modules separately, each with its own
+                    --detect.code.location.name, or exclude content that doesn't need scanning.""".format(" and ".join(reasons))
+                scan['split_scan_message'] = self._remove_white_space(scan['split_scan_message'])
+                scans_to_split.append(scan)
+
+        def summary(scan, **kwargs):
+            s = {k: scan[k] for k in ('name', 'url', 'scanSize', 'fileCount', 'mappedProjectVersion') if k in scan}
+            s.update(kwargs)
+            return s
+
+        scans = self.data['scans']
+        all_durations.sort()
+        self.data['scan_processing'] = {
+            'scans_with_durations': len(all_durations),
+            'duration_percentiles': {
+                "p{}".format(p): self._percentile(all_durations, p) for p in (50, 90, 95, 99, 100)},
+            'slowest_scans': [summary(scans[n], duration=d, createdAt=c) for d, n, c in sorted(slowest, reverse=True)],
+            'busiest_scans': [summary(scans[n], total_processing_time=t, scans=scans[n]['processing_time']['scans'])
+                              for t, n in sorted(busiest, reverse=True)],
+            'largest_scans': [summary(s) for s in heapq.nlargest(self.top_n, scans, key=lambda s: s.get('scanSize', 0))],
+        }
+        self.data['slow_scans'] = slow_scans
+        self.data['scans_to_split'] = scans_to_split
+
+    @staticmethod
+    def _content_fingerprint(scan):
+        '''Hash of what a codelocation's latest scan contained, None when there is too little to go by'''
+        if not scan.get('scanSize'):
+            return None
+        summaries = [ss for ss in scan.get('scan_summaries', []) if ss.get('status', 'COMPLETE') == 'COMPLETE']
+        latest = max(summaries, key=lambda ss: ss.get('createdAt', ''), default={})
+        content = [scan['scanSize'], scan.get('fileCount'), scan.get('directoryCount'),
+                   latest.get('matchCount'), latest.get('baseDirectory')]
+        return hashlib.blake2b(json.dumps(content).encode('utf-8'), digest_size=8).hexdigest()
+
+    def _find_redundant_scans(self):
+        '''Group codelocations holding identical content, going by their size, file, directory and
+        match counts and base directory, and list all but the most recently updated of each group
+        as redundant copies that can be deleted.
+        '''
+        groups = defaultdict(list)
+        for scan in self.data['scans']:
+            fingerprint = self._content_fingerprint(scan)
+            if fingerprint:
+                groups[fingerprint].append(scan)
+
+        def summary(scan):
+            return {k: scan[k] for k in ('name', 'url', 'mappedProjectVersion') if k in scan}
+
+        duplicate_groups = []
+        redundant_scans = []
+        for fingerprint, scans in groups.items():
+            if len(scans) < 2:
+                continue
+            keep = max(scans, key=lambda s: s.get('updatedAt', ''))
+            copies = [s for s in scans if s is not keep]
+            group = {
+                'fingerprint': fingerprint,
+                'scanSize': keep['scanSize'],
+                'fileCount': keep.get('fileCount'),
+                'keep': summary(keep),
+                'copies': [summary(s) for s in copies],
+                'wasted_scan_size': sum([s['scanSize'] for s in copies]),
+                'wasted_processing_time': sum([s.get('processing_time', {}).get('total', 0) for s in copies]),
+            }
+            duplicate_groups.append(group)
+            for scan in copies:
+                scan['redundant_scan_message'] = """This scan (aka code location) has the same content ({} bytes,
+                    {} files) as {} and {} other(s). It has taken {:.0f} minutes of the Hub's scan processing time.
+                    Unless it is needed to keep the BOM of another project-version, it can be deleted, and re-scanning
+                    the same content into several versions should be avoided.""".format(
+                        scan['scanSize'], scan.get('fileCount', 'unknown'), keep['name'], len(copies) - 1,
+                        scan.get('processing_time', {}).get('total', 0) / 60)
+                scan['redundant_scan_message'] = self._remove_white_space(scan['redundant_scan_message'])
+                redundant_scans.append(scan)
+        duplicate_groups.sort(key=lambda g: g['wasted_scan_size'], reverse=True)
+
+        self.data['duplicate_scans'] = {
+            'groups': duplicate_groups,
+            'wasted_scan_size': sum([g['wasted_scan_size'] for g in duplicate_groups]),
+            'wasted_processing_time': sum([g['wasted_processing_time'] for g in duplicate_groups]),
+        }
+        self.data['redundant_scans'] = redundant_scans
+
+    WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+    @staticmethod
+    def _hour_of_week_name(bucket):
+        return "{} {:02d}:00".format(BlackDuckSage.WEEKDAYS[bucket // 24], bucket % 24)
+
+    def _analyze_scan_load(self):
+        '''Count scan submissions per scanner host, per user and per hour of the week (UTC) to find
+        when the Hub is busiest and who is submitting scans then. Counts are kept in 168 hourly
+        buckets per submitter so memory does not grow with the number of scan summaries.
+        '''
+        heatmap = [0] * (7 * 24)
+        submitters = {'hosts': defaultdict(lambda: [0] * (7 * 24)), 'users': defaultdict(lambda: [0] * (7 * 24))}
+        for scan in self.data['scans']:
+            for ss in scan.get('scan_summaries', []):
+                if 'createdAt' not in ss:
+                    continue
+                created = self._parse_timestamp(ss['createdAt']).astimezone(timezone.utc)
+                bucket = created.weekday() * 24 + created.hour
+                heatmap[bucket] += 1
+                submitters['hosts'][ss.get('hostName') or 'unknown'][bucket] += 1
+                submitters['users'][ss.get('createdByUserName') or 'unknown'][bucket] += 1
+
+        total = sum(heatmap)
+        busy_hours = [b for b in range(len(heatmap)) if heatmap[b]]
+        # an hour is a peak when it sees well above the load of an average hour in which scans are submitted
+        average = total / len(busy_hours) if busy_hours else 0
+        peak_hours = sorted([b for b in busy_hours if heatmap[b] >= self.peak_load_factor * average],
+                            key=lambda b: heatmap[b], reverse=True)
+        quiet_hours = sorted(range(len(heatmap)), key=lambda b: (heatmap[b], b))[:self.top_n]
+        peak_scans = sum([heatmap[b] for b in peak_hours])
+
+        load = {
+            'timezone': 'UTC',
+            'total_scan_submissions': total,
+            'heatmap': {day: heatmap[i * 24:(i + 1) * 24] for i, day in enumerate(BlackDuckSage.WEEKDAYS)},
+            'peak_hours': [{'hour': self._hour_of_week_name(b), 'scans': heatmap[b]} for b in peak_hours],
+            'quiet_hours': [{'hour': self._hour_of_week_name(b), 'scans': heatmap[b]} for b in quiet_hours],
+            'recommendations': [],
+        }
+        for kind, counts in submitters.items():
+            top = []
+            for name, buckets in counts.items():
+                top.append({'name': name, 'scans': sum(buckets), 'peak_scans': sum([buckets[b] for b in peak_hours])})
+            top.sort(key=lambda t: (t['peak_scans'], t['scans']), reverse=True)
+            load[kind] = top[:self.top_n]
+            for t in load[kind]:
+                if not peak_scans or t['peak_scans'] / peak_scans < self.min_peak_share:
+                    continue
+                t['peak_share'] = t['peak_scans'] / peak_scans
+                message = """{} {} submitted {} scans during the Hub's peak hours ({:.0%} of all peak-hour scans).
+                    Scheduling these scans in quieter hours, e.g. {}, would reduce contention for the Hub's
+                    job queue.""".format(
+                        'Scanner host' if kind == 'hosts' else 'User', t['name'], t['peak_scans'], t['peak_share'],
+                        ", ".join(self._hour_of_week_name(b) for b in quiet_hours[:3]))
+                load['recommendations'].append({kind[:-1]: t['name'], 'peak_scans': t['peak_scans'],
+                                                'message': self._remove_white_space(message)})
+        self.data['scan_load'] = load
+
     # Calculate the total scan size for all scans in each version and all versions in a project.
     # Add 'scanSize' data to each project and version object with the results.
     def _calc_scan_sizes(self):
@@ -293,27 +915,349 @@ class BlackDuckSage(object):
                 project_scan_size += version_scan_size
             p['scanSize'] = project_scan_size
 
+    # /api/job-statistics is undocumented, so accept the field names seen across Hub releases
+    JOB_STATISTICS_FIELDS = {
+        'runs': ('totalRuns', 'runs'),
+        'successes': ('totalSuccesses', 'successes'),
+        'failures': ('totalFailures', 'failures'),
+        'in_progress': ('totalInProgress', 'inProgress'),
+        'average_run_time': ('averageRunTime', 'avgRunTime'),
+        'max_run_time': ('maxRunTime',),
+    }
+
+    @staticmethod
+    def _job_field(job, field):
+        for name in BlackDuckSage.JOB_STATISTICS_FIELDS[field]:
+            if isinstance(job.get(name), (int, float)):
+                return job[name]
+        return None
+
     def _analyze_jobs(self):
         logging.info("Fetching job statistics...")
         # This endpoint is not in the REST API docs with 2021.2 but it still works
         url = "/api/job-statistics"
-        job_statistics = list(hub.get_items(url, headers={'accept': "application/vnd.blackducksoftware.status-4+json"}))
+        job_statistics = list(self.hub.get_items(url, headers={'accept': "application/vnd.blackducksoftware.status-4+json"}))
         logging.info("Fetched %i job statistics", len(job_statistics))
         self.data['job_statistics'] = job_statistics
+        self._analyze_job_statistics()
+
+    def _analyze_job_statistics(self):
+        '''Summarize the Hub's (cumulative) job counters per job type, flag the job types limiting
+        the Hub's throughput and, given a job history file, compare with the previous run to see
+        whether processing capacity is degrading.
+        '''
+        job_types = {}
+        for job in self.data.get('job_statistics', []):
+            job_type = job.get('jobType', job.get('name', 'unknown'))
+            stats = {field: self._job_field(job, field) for field in BlackDuckSage.JOB_STATISTICS_FIELDS}
+            runs = stats['runs'] or 0
+            if stats['failures'] is not None and runs:
+                stats['failure_rate'] = stats['failures'] / runs
+            if stats['average_run_time'] is not None:
+                stats['total_run_time'] = stats['average_run_time'] * runs
+            job_types[job_type] = stats
+
+        total_run_time = sum([j.get('total_run_time', 0) for j in job_types.values()])
+        bottlenecks = []
+        for job_type, stats in job_types.items():
+            reasons = []
+            if total_run_time and stats.get('total_run_time', 0) / total_run_time >= self.job_run_time_share:
+                stats['run_time_share'] = stats['total_run_time'] / total_run_time
+                reasons.append("it accounts for {:.0%} of all job processing time".format(stats['run_time_share']))
+            if (stats['runs'] or 0) >= 10 and stats.get('failure_rate', 0) > self.max_job_failure_rate:
+                reasons.append("{:.1%} of its runs failed".format(stats['failure_rate']))
+            if (stats['in_progress'] or 0) >= self.max_job_backlog:
+                reasons.append("{} jobs are in progress or waiting".format(stats['in_progress']))
+            if reasons:
+                bottlenecks.append({'jobType': job_type, 'reasons': reasons, 'message': self._remove_white_space(
+                    """Job type {} may be limiting the Hub's throughput because {}. Review the job's recent
+                    failures in the Hub's job list and the server's sizing for this load.""".format(job_type, " and ".join(reasons)))})
+        bottlenecks.sort(key=lambda b: job_types[b['jobType']].get('total_run_time', 0), reverse=True)
+
+        self.data['job_analysis'] = {'job_types': job_types, 'bottlenecks': bottlenecks}
+        if self.job_history_file:
+            self.data['job_analysis']['trend'] = self._compare_with_job_history(job_types)
+
+    def _compare_with_job_history(self, job_types):
+        '''Append this run's job counters to the job history (one JSON document per line) and
+        compare them with the previous entry. The Hub's counters are cumulative, so the runs
+        completed per hour in between give the throughput.
+        '''
+        now = datetime.now(timezone.utc)
+        previous = None
+        if os.path.exists(self.job_history_file):
+            with open(self.job_history_file, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        previous = json.loads(line)
+        trend = self._job_trend(job_types, previous, now) if previous else {
+            'message': "No earlier job statistics recorded in {} to compare with".format(self.job_history_file)}
+        # recorded after comparing so that each entry carries the throughput measured when it was taken
+        with open(self.job_history_file, 'a') as f:
+            f.write(json.dumps({'time': now.isoformat(), 'job_types': job_types}) + "\n")
+        return trend
+
+    def _job_trend(self, job_types, previous, now):
+        hours = (now - self._parse_timestamp(previous['time'])).total_seconds() / 3600
+        trend = {'since': previous['time'], 'job_types': {}, 'degraded': []}
+        for job_type, stats in job_types.items():
+            before = previous['job_types'].get(job_type)
+            if not before:
+                continue
+            change = {}
+            if stats['runs'] is not None and before.get('runs') is not None and hours > 0 and stats['runs'] >= before['runs']:
+                # a counter going backwards means the Hub restarted and reset them
+                change['runs_per_hour'] = (stats['runs'] - before['runs']) / hours
+                if 'runs_per_hour' in before.get('trend', {}):
+                    change['previous_runs_per_hour'] = before['trend']['runs_per_hour']
+            if stats['average_run_time'] and before.get('average_run_time'):
+                change['average_run_time_change'] = stats['average_run_time'] / before['average_run_time'] - 1
+            if (stats['in_progress'] or 0) > (before.get('in_progress') or 0):
+                change['backlog_growth'] = stats['in_progress'] - (before.get('in_progress') or 0)
+            stats['trend'] = {k: v for k, v in change.items() if k == 'runs_per_hour'}
+            slower = change.get('average_run_time_change', 0) > 0.25
+            less_throughput = change.get('runs_per_hour', 0) < 0.75 * change.get('previous_runs_per_hour', 0)
+            if slower or (less_throughput and change.get('backlog_growth')):
+                trend['degraded'].append(job_type)
+            trend['job_types'][job_type] = change
+        return trend
 
     def analyze(self):
         self.data["sage_version"] = BlackDuckSage.VERSION
         self.data["time_of_analysis"] = datetime.now().isoformat()
+        self._export_run_metrics('total')
         self._get_data()
+        self._export_run_metrics('collection')
+        self._analyze_data()
+        if self.sample:
+            self._estimate_from_sample()
+
+        self.data["hub_url"] = self.hub.base_url
+        self.data["hub_version"] = self.get_hub_version_info(self.hub)
+
+        if self.analyze_jobs_flag and not (self.shard and self.shard[0] != 0):
+            self._analyze_jobs()
+        if self.tables:
+            self.tables.write_findings(self.data, BlackDuckSage.FINDINGS)
+            self.tables.close()
+        self._write_results()
+
+    def refresh(self):
+        '''Collect and analyze the hub again, e.g. on a schedule in a long-running process, fetching
+        only the scan summaries of the codelocations updated since the previous collection.
+        Returns the new data, leaving the previous data as it was for anyone still reading it.
+        '''
+        self.data = {}
+        self.started = time.monotonic()
+        self.analyze()
+        return self.data
+
+    def _count(self, name, parent=None, offset=0, headers=None):
+        '''Fetch a single item of a resource listing, returning (totalCount, items) and timing the request'''
+        start = time.monotonic()
+        page = self.hub.get_resource(name, parent, items=False, params={'offset': offset, 'limit': 1}, headers=headers)
+        self._timings.append(time.monotonic() - start)
+        return page.get('totalCount', 0), page.get('items', [])
+
+    @staticmethod
+    def _pages(count, page_size=250):
+        # Client.get_items always makes at least one request, and one more when the last page is full
+        return int(count // page_size) + 1
+
+    def preflight(self):
+        '''Estimate the size of the hub and the cost of a full collection using only limit=1 requests.
+
+        totalCount gives the number of projects, codelocations and policies. The versions per
+        project, codelocations per version and scan summaries per codelocation are estimated from
+        a random sample, and the time to list all projects from timing one page of them.
+        '''
+        self._timings = []
+        rng = random.Random(self.seed)
+        version_headers = {'accept': "application/vnd.blackducksoftware.project-detail-5+json"}
+        scan_headers = {'accept': "application/vnd.blackducksoftware.scan-4+json"}
+
+        total_projects, _ = self._count('projects')
+        total_codelocations, _ = self._count('codeLocations', headers=scan_headers)
+        total_policies, _ = self._count('policyRules')
+
+        versions_per_project = []
+        codelocations_per_version = []
+        for offset in rng.sample(range(total_projects), min(self.preflight_samples, total_projects)):
+            _, projects = self._count('projects', offset=offset)
+            if not projects:
+                continue
+            num_versions, versions = self._count('versions', projects[0], headers=version_headers)
+            versions_per_project.append(num_versions)
+            if versions:
+                headers = {'accept': "application/json", 'content-type': "application/vnd.blackducksoftware.scan-4+json"}
+                codelocations_per_version.append(self._count('codelocations', versions[0], headers=headers)[0])
+        summaries_per_codelocation = []
+        for offset in rng.sample(range(total_codelocations), min(self.preflight_samples, total_codelocations)):
+            _, codelocations = self._count('codeLocations', offset=offset, headers=scan_headers)
+            if codelocations:
+                summaries_per_codelocation.append(self._count('scans', codelocations[0], headers=scan_headers)[0])
+
+        start = time.monotonic()
+        list(itertools.islice(self.hub.get_resource('projects', headers={'accept': "application/vnd.blackducksoftware.project-detail-4+json"}), 250))
+        page_seconds = time.monotonic() - start
+
+        def mean(values):
+            return sum(values) / len(values) if values else 0
+
+        est_versions = round(total_projects * mean(versions_per_project))
+        est_summaries = round(total_codelocations * mean(summaries_per_codelocation))
+        requests = {
+            'projects': self._pages(total_projects),
+            'versions': total_projects * self._pages(mean(versions_per_project)),
+            'version_codelocations': est_versions * self._pages(mean(codelocations_per_version)),
+            'policies': self._pages(total_policies),
+            'codelocations': self._pages(total_codelocations),
+            'scan_summaries': total_codelocations * self._pages(mean(summaries_per_codelocation)),
+        }
+        total_requests = sum(requests.values())
+        seconds_per_request = mean(self._timings)
+        est_runtime = total_requests * seconds_per_request
+        est_project_listing = requests['projects'] * page_seconds
+
+        warnings = []
+        if total_projects > self.max_recommended_projects:
+            warnings.append("""The hub has {} projects which is more than the recommended maximum of {}. Review the
+                projects with the most versions and scans first, and delete projects that are no longer used.""".format(
+                    total_projects, self.max_recommended_projects))
+        if est_project_listing > self.max_time_to_retrieve_projects:
+            warnings.append("""Listing all projects will take about {:.0f} seconds which is more than the expected
+                {} seconds, an indication that the hub is overloaded or under-resourced.""".format(
+                    est_project_listing, self.max_time_to_retrieve_projects))
+        recommendations = []
+        shards = math.ceil(est_runtime / (self.max_runtime * 3600)) if est_runtime else 1
+        if shards > 1:
+            recommendations.append("""A full collection will take about {} which is more than {} hours.
+                Run it as {} concurrent shards (--shard 0/{} ... --shard {}/{}) and combine them with
+                'sage.py merge', or collect a sample of the hub.""".format(
+                    timedelta(seconds=round(est_runtime)), self.max_runtime, shards, shards, shards - 1, shards))
 
+        self.data = {
+            'sage_version': BlackDuckSage.VERSION,
+            'time_of_analysis': datetime.now().isoformat(),
+            'hub_url': self.hub.base_url,
+            'preflight': {
+                'total_projects': total_projects,
+                'total_codelocations': total_codelocations,
+                'total_policies': total_policies,
+                'samples': {
+                    'versions_per_project': versions_per_project,
+                    'codelocations_per_version': codelocations_per_version,
+                    'scan_summaries_per_codelocation': summaries_per_codelocation,
+                },
+                'estimated_versions': est_versions,
+                'estimated_scan_summaries': est_summaries,
+                'estimated_requests': dict(requests, total=total_requests),
+                'seconds_per_request': seconds_per_request,
+                'estimated_project_listing_seconds': est_project_listing,
+                'estimated_runtime_seconds': est_runtime,
+                'estimated_runtime': str(timedelta(seconds=round(est_runtime))),
+                'recommended_shards': shards,
+                'warnings': [self._remove_white_space(w) for w in warnings],
+                'recommendations': [self._remove_white_space(r) for r in recommendations],
+            },
+        }
+        preflight = self.data['preflight']
+        logging.info("%i projects (~%i versions), %i codelocations (~%i scan summaries), %i policies",
+                     total_projects, est_versions, total_codelocations, est_summaries, total_policies)
+        logging.info("A full collection needs about %i requests and %s at %.2fs per request",
+                     total_requests, preflight['estimated_runtime'], seconds_per_request)
+        for message in preflight['warnings'] + preflight['recommendations']:
+            logging.warning(message)
+        self._write_results()
+
+    def _sample_listing(self, name, headers=None):
+        '''Fetch a stratified random sample of self.sample items of a root listing.
+
+        The listing is divided into equally sized strata and one item, at a random offset, is
+        fetched from each with a limit=1 request, so the sample covers the whole listing and
+        costs one request per item.
+        '''
+        rng = random.Random(self.seed)
+        population, _ = self._count(name, headers=headers)
+        n = min(self.sample, population)
+        items = []
+        for i in range(n):
+            offset = rng.randrange(i * population // n, (i + 1) * population // n)
+            items.extend(self._count(name, offset=offset, headers=headers)[1])
+        self.data.setdefault('sample', {})[name.lower()] = {'population': population, 'sampled': len(items)}
+        logging.info("Sampled %i of %i %s", len(items), population, name)
+        return items
+
+    @staticmethod
+    def _estimate_total(values, population, z):
+        '''Estimate the population total of values from a simple random sample, with a normal
+        approximation confidence interval corrected for sampling without replacement'''
+        n = len(values)
+        if not n:
+            return None
+        mean = sum(values) / n
+        variance = sum([(v - mean) ** 2 for v in values]) / (n - 1) if n > 1 else 0
+        error = z * population * math.sqrt(max(0, 1 - n / population) * variance / n)
+        return {'sampled': sum(values), 'estimate': population * mean,
+                'low': max(0, population * mean - error), 'high': population * mean + error}
+
+    def _estimate_from_sample(self):
+        '''Scale the totals and finding counts of a sampled collection up to the whole hub.
+
+        Project and version findings are estimated from the projects sampled, codelocation ones
+        from the codelocations sampled. The finding lists themselves only hold the sampled entities.
+        '''
+        sample = self.data['sample']
+        z = NormalDist().inv_cdf((1 + self.confidence) / 2)
+        projects = self.data['projects']
+        scans = self.data['scans']
+        num_projects = sample['projects']['population']
+        num_scans = sample['codelocations']['population']
+
+        estimates = {
+            'total_versions': self._estimate_total([p['num_versions'] for p in projects], num_projects, z),
+            'total_scan_size': self._estimate_total([s.get('scanSize', 0) for s in scans], num_scans, z),
+            'number_signature_scans': self._estimate_total([int(self._is_signature_scan(s)) for s in scans], num_scans, z),
+            'number_bom_scans': self._estimate_total([int(self._is_bom_scan(s)) for s in scans], num_scans, z),
+        }
+        for finding, (entity_type, _) in BlackDuckSage.FINDINGS.items():
+            if entity_type == 'codelocation':
+                urls = set(e['url'] for e in self.data[finding])
+                values = [int(s['url'] in urls) for s in scans]
+                estimates[finding] = self._estimate_total(values, num_scans, z)
+            else:
+                # versions are counted against the project their url belongs to
+                per_project = defaultdict(int)
+                for e in self.data[finding]:
+                    per_project[e['url'].split('/versions/')[0]] += 1
+                estimates[finding] = self._estimate_total([per_project[p['url']] for p in projects], num_projects, z)
+        estimates['total_unmapped_scans'] = estimates['unmapped_scans']
+
+        sample['confidence'] = self.confidence
+        sample['estimates'] = estimates
+        self.data['total_projects'] = num_projects
+        self.data['total_scans'] = num_scans
+        for total in BlackDuckSage.TOTALS:
+            if estimates.get(total):
+                self.data[total] = round(estimates[total]['estimate'])
+        for finding, estimate in estimates.items():
+            if finding in BlackDuckSage.FINDINGS and estimate:
+                logging.info("%s: about %.0f (%.0f - %.0f)", finding, estimate['estimate'], estimate['low'], estimate['high'])
+
+    def _analyze_data(self):
         logging.info("Analyzing data")
         self._calc_scan_sizes()
         self._find_projects_with_too_many_versions()
         self._find_projects_without_an_owner()
+        self._find_projects_with_version_churn()
         self._find_versions_with_too_many_scans()
         self._find_versions_with_zero_scans()
+        self._find_similar_scan_names()
         self._find_unmapped_scans()
         self._find_high_frequency_scans()
+        self._analyze_scan_processing()
+        self._find_redundant_scans()
+        self._analyze_scan_load()
         self.data['total_scans'] = len(self.data['scans'])
         self.data['total_scan_size'] = sum([s.get('scanSize', 0) for s in self.data['scans']])
         self.data['number_signature_scans'] = len(list(filter(
@@ -321,18 +1265,310 @@ class BlackDuckSage(object):
         self.data['number_bom_scans'] = len(list(filter(
             lambda s: self._is_bom_scan(s), self.data['scans'])))
 
-        self.data["hub_url"] = self.hub.base_url
-        self.data["hub_version"] = self.get_hub_version_info()
+    # attributes the analysis adds to the collected entities
+    DERIVED_ATTRIBUTES = ['processing_time', 'similar_scans', 'version_churn']
+    # report keys holding collected, rather than derived, data
+    COLLECTED_KEYS = ['sage_version', 'time_of_analysis', 'hub_url', 'hub_version', 'projects', 'scans', 'policies',
+                      'job_statistics', 'shard', 'project_urls', 'scan_urls']
 
-        if self.analyze_jobs_flag:
-            self._analyze_jobs()
+    @staticmethod
+    def _strip_findings(entities):
+        message_keys = [m for _, m in BlackDuckSage.FINDINGS.values()] + BlackDuckSage.DERIVED_ATTRIBUTES
+        for entity in entities:
+            for key in message_keys:
+                entity.pop(key, None)
+
+    def reanalyze(self, report):
+        '''Re-run the analysis on the data collected by an earlier run, e.g. with other thresholds,
+        without connecting to the hub.
+        '''
+        self.data = {k: report[k] for k in BlackDuckSage.COLLECTED_KEYS if k in report}
+        self.data.setdefault('policies', [])
+        for project in self.data['projects']:
+            self._strip_findings([project])
+            self._strip_findings(project['versions'])
+        self._strip_findings(self.data['scans'])
+        logging.info("Re-analyzing %i projects and %i codelocations collected at %s",
+                     len(self.data['projects']), len(self.data['scans']), self.data.get('time_of_analysis'))
+
+        self.data['total_projects'] = len(self.data['projects'])
+        self.data['total_versions'] = sum([p['num_versions'] for p in self.data['projects']])
+        if 'sample' in report:
+            self.data['sample'] = {k: report['sample'][k] for k in ('projects', 'codelocations')}
+        self._analyze_data()
+        if 'sample' in self.data:
+            self._estimate_from_sample()
+        if self.analyze_jobs_flag and 'job_statistics' in self.data:
+            self._analyze_job_statistics()
+        self.data['sage_version'] = BlackDuckSage.VERSION
+        if self.tables:
+            self.tables.write_findings(self.data, BlackDuckSage.FINDINGS)
+            self.tables.close()
+        self._write_results()
+
+    def merge(self, shard_files):
+        '''Combine the reports written by --shard runs into the report a single run would have
+        produced, re-running the analysis on the combined data.
+        '''
+        shards = {}
+        # the union of every shard's listing of the hub, in case it changed while the shards ran
+        project_order, scan_order = {}, {}
+        listings = set()
+        for shard_file in shard_files:
+            shard_data = load_report(shard_file)
+            if 'shard' not in shard_data:
+                raise ValueError("{} was not produced by a --shard run".format(shard_file))
+            index, count = [int(i) for i in shard_data['shard'].split('/')]
+            if index in shards or (self.data and count != self.data['shard_count']):
+                raise ValueError("{} duplicates or does not belong with the other shards".format(shard_file))
+            shards[index] = shard_file
+            if not self.data:
+                self.data = {k: shard_data[k] for k in ('sage_version', 'time_of_analysis', 'hub_url', 'hub_version')}
+                self.data.update({'shard_count': count, 'projects': [], 'scans': [], 'policies': []})
+            listings.add((tuple(shard_data['project_urls']), tuple(shard_data['scan_urls'])))
+            for url in shard_data['project_urls']:
+                project_order.setdefault(url, len(project_order))
+            for url in shard_data['scan_urls']:
+                scan_order.setdefault(url, len(scan_order))
+            self.data['projects'].extend(shard_data['projects'])
+            self.data['scans'].extend(shard_data['scans'])
+            if index == 0:
+                self.data['policies'] = shard_data['policies']
+                for key in ('job_statistics', 'job_analysis'):
+                    if key in shard_data:
+                        self.data[key] = shard_data[key]
+        missing = set(range(self.data.pop('shard_count'))) - set(shards)
+        if missing:
+            raise ValueError("Missing shard(s) {}".format(", ".join(str(m) for m in sorted(missing))))
+        if len(listings) > 1:
+            logging.warning("The hub's projects or codelocations changed while the shards were collected, "
+                            "entities added or removed in between may be missing from the merged report")
+
+        # Restore the hub's listing order so the merged findings come out in the same order as a single run's
+        self.data['projects'].sort(key=lambda p: project_order.get(p['url'], len(project_order)))
+        self.data['scans'].sort(key=lambda s: scan_order.get(s['url'], len(scan_order)))
+
+        for project in self.data['projects']:
+            self._strip_findings([project])
+            self._strip_findings(project['versions'])
+        self._strip_findings(self.data['scans'])
+
+        self.data['total_projects'] = len(self.data['projects'])
+        self.data['total_versions'] = sum([p['num_versions'] for p in self.data['projects']])
+        self._analyze_data()
         self._write_results()
 
 
+def connect(base_url, api_token=None, token_file=None, username=None, password=None, timeout=15.0, retries=3, scheduler=None):
+    from blackduck import Client
+    from blackduck.Client import HubSession
+    from blackduck.Authentication import BearerAuth, CookieAuth
+
+    verify = False  # TLS certificate verification
+    session = HubSession(base_url, timeout=timeout, retries=retries, verify=verify)
+    if scheduler:
+        scheduler.install(session)
+
+    # De-tangle the possibilities of specifying credentials
+    if api_token:
+        access_token = api_token
+        auth = BearerAuth(session, access_token)
+    elif token_file:
+        with open(token_file, 'r') as tf:
+            access_token = tf.readline().strip()
+        auth = BearerAuth(session, access_token)
+    elif username and password:
+        auth = CookieAuth(session, username, password)
+    else:
+        raise SystemError("Authentication credentials not specified")
+
+    return Client(base_url=base_url, session=session, auth=auth)
+
+
+def load_collected_data(path, snapshot=None):
+    '''The report in path, or the snapshot (by default the latest) of the sage_history.py store in path'''
+    if not os.path.isdir(path):
+        return load_report(path)
+    from sage_history import SnapshotStore
+    store = SnapshotStore(path)
+    entities = store.load(snapshot)
+    entry = store.index['snapshots'][-1 if snapshot is None else snapshot]
+    report = report_from_entities(entities)
+    report.update({k: entry[k] for k in ('time_of_analysis', 'hub_url') if entry.get(k)})
+    return report
+
+
+def parse_shard(value):
+    try:
+        index, count = [int(i) for i in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be given as i/N, e.g. 0/4")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError("shard index must be between 0 and N-1")
+    return (index, count)
+
+
+# (flags, argparse keyword arguments, values 'sage.py sweep' tries by default or None if it can't sweep it)
+ANALYSIS_ARGUMENTS = [
+    (("-vp", "--max_versions_per_project"), dict(type=int, default=20,
+        help="Catch any projects having more than this many versions (default: 20)"), "5,10,20,50,100"),
+    (("-sv", "--max_scans_per_version"), dict(type=int, default=10,
+        help="Catch any project-versions with more than this many scans (default: 10)"), "5,10,20,50"),
+    (("--max-scan-duration",), dict(dest="max_scan_duration", type=int, default=30,
+        help="Flag scans typically taking longer than this many minutes to process (default: 30)"), None),
+    (("--max-scan-size",), dict(dest="max_scan_size", type=float, default=5,
+        help="Recommend splitting scans larger than this many GB (default: 5)"), None),
+    (("--top-n",), dict(dest="top_n", type=int, default=10,
+        help="Number of slowest, busiest and largest scans to list (default: 10)"), None),
+    (("--high-frequency-window",), dict(dest='high_frequency_window', type=float, default=24,
+        help="Report codelocations scanned twice within this many hours as scanned too frequently (default: 24)"), "1,4,12,24,168"),
+    (("--max-unmapped-age",), dict(dest='max_age_unmapped_scans', type=int, default=365,
+        help="Days after which unmapped scans should be deleted (default: 365)"), None),
+    (("--similar-name-threshold",), dict(dest='similar_name_threshold', type=float, default=0.7,
+        help="How similar (0-1) codelocation names must be to be reported as probable duplicates (default: 0.7)"), None),
+]
+
+
+def add_analysis_arguments(parser, sweep=False):
+    '''Add the thresholds of the analysis, so that every command analyzing data, e.g. merging
+    shards, finds what a single run with the same options would. With sweep, only the thresholds
+    'sage.py sweep' can try are added, taking lists of values instead.
+    '''
+    group = parser.add_argument_group('analysis thresholds')
+    for flags, kwargs, sweep_values in ANALYSIS_ARGUMENTS:
+        if not sweep:
+            group.add_argument(*flags, **kwargs)
+        elif sweep_values:
+            group.add_argument(*flags, **dict(kwargs, type=parse_values, default=parse_values(sweep_values),
+                               help="{}. Values to try, e.g. 10,20,50 or 10:100:10 (default: {})".format(
+                                   kwargs['help'].rsplit(" (default", 1)[0], sweep_values)))
+
+
+def analysis_kwargs(args):
+    '''BlackDuckSage keyword arguments from the options added by add_analysis_arguments()'''
+    return {
+        'max_versions_per_project': args.max_versions_per_project,
+        'max_scans_per_version': args.max_scans_per_version,
+        'max_scan_duration': args.max_scan_duration,
+        'max_recommended_scan_size': int(args.max_scan_size * 1024 ** 3),
+        'top_n': args.top_n,
+        'high_frequency_window': args.high_frequency_window,
+        'max_age_unmapped_scans': args.max_age_unmapped_scans,
+        'similar_name_threshold': args.similar_name_threshold,
+    }
+
+
+def merge_main(argv):
+    parser = argparse.ArgumentParser("sage.py merge", description="Merge the reports of sage.py --shard runs into one report")
+    parser.add_argument('shard_files', nargs='+', help="Reports written by each of the --shard i/N runs")
+    parser.add_argument('-f', "--file", default="/var/log/sage_says.json", help="File to write the merged report into")
+    parser.add_argument("--compress", choices=list(COMPRESSIONS), default=None, help="Compress the merged report")
+    add_analysis_arguments(parser)
+    args = parser.parse_args(argv)
+    if os.path.exists(args.file) and any(os.path.samefile(f, args.file) for f in args.shard_files if os.path.exists(f)):
+        parser.error("the merged report cannot be written over one of the shard reports")
+
+    sage = BlackDuckSage(
+        None,
+        file=args.file,
+        compression=args.compress,
+        **analysis_kwargs(args))
+    sage.merge(args.shard_files)
+
+
+def diff_main(argv):
+    from sage_diff import diff_reports, summarize
+
+    parser = argparse.ArgumentParser("sage.py diff", description="Show which entities and findings changed between two Sage reports")
+    parser.add_argument('old_file', help="Earlier report")
+    parser.add_argument('new_file', help="Later report")
+    parser.add_argument('-f', "--file", default=None, help="Write the full differences as JSON into this file")
+    args = parser.parse_args(argv)
+
+    diff = diff_reports(args.old_file, args.new_file, list(BlackDuckSage.FINDINGS), BlackDuckSage.TOTALS)
+    for total, change in diff['totals'].items():
+        if change['change']:
+            print("{}: {} -> {} ({:+})".format(total, change['old'], change['new'], change['change']))
+    for line in summarize(diff):
+        print(line)
+    if args.file:
+        with open_report(args.file, 'w') as f:
+            write_report(diff, f)
+        logging.info("Wrote differences to %s", args.file)
+
+
+def parse_since(value):
+    '''A number of days ago, or an ISO date or time, as an ISO time'''
+    try:
+        return (datetime.now(timezone.utc) - timedelta(days=float(value))).isoformat()
+    except ValueError:
+        pass
+    try:
+        return BlackDuckSage._parse_timestamp(value).isoformat()
+    except (ValueError, OverflowError):
+        raise argparse.ArgumentTypeError("expected a number of days or a date, e.g. 30 or 2021-06-01")
+
+
+def parse_values(value):
+    '''A comma separated list of numbers, or start:stop:step (stop included)'''
+    try:
+        if ':' in value:
+            start, stop, step = [float(v) for v in value.split(':')]
+            values = [start + i * step for i in range(int((stop - start) / step) + 1)]
+        else:
+            values = [float(v) for v in value.split(',')]
+    except (ValueError, ZeroDivisionError):
+        raise argparse.ArgumentTypeError("expected e.g. 10,20,50 or 10:100:10")
+    return [int(v) if v == int(v) else v for v in values]
+
+
+def sweep_main(argv):
+    import csv
+
+    parser = argparse.ArgumentParser("sage.py sweep", description="Show how many entities, and how much scan size, each value of a threshold would flag")
+    parser.add_argument('report', help="Report, or sage_history.py directory, holding the collected data")
+    parser.add_argument('--snapshot', type=int, default=None, help="Snapshot of a history directory to use (default: the latest)")
+    add_analysis_arguments(parser, sweep=True)
+    args = parser.parse_args(argv)
+
+    sage = BlackDuckSage(None, file=os.devnull)
+    sage.data = load_collected_data(args.report, args.snapshot)
+    thresholds = ('max_versions_per_project', 'max_scans_per_version', 'high_frequency_window')
+    results = sage.sweep({t: getattr(args, t) for t in thresholds})
+    w = csv.writer(sys.stdout)
+    w.writerow(['threshold', 'value', 'flagged', 'scanSize'])
+    for threshold in thresholds:
+        w.writerows([threshold] + list(r) for r in results[threshold])
+
+
+def warn_about_affected_hub_versions(hub):
+    hub_25835_affected_versions = ['2020.8', '2020.10']
+    hub_version_info = BlackDuckSage.get_hub_version_info(hub)
+    for h in hub_25835_affected_versions:
+        if hub_version_info['version'].startswith(h):
+            logging.warning("Scan summaries may be incomplete showing only 1 entry per codelocation (ref. HUB-25835)")
+            logging.warning("Affected Hub versions: %s", hub_25835_affected_versions)
+
+
+LOG_FORMAT = "[%(asctime)s] {%(module)s:%(lineno)d} %(levelname)s: %(message)s"
+
+# sage.py <subcommand> ... runs these instead of analyzing a hub
+SUBCOMMANDS = {
+    'merge': merge_main,
+    'diff': diff_main,
+    'sweep': sweep_main,
+}
+
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=LOG_FORMAT)
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        sys.exit(0)
+
     parser = argparse.ArgumentParser("Sage, a program that looks at your Black Duck server and offers advice on how to get more value")
 
-    parser.add_argument('hub_url', help="Hub server URL e.g. https://example.com")
+    parser.add_argument('hub_url', nargs='?', default=None, help="Hub server URL e.g. https://example.com")
     parser.add_argument('api_token', nargs='?', default=None, help="API access token")
 
     parser.add_argument('--token-file', dest='token_file', default=None, help="File containing access token")
@@ -341,6 +1577,8 @@ if __name__ == "__main__":
 
     parser.add_argument('--timeout', dest='timeout', default=15.0, help="Connection timeout in seconds")
     parser.add_argument('--retries', dest='retries', default=3, help="Maximum number of retries for a single request")
+    add_scheduler_arguments(parser)
+    add_progress_arguments(parser)
 
     parser.add_argument(
         '-f',
@@ -354,6 +1592,59 @@ if __name__ == "__main__":
         action='store_true',
         help="Include this flag if you want to try to collect and analyze jobs info")
 
+    parser.add_argument(
+        '--job-history',
+        dest='job_history',
+        default=None,
+        help="File accumulating job statistics across runs (with -j) so that degrading job throughput can be detected")
+
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help="Keep this OpenMetrics file, e.g. for the node_exporter textfile collector, updated with the report totals, finding counts and how the run went")
+    parser.add_argument('--from-report', dest='from_report', default=None,
+                        help="Re-analyze the data collected in this earlier report, or sage_history.py directory, instead of connecting to a hub")
+    parser.add_argument('--snapshot', dest='snapshot', type=int, default=None,
+                        help="Snapshot of the --from-report history directory to re-analyze (default: the latest)")
+
+    parser.add_argument(
+        '--preflight',
+        action='store_true',
+        help="Only estimate the size of the hub and the time a full collection would take, using a handful of requests, and write the estimate to the output file")
+    scope = parser.add_argument_group('collection scope', "Only collect the projects, versions and codelocations matching all of these")
+    scope.add_argument('--include-projects', dest='include_projects', default=None, metavar='REGEX',
+                       help="Projects whose name matches this regular expression")
+    scope.add_argument('--exclude-projects', dest='exclude_projects', default=None, metavar='REGEX',
+                       help="Projects whose name does not match this regular expression")
+    scope.add_argument('--phases', dest='phases', type=lambda v: v.split(','), default=None,
+                       help="Versions in these phases, e.g. DEVELOPMENT,RELEASED")
+    scope.add_argument('--distributions', dest='distributions', type=lambda v: v.split(','), default=None,
+                       help="Versions with these distributions, e.g. EXTERNAL,SAAS")
+    scope.add_argument('--updated-since', dest='updated_since', type=parse_since, default=None,
+                       help="Projects, and unmapped codelocations, updated since this date or this many days ago")
+    serve = parser.add_argument_group('daemon mode', "Keep the analysis in memory, refresh it on a schedule and answer queries about it over HTTP")
+    serve.add_argument('--serve', dest='serve', type=int, default=None, metavar='PORT',
+                       help="Serve /totals, /findings, /findings/<finding> and /projects/<project ID or name> as JSON on this port after the first analysis")
+    serve.add_argument('--bind', dest='bind', default="127.0.0.1", help="Address to serve on (default: 127.0.0.1)")
+    serve.add_argument('--refresh-interval', dest='refresh_interval', type=float, default=60,
+                       help="Minutes between refreshes, which only fetch the scan summaries of updated codelocations (default: 60, 0 to never refresh)")
+
+    parser.add_argument('--latest-summaries', dest='latest_summaries', type=int, default=None, metavar='N',
+                        help="Only fetch the newest N scan summaries of each codelocation. Codelocations scanned too frequently only further back than those, "
+                             "and not often enough to bring the average interval since they were created below --high-frequency-window, are then not flagged")
+    parser.add_argument('--unmapped-manifest', dest='unmapped_manifest', default=None,
+                        help="Write the IDs of the unmapped scans older than --manifest-min-age days into this file, for delete_versions.py --codelocations")
+    parser.add_argument('--manifest-min-age', dest='manifest_min_age', type=int, default=None,
+                        help="Minimum age in days of the unmapped scans in the manifest (default: --max-unmapped-age)")
+    parser.add_argument('--sample', dest='sample', type=int, default=None,
+                        help="Only collect a random sample of this many projects and codelocations, and estimate the totals and findings for the whole hub from them")
+    parser.add_argument('--confidence', dest='confidence', type=float, default=0.95,
+                        help="Confidence level of the intervals estimated by --sample (default: 0.95)")
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+                        help="Seed of the random samples taken by --sample and --preflight, to make them repeatable")
+    parser.add_argument('--preflight-samples', dest='preflight_samples', type=int, default=5,
+                        help="Number of projects and of codelocations sampled by --preflight (default: 5)")
+    parser.add_argument('--max-runtime', dest='max_runtime', type=float, default=8,
+                        help="Hours a collection should take before --preflight recommends sharding it (default: 8)")
+
     parser.add_argument(
         "-m",
         "--mode",
@@ -362,63 +1653,100 @@ if __name__ == "__main__":
         help="""Set to 'resume' to resume analysis or to 'new' to start new (default).
 Resuming requires a previously saved file is present to read the current state of analysis. 'New' will overwrite the analysis file.""")
 
-    default_max_versions_per_project = 20
+    add_analysis_arguments(parser)
+
+    parser.add_argument(
+        "--csv-dir",
+        dest="csv_dir",
+        default=None,
+        help="Also write normalized CSV tables (projects, versions, codelocations, scan_summaries, findings) into this directory as data is collected")
+
     parser.add_argument(
-        "-vp",
-        "--max_versions_per_project",
-        default=default_max_versions_per_project,
-        type=int,
-        help="Set max_versions_per_project to catch any projects having more than max_versions_per_project (default: {})".format(
-            default_max_versions_per_project))
-
-    default_max_scans_per_version = 10
+        "--compress",
+        choices=list(COMPRESSIONS),
+        default=None,
+        help="Compress the results written to --file (default: by file extension .gz, .xz or .bz2, otherwise uncompressed)")
+
     parser.add_argument(
-        "-sv",
-        "--max_scans_per_version",
-        default=default_max_scans_per_version,
-        type=int,
-        help="Set max_scans to catch any project-versions with more than max_scans (default: {})".format(
-            default_max_scans_per_version))
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Collect only slice i of N (e.g. 0/4) of the projects and codelocations, use 'sage.py merge' to combine the results")
 
     args = parser.parse_args()
+    if args.sample and args.shard:
+        parser.error("--sample and --shard cannot be combined")
+    if args.sample and any([args.include_projects, args.exclude_projects, args.phases, args.distributions, args.updated_since]):
+        # the estimates scale the sample up to the whole listing, not to the part of it in scope
+        parser.error("--sample cannot be combined with the collection scope options")
+    if args.serve is not None and (args.preflight or args.shard or args.csv_dir):
+        parser.error("--serve cannot be combined with --preflight, --shard or --csv-dir")
+    if not args.hub_url and not args.from_report:
+        parser.error("the hub_url is required unless re-analyzing an earlier report with --from-report")
 
     logging.basicConfig(
         level=logging.INFO,
         stream=sys.stdout,
-        format="[%(asctime)s] {%(module)s:%(lineno)d} %(levelname)s: %(message)s"
+        format=LOG_FORMAT
     )
 
-    base_url = args.hub_url
-    verify = False  # TLS certificate verification
-    session = HubSession(base_url, timeout=args.timeout, retries=args.retries, verify=verify)
+    collected = None
+    if args.from_report:
+        if os.path.exists(args.file) and os.path.samefile(args.from_report, args.file):
+            parser.error("--from-report and --file cannot be the same file, the report would be overwritten while it is read")
+        # before BlackDuckSage opens --file
+        collected = load_collected_data(args.from_report, args.snapshot)
 
-    # De-tangle the possibilities of specifying credentials
-    if args.api_token:
-        access_token = args.api_token
-        auth = BearerAuth(session, access_token)
-    elif args.token_file:
-        tf = open(args.token_file, 'r')
-        access_token = tf.readline().strip()
-        auth = BearerAuth(session, access_token)
-    elif args.username and args.password:
-        auth = CookieAuth(session, args.username, args.password)
+    scheduler = RequestScheduler.from_args(args)
+    if args.from_report:
+        hub = None
     else:
-        raise SystemError("Authentication credentials not specified")
-
-    hub = Client(base_url=base_url, session=session, auth=auth)
-
-    hub_25835_affected_versions = ['2020.8', '2020.10']
-    hub_version_info = BlackDuckSage.get_hub_version_info()
-    for h in hub_25835_affected_versions:
-        if hub_version_info['version'].startswith(h):
-            logging.warning("Scan summaries may be incomplete showing only 1 entry per codelocation (ref. HUB-25835)")
-            logging.warning("Affected Hub versions: %s", hub_25835_affected_versions)
+        hub = connect(
+            args.hub_url,
+            api_token=args.api_token,
+            token_file=args.token_file,
+            username=args.username,
+            password=args.password,
+            timeout=args.timeout,
+            retries=args.retries,
+            scheduler=scheduler)
+        warn_about_affected_hub_versions(hub)
 
     sage = BlackDuckSage(
         hub,
         mode=args.mode,
         file=args.file,
-        max_versions_per_project=args.max_versions_per_project,
-        max_scans_per_version=args.max_scans_per_version,
-        analyze_jobs=args.jobs)
-    sage.analyze()
+        progress=Progress.from_args(args),
+        scheduler=scheduler,
+        metrics_file=args.metrics_file,
+        analyze_jobs=args.jobs,
+        job_history=args.job_history,
+        csv_dir=args.csv_dir,
+        compression=args.compress,
+        shard=args.shard,
+        include_projects=args.include_projects,
+        exclude_projects=args.exclude_projects,
+        phases=args.phases,
+        distributions=args.distributions,
+        updated_since=args.updated_since,
+        latest_summaries=args.latest_summaries,
+        unmapped_manifest=args.unmapped_manifest,
+        manifest_min_age=args.manifest_min_age,
+        sample=args.sample,
+        confidence=args.confidence,
+        seed=args.seed,
+        preflight_samples=args.preflight_samples,
+        max_runtime=args.max_runtime,
+        **analysis_kwargs(args))
+    if args.from_report:
+        sage.reanalyze(collected)
+    elif args.preflight:
+        sage.preflight()
+    else:
+        sage.analyze()
+
+    if args.serve is not None:
+        from sage_server import SageServer
+        # a re-analyzed report has no hub to refresh it from
+        refresh_interval = args.refresh_interval * 60 if args.refresh_interval and not args.from_report else None
+        SageServer((args.bind, args.serve), sage, refresh_interval).serve()
@@ -9,12 +9,37 @@ import logging
 import os
 from pprint import pprint
 import re
+from sage_io import open_report
+from sage_tables import read_table
 import sys
 
 loggingLevel = logging.INFO
 logging.basicConfig(stream=sys.stdout, format='%(threadName)s: %(asctime)s: %(levelname)s: %(message)s', level=loggingLevel)
 
 
+COLUMNS = ['codelocationId',
+           'scanSize',
+           'scanSizeReadable',
+           'createdAt',
+           'updatedAt',
+           'summaries',
+           'frequent',
+           'latestSummary',
+           'latestCreatedBy',
+           'latestCreatedAt',
+           'latestUpdatedAt',
+           'latestStatus',
+           'latestScanType',
+           'latestMatchCount',
+           'latestHostName',
+           'latestBaseDirectory',
+           'projectId',
+           'versionId',
+           'project',
+           'version',
+           'codelocation']
+
+
 def sizeof_fmt(num, suffix='B'):
     for unit in ['', 'K', 'M', 'G', 'T', 'P', 'E', 'Z']:
         if abs(num) < 1024.0:
@@ -23,21 +48,78 @@ def sizeof_fmt(num, suffix='B'):
     return "%.2f %s%s" % (num, 'Yi', suffix)
 
 
+def codelocation_rows_from_tables(directory):
+    """Produce the same rows as the JSON path from the normalized tables written by sage.py --csv-dir"""
+    projectDict = {row['projectId']: row['name'] for row in read_table(directory, 'projects')}
+    versionDict = {row['versionId']: row['versionName'] for row in read_table(directory, 'versions')}
+    frequent = {row['entityId'] for row in read_table(directory, 'findings') if row['finding'] == 'high_frequency_scans'}
+
+    latest = {}  # key:codelocationId: (timestamp, summary row)
+    for summary in read_table(directory, 'scan_summaries'):
+        ts = summary['createdAt'] or summary['updatedAt']
+        if not ts:
+            logging.warning("no createdAt or updatedAt in summary %s", summary['summaryId'])
+            continue
+        current = latest.get(summary['codelocationId'])
+        if current is None or ts >= current[0]:
+            latest[summary['codelocationId']] = (ts, summary)
+
+    for codelocation in read_table(directory, 'codelocations'):
+        codelocationId = codelocation['codelocationId']
+        projectId = codelocation['projectId']
+        versionId = codelocation['versionId']
+        project = projectDict.get(projectId, "ERROR: NOT IN PROJECT DICT!") if projectId else ""
+        version = versionDict.get(versionId, "ERROR: NOT IN VERSION DICT!") if versionId else ""
+        ts, summary = latest.get(codelocationId, ("", {}))
+        scanSize = int(codelocation['scanSize'] or 0)
+        yield [codelocationId,
+               scanSize,
+               sizeof_fmt(scanSize),
+               codelocation['createdAt'],
+               codelocation['updatedAt'],
+               int(codelocation['num_summaries']),
+               True if codelocationId in frequent else "",
+               ts,
+               summary.get('createdByUserName', ""),
+               summary.get('createdAt', ""),
+               summary.get('updatedAt', ""),
+               summary.get('status', ""),
+               summary.get('scanType', ""),
+               summary.get('matchCount', ""),
+               summary.get('hostName', ""),
+               summary.get('baseDirectory', ""),
+               projectId,
+               versionId,
+               project,
+               version,
+               codelocation['name']]
+
+
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Extract codelocations to CSV")
 
     group1 = parser.add_argument_group('required arguments')
-    group1.add_argument('--input', dest='json_file_input', required=True, help="File containing Sage output e.g. sage_says.json")
+    inputs = group1.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', dest='json_file_input', help="File containing Sage output e.g. sage_says.json")
+    inputs.add_argument('--tables', dest='tables_dir', help="Directory of CSV tables written by sage.py --csv-dir")
     group1.add_argument('--output', dest='csv_file_output', required=True, help="Output CSV file")
 
     args = parser.parse_args()
 
-    if os.path.exists(args.csv_file_output) and os.path.samefile(args.json_file_input, args.csv_file_output):
+    if args.json_file_input and os.path.exists(args.csv_file_output) and os.path.samefile(args.json_file_input, args.csv_file_output):
         print("Error, input and output file cannot be the same")
         sys.exit(-1)
 
-    with open(args.json_file_input, 'r') as jf:
+    if args.tables_dir:
+        with open(args.csv_file_output, 'w', newline='', encoding='utf-8') as f:
+            w = csv.writer(f)
+            w.writerow(COLUMNS)
+            w.writerows(codelocation_rows_from_tables(args.tables_dir))
+        logging.info("Output written to: %s", args.csv_file_output)
+        sys.exit(0)
+
+    with open_report(args.json_file_input) as jf:
         logging.info("Loading data from %s...", args.json_file_input)
         sageJson = json.load(jf)
         logging.info("Loaded data for %i codelocations across %i projects", len(sageJson['scans']), len(sageJson['projects']))
@@ -64,28 +146,7 @@ if __name__ == '__main__':
 
     # Future enhancement: add more detail about too frequent scanning
 
-    columns = ['codelocationId',
-               'scanSize',
-               'scanSizeReadable',
-               'createdAt',
-               'updatedAt',
-               'summaries',
-               'frequent',
-               'latestSummary',
-               'latestCreatedBy',
-               'latestCreatedAt',
-               'latestUpdatedAt',
-               'latestStatus',
-               'latestScanType',
-               'latestMatchCount',
-               'latestHostName',
-               'latestBaseDirectory',
-               'projectId',
-               'versionId',
-               'project',
-               'version',
-               'codelocation']
-    w.writerow(columns)
+    w.writerow(COLUMNS)
 
     i = 0
     for codelocation in sageJson['scans']:
@@ -109,7 +170,7 @@ if __name__ == '__main__':
             else:
                 logging.warning("index %i versionId %s not found in versionDict", i, versionId)
                 version = "ERROR: NOT IN VERSION DICT!"
-        num_summaries = len(codelocation['scan_summaries'])
+        num_summaries = codelocation.get('num_scan_summaries', len(codelocation['scan_summaries']))
 
         latest_summary_timestamp = ""
         latest_summary_createdAt = ""
@@ -0,0 +1,92 @@
+# sage_diff.py
+#
+# Entity and finding level differences between two Sage reports, used by 'sage.py diff'.
+
+import json
+import zlib
+
+from sage_io import ENTITY_KINDS, entity_records, last_id, stream_report
+
+
+def _fingerprint(record):
+    """crc32 of each attribute, which is enough to tell whether, and which, attributes changed"""
+    return {k: zlib.crc32(json.dumps(v, sort_keys=True).encode('utf-8')) for k, v in record.items()}
+
+
+def _name(record):
+    return record.get('name', record.get('versionName'))
+
+
+def _index_report(path, findings, totals, on_entity):
+    """Stream a report calling on_entity(kind, id, record) for every entity, return its
+    (metadata, totals, {finding: set of entity ids})"""
+    metadata = {}
+    report_totals = {}
+    finding_ids = {f: set() for f in findings}
+    for key, value in stream_report(path):
+        if key in ('projects', 'scans'):
+            for item in value:
+                for kind, entity_id, record in entity_records(key, item):
+                    on_entity(kind, entity_id, record)
+        elif key in finding_ids:
+            finding_ids[key].update(last_id(e['url']) for e in value)
+        elif key in totals:
+            report_totals[key] = value
+        elif key in ('time_of_analysis', 'hub_url', 'sage_version'):
+            metadata[key] = value
+    return metadata, report_totals, finding_ids
+
+
+def diff_reports(old_path, new_path, findings, totals):
+    """Compare two reports in time linear in their size.
+
+    The old report is streamed into a hash index of entity id -> (name, attribute checksums)
+    and the new one is streamed past it, so neither report is ever loaded as a whole.
+    """
+    old_index = {kind: {} for kind in ENTITY_KINDS}
+
+    def index_old(kind, entity_id, record):
+        old_index[kind][entity_id] = (_name(record), _fingerprint(record))
+
+    old_metadata, old_totals, old_findings = _index_report(old_path, findings, totals, index_old)
+
+    entities = {kind: {'added': [], 'removed': [], 'changed': []} for kind in ENTITY_KINDS}
+
+    def compare_new(kind, entity_id, record):
+        old = old_index[kind].pop(entity_id, None)
+        if old is None:
+            entities[kind]['added'].append({'id': entity_id, 'name': _name(record)})
+            return
+        old_fingerprint = old[1]
+        new_fingerprint = _fingerprint(record)
+        fields = sorted(k for k in set(old_fingerprint) | set(new_fingerprint) if old_fingerprint.get(k) != new_fingerprint.get(k))
+        if fields:
+            entities[kind]['changed'].append({'id': entity_id, 'name': _name(record), 'fields': fields})
+
+    new_metadata, new_totals, new_findings = _index_report(new_path, findings, totals, compare_new)
+
+    # whatever was not matched by the new report has gone
+    for kind, remaining in old_index.items():
+        entities[kind]['removed'] = [{'id': entity_id, 'name': name} for entity_id, (name, _) in remaining.items()]
+
+    return {
+        'old': dict(old_metadata, file=old_path),
+        'new': dict(new_metadata, file=new_path),
+        'totals': {t: {'old': old_totals.get(t), 'new': new_totals.get(t),
+                       'change': (new_totals.get(t) or 0) - (old_totals.get(t) or 0)} for t in totals},
+        'entities': entities,
+        'findings': {f: {'new': sorted(new_findings[f] - old_findings[f]),
+                         'resolved': sorted(old_findings[f] - new_findings[f])} for f in findings},
+    }
+
+
+def summarize(diff):
+    """One line per entity kind and finding with the number of changes"""
+    lines = []
+    for kind, changes in diff['entities'].items():
+        lines.append("{}: {} added, {} removed, {} changed".format(
+            kind, len(changes['added']), len(changes['removed']), len(changes['changed'])))
+    for finding, changes in diff['findings'].items():
+        if changes['new'] or changes['resolved']:
+            lines.append("{}: {} new, {} resolved".format(finding, len(changes['new']), len(changes['resolved'])))
+    return lines
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+
+# sage_fleet.py
+#
+# Run Sage against several Black Duck servers in parallel worker processes and merge the
+# per-hub reports into one cross-hub summary.
+
+import argparse
+from datetime import datetime
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+from sage import BlackDuckSage, connect, warn_about_affected_hub_versions
+from sage_io import load_report, open_report
+from sage_scheduler import RequestScheduler
+
+EXAMPLE_CONFIG = """Example configuration,
+{
+    "max_workers": 4,
+    "output_dir": "/var/log/sage",
+    "hubs": [
+        {"name": "emea", "url": "https://emea.example.com", "token_file": "~/.bd_tokens/emea"},
+        {"name": "apac", "url": "https://apac.example.com", "username": "sysadmin", "password": "...",
+         "timeout": 30, "retries": 5, "rps": 5, "target_latency": 2.0, "jobs": true,
+         "options": {"max_versions_per_project": 50}}
+    ]
+}
+Each hub's report is written to <output_dir>/<name>.json unless the hub has its own "file".
+"rps", "max_in_flight" and "target_latency" set the request budget for a hub (see sage.py -h).
+"jobs": true also collects and analyzes the hub's job statistics, like sage.py -j."""
+
+
+def load_config(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    output_dir = config.get('output_dir', '.')
+    names = set()
+    for hub_config in config['hubs']:
+        if 'name' not in hub_config or 'url' not in hub_config:
+            raise ValueError("Every hub needs a 'name' and a 'url': {}".format(hub_config))
+        if hub_config['name'] in names:
+            raise ValueError("Duplicate hub name {}".format(hub_config['name']))
+        names.add(hub_config['name'])
+        if hub_config.get('token_file'):
+            hub_config['token_file'] = os.path.expanduser(hub_config['token_file'])
+        hub_config.setdefault('file', os.path.join(output_dir, hub_config['name'] + ".json"))
+    return config
+
+
+def analyze_hub(hub_config):
+    """Worker process entry point, returns (hub name, report file, error message or None)"""
+    multiprocessing.current_process().name = hub_config['name']
+    start_time = datetime.now()
+    try:
+        hub = connect(
+            hub_config['url'],
+            api_token=hub_config.get('api_token'),
+            token_file=hub_config.get('token_file'),
+            username=hub_config.get('username'),
+            password=hub_config.get('password'),
+            timeout=hub_config.get('timeout', 15.0),
+            retries=hub_config.get('retries', 3),
+            scheduler=RequestScheduler(
+                rps=hub_config.get('rps'),
+                max_in_flight=hub_config.get('max_in_flight'),
+                target_latency=hub_config.get('target_latency')))
+        warn_about_affected_hub_versions(hub)
+        options = dict(hub_config.get('options', {}))
+        # job statistics are only collected when asked for, as with sage.py -j
+        options.setdefault('analyze_jobs', hub_config.get('jobs', False))
+        sage = BlackDuckSage(hub, file=hub_config['file'], **options)
+        sage.analyze()
+        error = None
+    except Exception as e:
+        logging.exception("Analysis of %s failed", hub_config['url'])
+        error = "{}: {}".format(type(e).__name__, e)
+    logging.info("Finished %s in %s", hub_config['name'], datetime.now() - start_time)
+    return (hub_config['name'], hub_config['file'], error)
+
+
+def _finding_record(hub_name, entity, message_key):
+    record = {'hub': hub_name, 'url': entity.get('url'), 'message': entity.get(message_key)}
+    for attr in ('project_name', 'name', 'versionName', 'scanSize'):
+        if attr in entity:
+            record[attr] = entity[attr]
+    return record
+
+
+def merge_reports(results):
+    """Combine per-hub reports into totals and findings, reading one report at a time.
+
+    Only the hub totals and a compact record per finding are kept, so memory use is bounded by
+    the largest single report rather than by the size of the fleet.
+    """
+    summary = {
+        'time_of_analysis': datetime.now().isoformat(),
+        'sage_version': BlackDuckSage.VERSION,
+        'totals': {t: 0 for t in BlackDuckSage.TOTALS},
+        'hubs': {},
+        'findings': {f: [] for f in BlackDuckSage.FINDINGS},
+    }
+    for hub_name, report_file, error in results:
+        if error:
+            summary['hubs'][hub_name] = {'error': error}
+            continue
+        report = load_report(report_file)
+        hub_summary = {
+            'hub_url': report.get('hub_url'),
+            'hub_version': report.get('hub_version', {}).get('version'),
+            'report': report_file,
+        }
+        for total in BlackDuckSage.TOTALS:
+            hub_summary[total] = report.get(total, 0)
+            summary['totals'][total] += hub_summary[total]
+        for finding, (entity_type, message_key) in BlackDuckSage.FINDINGS.items():
+            entities = report.get(finding, [])
+            hub_summary[finding] = len(entities)
+            summary['findings'][finding].extend(_finding_record(hub_name, e, message_key) for e in entities)
+        summary['hubs'][hub_name] = hub_summary
+        del report
+    summary['totals'].update({f: len(entities) for f, entities in summary['findings'].items()})
+    return summary
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Run Sage against a fleet of Black Duck servers",
+        epilog=EXAMPLE_CONFIG,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('config', help="JSON file listing the hubs to analyze and their credentials")
+    parser.add_argument('--max-workers', dest='max_workers', type=int, default=None,
+                        help="Maximum number of hubs analyzed at the same time (overrides max_workers in the config, default: 4)")
+    parser.add_argument('-f', '--file', dest='file', default="sage_fleet_says.json",
+                        help="File to write the merged cross-hub summary into (default: sage_fleet_says.json)")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stdout,
+        format="[%(asctime)s] %(processName)s {%(module)s:%(lineno)d} %(levelname)s: %(message)s"
+    )
+
+    config = load_config(args.config)
+    max_workers = args.max_workers or config.get('max_workers', 4)
+    hubs = config['hubs']
+    logging.info("Analyzing %i hubs using up to %i worker processes", len(hubs), max_workers)
+
+    start_time = datetime.now()
+    # maxtasksperchild=1 so every hub starts from a fresh process and its memory is released when done
+    with multiprocessing.Pool(processes=min(max_workers, len(hubs)), maxtasksperchild=1) as pool:
+        results = list(pool.imap_unordered(analyze_hub, hubs))
+
+    for hub_name, report_file, error in results:
+        if error:
+            logging.error("%s failed: %s", hub_name, error)
+
+    summary = merge_reports(sorted(results))
+    summary['elapsed_time'] = str(datetime.now() - start_time)
+    with open_report(args.file, 'w') as f:
+        json.dump(summary, f)
+    logging.info("Wrote cross-hub summary for %i hubs to %s", len(hubs), args.file)
+
+    sys.exit(1 if any(error for _, _, error in results) else 0)
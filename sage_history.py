@@ -0,0 +1,193 @@
+#!/usr/bin/python
+
+# sage_history.py
+#
+# Keep a history of Sage reports as deltas against the previous run, with periodic full
+# checkpoints, and answer trend queries from it.
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+
+from sage import BlackDuckSage
+from sage_io import ENTITY_KINDS, compression_for, iter_entities, load_report, open_report
+
+
+def _digest(record):
+    return hashlib.blake2b(json.dumps(record, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+
+
+class SnapshotStore(object):
+    """A directory holding one snapshot per recorded report.
+
+    index.json lists the snapshots with their report totals and finding counts, so trends in
+    those are answered from the index alone. Each snapshot keeps one file per entity kind
+    (projects, versions, codelocations) holding either every entity (a checkpoint) or only the
+    entities added, removed or changed since the previous snapshot (a delta), so per-entity
+    trends only read the files of the kind they are about. digests.<kind>.json holds a short
+    hash of every entity in the latest snapshot, which is all that is needed to compute the
+    next delta.
+    """
+
+    def __init__(self, path, checkpoint_every=7):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.index_file = os.path.join(path, "index.json")
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.index = json.load(f)
+        else:
+            self.index = {'checkpoint_every': checkpoint_every, 'snapshots': []}
+
+    def _file(self, seq, snapshot_type, kind):
+        return os.path.join(self.path, "{:06d}.{}.{}.json.gz".format(seq, snapshot_type, kind))
+
+    def _digests_file(self, kind):
+        return os.path.join(self.path, "digests.{}.json".format(kind))
+
+    def _write_json(self, path, obj):
+        # write then rename so an interrupted run never leaves a truncated file behind
+        with open_report(path + ".tmp", 'w', compression_for(path)) as f:
+            json.dump(obj, f)
+        os.replace(path + ".tmp", path)
+
+    def record(self, report):
+        """Add a report to the history, returning its snapshot entry"""
+        snapshots = self.index['snapshots']
+        seq = len(snapshots)
+        checkpoint = seq % self.index['checkpoint_every'] == 0
+        snapshot_type = "full" if checkpoint else "delta"
+
+        entities = {kind: {} for kind in ENTITY_KINDS}
+        for kind, entity_id, record in iter_entities(report):
+            entities[kind][entity_id] = record
+
+        changes = {}
+        for kind in ENTITY_KINDS:
+            previous = {}
+            if seq > 0 and os.path.exists(self._digests_file(kind)):
+                with open(self._digests_file(kind), 'r') as f:
+                    previous = json.load(f)
+            digests = {entity_id: _digest(record) for entity_id, record in entities[kind].items()}
+            added = {i: r for i, r in entities[kind].items() if i not in previous}
+            changed = {i: r for i, r in entities[kind].items() if i in previous and previous[i] != digests[i]}
+            removed = [i for i in previous if i not in digests]
+            changes[kind] = {'added': len(added), 'changed': len(changed), 'removed': len(removed)}
+            if checkpoint:
+                self._write_json(self._file(seq, snapshot_type, kind), entities[kind])
+            else:
+                self._write_json(self._file(seq, snapshot_type, kind), {'added': added, 'changed': changed, 'removed': removed})
+            self._write_json(self._digests_file(kind), digests)
+
+        metrics = {m: report.get(m, 0) for m in BlackDuckSage.TOTALS}
+        metrics.update({f: len(report.get(f, [])) for f in BlackDuckSage.FINDINGS})
+        entry = {
+            'seq': seq,
+            'type': snapshot_type,
+            'time_of_analysis': report.get('time_of_analysis'),
+            'hub_url': report.get('hub_url'),
+            'sage_version': report.get('sage_version'),
+            'metrics': metrics,
+            'changes': changes,
+        }
+        snapshots.append(entry)
+        self._write_json(self.index_file, self.index)
+        logging.info("Recorded snapshot %i (%s): %s", seq, snapshot_type, changes)
+        return entry
+
+    def trend(self, metrics):
+        """(time_of_analysis, [value of each metric]) for every snapshot, read from the index only"""
+        return [(s['time_of_analysis'], [s['metrics'].get(m) for m in metrics]) for s in self.index['snapshots']]
+
+    def replay(self, kind, until=None):
+        """Yield (snapshot entry, {id: record}) for each snapshot, applying the deltas to the nearest
+        preceding checkpoint. Given until, replay starts at the last checkpoint at or before
+        snapshot until and stops there, so only the files since that checkpoint are read, and only
+        those of the given kind.
+        """
+        snapshots = self.index['snapshots']
+        if until is not None:
+            start = max([s['seq'] for s in snapshots[:until + 1] if s['type'] == "full"], default=0)
+            snapshots = snapshots[start:until + 1]
+        state = {}
+        for entry in snapshots:
+            with open_report(self._file(entry['seq'], entry['type'], kind)) as f:
+                stored = json.load(f)
+            if entry['type'] == "full":
+                state = stored
+            else:
+                for entity_id in stored['removed']:
+                    state.pop(entity_id, None)
+                state.update(stored['added'])
+                state.update(stored['changed'])
+            yield entry, state
+
+    def entity_trend(self, kind, attribute, name=None):
+        """(time_of_analysis, id, name, value of attribute) of every entity, or only those named name, per snapshot"""
+        for entry, state in self.replay(kind):
+            for entity_id, record in state.items():
+                entity_name = record.get('name', record.get('versionName'))
+                if name is None or name in (entity_name, entity_id):
+                    yield (entry['time_of_analysis'], entity_id, entity_name, record.get(attribute))
+
+    def load(self, seq=None):
+        """The {kind: {id: record}} entities of snapshot seq, by default the latest one"""
+        if seq is None:
+            seq = len(self.index['snapshots']) - 1
+        if not 0 <= seq < len(self.index['snapshots']):
+            raise ValueError("No snapshot {} in {}".format(seq, self.path))
+        entities = {}
+        for kind in ENTITY_KINDS:
+            for entry, state in self.replay(kind, until=seq):
+                pass
+            entities[kind] = state
+        return entities
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record Sage reports in a delta-encoded history and query trends over it")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    record_parser = subparsers.add_parser('record', help="Add a Sage report to the history")
+    record_parser.add_argument('store', help="History directory")
+    record_parser.add_argument('report', help="Sage report, e.g. sage_says.json")
+    record_parser.add_argument('--checkpoint-every', dest='checkpoint_every', type=int, default=7,
+                               help="Store a full checkpoint every N snapshots when creating a new history (default: 7)")
+
+    trend_parser = subparsers.add_parser('trend', help="Report totals and finding counts over time as CSV")
+    trend_parser.add_argument('store', help="History directory")
+    trend_parser.add_argument('metrics', nargs='*', default=['total_scan_size', 'total_unmapped_scans'],
+                              help="Metrics to report (default: total_scan_size total_unmapped_scans)")
+
+    entity_parser = subparsers.add_parser('entity', help="Report an attribute of projects, versions or codelocations over time as CSV")
+    entity_parser.add_argument('store', help="History directory")
+    entity_parser.add_argument('--kind', choices=ENTITY_KINDS, default='projects')
+    entity_parser.add_argument('--attribute', default='num_versions', help="Attribute to report (default: num_versions)")
+    entity_parser.add_argument('--name', default=None, help="Only report the entity with this name or ID")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stderr,
+        format="[%(asctime)s] {%(module)s:%(lineno)d} %(levelname)s: %(message)s"
+    )
+
+    w = csv.writer(sys.stdout)
+    if args.command == 'record':
+        store = SnapshotStore(args.store, checkpoint_every=args.checkpoint_every)
+        store.record(load_report(args.report))
+    elif args.command == 'trend':
+        store = SnapshotStore(args.store)
+        w.writerow(['time_of_analysis'] + args.metrics)
+        for time_of_analysis, values in store.trend(args.metrics):
+            w.writerow([time_of_analysis] + values)
+    elif args.command == 'entity':
+        store = SnapshotStore(args.store)
+        w.writerow(['time_of_analysis', 'id', 'name', args.attribute])
+        w.writerows(store.entity_trend(args.kind, args.attribute, args.name))
@@ -0,0 +1,212 @@
+# sage_io.py
+#
+# Reading and writing Sage reports, optionally compressed with gzip, xz or bz2.
+
+import bz2
+import gzip
+import json
+import lzma
+import os
+
+COMPRESSIONS = {
+    'gzip': ('.gz', gzip.open, b'\x1f\x8b'),
+    'xz': ('.xz', lzma.open, b'\xfd7zXZ\x00'),
+    'bz2': ('.bz2', bz2.open, b'BZh'),
+}
+
+
+def compression_for(path):
+    """Name of the compression implied by the file extension, None for a plain file"""
+    for name, (extension, _, _) in COMPRESSIONS.items():
+        if str(path).endswith(extension):
+            return name
+    return None
+
+
+def _sniff(path):
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for name, (_, _, magic) in COMPRESSIONS.items():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def open_report(path, mode='r', compression=None):
+    """Open a report for reading or writing text, (de)compressing as needed.
+
+    When writing, compression is taken from the argument or else the file extension. When
+    reading, it is detected from the file contents so a compressed report is read correctly
+    whatever it is called.
+    """
+    if 'r' in mode:
+        compression = _sniff(path) if os.path.exists(path) else compression_for(path)
+    else:
+        compression = compression or compression_for(path)
+    mode = mode.replace('b', '').replace('t', '') + 't'
+    if compression:
+        return COMPRESSIONS[compression][1](path, mode, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def load_report(path):
+    with open_report(path) as f:
+        return json.load(f)
+
+
+def write_report(data, f):
+    """Write data as one JSON object, serializing a top level key, or a list element, at a time.
+
+    This keeps the whole encoded report from being built up in memory while still using the
+    C accelerated encoder of json.dumps, which json.dump does not use.
+    """
+    f.write('{')
+    for n, (key, value) in enumerate(data.items()):
+        f.write(', ' if n else '')
+        f.write(json.dumps(key))
+        f.write(': ')
+        if isinstance(value, list):
+            f.write('[')
+            for i, item in enumerate(value):
+                f.write(', ' if i else '')
+                f.write(json.dumps(item))
+            f.write(']')
+        else:
+            f.write(json.dumps(value))
+    f.write('}')
+
+
+ENTITY_KINDS = ('projects', 'versions', 'codelocations')
+
+
+def last_id(url):
+    return url.rstrip('/').rsplit('/', 1)[-1]
+
+
+def entity_records(key, item):
+    """Flatten one element of a report's 'projects' or 'scans' list into (kind, id, record) tuples.
+
+    Versions are split out of their project and the codelocations listed under each version are
+    dropped in favour of the hub-wide 'scans' list, so every entity appears exactly once.
+    """
+    if key == 'projects':
+        project = {k: v for k, v in item.items() if k != 'versions'}
+        yield ('projects', last_id(item['url']), project)
+        for version in item.get('versions', []):
+            yield ('versions', last_id(version['url']), {k: v for k, v in version.items() if k != 'scans'})
+    elif key == 'scans':
+        yield ('codelocations', last_id(item['url']), item)
+
+
+def iter_entities(report):
+    for key in ('projects', 'scans'):
+        for item in report.get(key, []):
+            for record in entity_records(key, item):
+                yield record
+
+
+def report_from_entities(entities):
+    """Rebuild a report's 'projects' and 'scans' from {kind: {id: record}}, the inverse of entity_records"""
+    versions = {}
+    for version in entities['versions'].values():
+        versions.setdefault(version['url'].split('/versions/')[0], []).append(dict(version, scans=[]))
+    mapped = {}
+    for version_list in versions.values():
+        for version in version_list:
+            mapped[version['url']] = version
+    for codelocation in entities['codelocations'].values():
+        version = mapped.get(codelocation.get('mappedProjectVersion'))
+        if version is not None:
+            version['scans'].append({k: v for k, v in codelocation.items() if k != 'scan_summaries'})
+            version['scans'][-1].update(version_name=version.get('versionName'), project_name=version.get('project_name'))
+    projects = [dict(project, versions=versions.get(project['url'], [])) for project in entities['projects'].values()]
+    return {'projects': projects, 'scans': list(entities['codelocations'].values())}
+
+
+class _StreamReader(object):
+    """Pull JSON values one at a time out of a text stream, reading only as much as needed"""
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size):
+        data = self.f.read(size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+    def peek(self):
+        """Skip whitespace and return the next character, '' at the end of the stream"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill(self.chunk_size)
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError("Expected '{}' in report but found '{}'".format(char, self.peek()))
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a value ending exactly at the end of the buffer, e.g. a number, may continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # grow geometrically so a very large value is only re-parsed a logarithmic number of times
+            self._fill(max(self.chunk_size, len(self.buf)))
+
+
+def stream_report(path):
+    """Iterate over the (key, value) pairs of a report without loading it all into memory.
+
+    A list value is given as an iterator over its elements, which has to be consumed before
+    moving on to the next key (anything left unconsumed is skipped), much like itertools.groupby.
+    """
+    with open_report(path) as f:
+        reader = _StreamReader(f)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if reader.peek() == '[':
+                reader.pos += 1
+                items = _stream_list(reader)
+                yield key, items
+                for _ in items:
+                    pass
+            else:
+                yield key, reader.value()
+            if reader.peek() == '}':
+                return
+            reader.expect(',')
+
+
+def _stream_list(reader):
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.peek() == ']':
+            reader.pos += 1
+            return
+        reader.expect(',')
@@ -0,0 +1,117 @@
+#!/usr/bin/python
+
+# sage_metrics.py
+#
+# Export the totals and finding counts of a Sage report, and how the Sage run itself went, as an
+# OpenMetrics text file for the node_exporter textfile collector (or anything else that scrapes
+# the Prometheus text format).
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from sage_io import stream_report
+
+UNITS = {'total_scan_size': '_bytes'}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items())) + "}"
+
+
+class MetricsFile(object):
+    """Metric families rendered into a text file, which is rewritten atomically on every write()
+    so that a scrape never sees a half written file and the metrics can be updated as a run
+    progresses.
+    """
+
+    def __init__(self, path, labels=None):
+        self.path = path
+        self.labels = labels or {}
+        self.families = {}  # name -> (type, help, {label items: value}), in the order first set
+
+    def set(self, name, value, help_text, labels=None, metric_type='gauge'):
+        samples = self.families.setdefault(name, (metric_type, help_text, {}))[2]
+        samples[tuple(sorted((labels or {}).items()))] = value
+
+    def render(self):
+        lines = []
+        for name, (metric_type, help_text, samples) in self.families.items():
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, metric_type))
+            for labels, value in samples.items():
+                lines.append("{}{} {}".format(name, _labels(dict(self.labels, **dict(labels))), value))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        with open(self.path + ".tmp", 'w') as f:
+            f.write(self.render())
+        os.replace(self.path + ".tmp", self.path)
+
+
+def set_report_metrics(metrics, totals, finding_counts):
+    """totals: {total name: value}, finding_counts: {finding: number of entities}"""
+    for total, value in totals.items():
+        metrics.set("sage_{}{}".format(total, UNITS.get(total, "")), value, "Sage report {}".format(total.replace('_', ' ')))
+    for finding, count in finding_counts.items():
+        metrics.set("sage_findings", count, "Number of entities with each Sage finding", {'finding': finding})
+
+
+def set_run_metrics(metrics, phase, started, scheduler_stats=None, finished=False):
+    """How long the run has taken so far and, given the RequestScheduler's stats, the requests it made"""
+    metrics.set("sage_run_duration_seconds", round(time.monotonic() - started, 3),
+                "Time taken by each phase of the last Sage run, and by the run as a whole", {'phase': phase})
+    if scheduler_stats:
+        metrics.set("sage_run_requests", scheduler_stats['requests'], "Requests made to the Hub by the last Sage run")
+        metrics.set("sage_run_request_errors", scheduler_stats['errors'], "Failed requests, including 4xx and 5xx responses")
+        metrics.set("sage_run_throttled_requests", scheduler_stats['throttled'], "Requests the Hub answered with 429 or 503")
+        metrics.set("sage_run_request_seconds", round(scheduler_stats['request_seconds'], 3), "Time spent waiting on Hub responses")
+    metrics.set("sage_run_in_progress", 0 if finished else 1, "1 while a Sage run is collecting or analyzing data")
+    if finished:
+        metrics.set("sage_run_last_success_timestamp_seconds", round(time.time(), 3), "When the last Sage run completed")
+
+
+def report_metrics(path, totals, findings):
+    """Read the totals and finding counts of a report, streaming it so it's never loaded whole"""
+    report_totals = {}
+    finding_counts = {}
+    labels = {}
+    for key, value in stream_report(path):
+        if key in findings:
+            finding_counts[key] = sum(1 for _ in value)
+        elif key in totals:
+            report_totals[key] = value
+        elif key == 'hub_url':
+            labels['hub'] = value
+    return report_totals, finding_counts, labels
+
+
+# -----------------------------------------------------------------------------
+if __name__ == '__main__':
+    from sage import BlackDuckSage
+
+    parser = argparse.ArgumentParser(description="Write the totals and finding counts of a Sage report as OpenMetrics")
+    parser.add_argument('report', help="Sage report, e.g. sage_says.json")
+    parser.add_argument('-o', '--output', required=True, help="Metrics file, e.g. /var/lib/node_exporter/textfile/sage.prom")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stderr,
+        format="[%(asctime)s] {%(module)s:%(lineno)d} %(levelname)s: %(message)s"
+    )
+
+    totals, finding_counts, labels = report_metrics(args.report, BlackDuckSage.TOTALS, BlackDuckSage.FINDINGS)
+    metrics = MetricsFile(args.output, labels)
+    set_report_metrics(metrics, totals, finding_counts)
+    metrics.write()
+    logging.info("Wrote %i totals and %i finding counts to %s", len(totals), len(finding_counts), args.output)
@@ -0,0 +1,113 @@
+# sage_progress.py
+#
+# Progress reporting for the Sage tools: counts, rates and an ETA logged at a fixed interval, and
+# optionally written to a JSON file for monitoring, rather than a line of output per entity.
+
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+import threading
+import time
+
+
+def add_progress_arguments(parser):
+    group = parser.add_argument_group('progress reporting')
+    group.add_argument('--progress-interval', dest='progress_interval', type=float, default=10.0,
+                       help="Seconds between progress updates (default: 10)")
+    group.add_argument('--progress-file', dest='progress_file', default=None,
+                       help="Also write the latest progress, as JSON, to this file at every update")
+    group.add_argument('-q', '--quiet', dest='quiet', action='store_true',
+                       help="Don't log progress updates (the progress file, if any, is still written)")
+
+
+class Progress(object):
+    """Track the progress of named stages, e.g. 'projects' or 'codelocations'.
+
+    update() only counts, so it is cheap enough to call for every entity. At most once per
+    interval the counts, rates and, for stages whose total is known, the estimated time to
+    completion are logged on a single line and written to the progress file.
+    """
+
+    def __init__(self, interval=10.0, progress_file=None, quiet=False):
+        self.interval = interval
+        self.progress_file = progress_file
+        self.quiet = quiet
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.current = None
+        self.started = time.monotonic()
+        self.last_report = self.started
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(interval=args.progress_interval, progress_file=args.progress_file, quiet=args.quiet)
+
+    def start(self, stage, total=None):
+        with self.lock:
+            self.stages[stage] = {'done': 0, 'total': total, 'counts': {}, 'started': time.monotonic(), 'finished': None}
+            self.current = stage
+
+    def update(self, stage, n=1, **counts):
+        """Record n more entities done in stage, and add counts to the stage's other counters"""
+        with self.lock:
+            s = self.stages[stage]
+            s['done'] += n
+            for name, count in counts.items():
+                s['counts'][name] = s['counts'].get(name, 0) + count
+            now = time.monotonic()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            self._report(now)
+
+    def finish(self, stage):
+        with self.lock:
+            now = time.monotonic()
+            self.stages[stage]['finished'] = now
+            self.last_report = now
+            self._report(now, stage)
+
+    def status(self, now=None):
+        """The progress of every stage as a JSON serializable dict"""
+        now = now or time.monotonic()
+        stages = {}
+        for name, s in self.stages.items():
+            elapsed = (s['finished'] or now) - s['started']
+            rate = s['done'] / elapsed if elapsed > 0 else None
+            stage = {'done': s['done'], 'total': s['total'], 'elapsed_seconds': round(elapsed, 1),
+                     'rate': rate, 'counts': dict(s['counts']), 'finished': s['finished'] is not None}
+            if s['total'] is not None and not stage['finished'] and rate:
+                stage['eta_seconds'] = round(max(0, s['total'] - s['done']) / rate, 1)
+            stages[name] = stage
+        return {'time': datetime.now().isoformat(), 'elapsed_seconds': round(now - self.started, 1),
+                'current_stage': self.current, 'stages': stages}
+
+    @staticmethod
+    def _describe(name, stage):
+        if stage['total'] is not None:
+            text = "{} {}/{}".format(name, stage['done'], stage['total'])
+            if stage['total']:
+                text += " ({:.1%})".format(stage['done'] / stage['total'])
+        else:
+            text = "{} {}".format(name, stage['done'])
+        if stage['rate'] is not None:
+            text += ", {:.1f}/s".format(stage['rate'])
+        if 'eta_seconds' in stage:
+            text += ", ETA {}".format(timedelta(seconds=round(stage['eta_seconds'])))
+        elif stage['finished']:
+            text += " done in {}".format(timedelta(seconds=round(stage['elapsed_seconds'])))
+        for counter, count in stage['counts'].items():
+            text += ", {} {}".format(count, counter)
+        return text
+
+    def _report(self, now, stage=None):
+        status = self.status(now)
+        if not self.quiet:
+            name = stage or self.current
+            logging.info("Progress: %s", self._describe(name, status['stages'][name]))
+        if self.progress_file:
+            # write then rename so a monitor never reads a partially written file
+            with open(self.progress_file + ".tmp", 'w') as f:
+                json.dump(status, f)
+            os.replace(self.progress_file + ".tmp", self.progress_file)
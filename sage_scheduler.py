@@ -0,0 +1,160 @@
+# sage_scheduler.py
+#
+# A request scheduler that all the Sage tools install on their Hub session to keep the load they
+# put on a production server within a budget.
+
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+import logging
+import threading
+import time
+
+THROTTLE_STATUS_CODES = (429, 503)
+
+
+def add_scheduler_arguments(parser, default_rps=None):
+    group = parser.add_argument_group('request budget')
+    group.add_argument('--rps', dest='rps', type=float, default=default_rps,
+                       help="Maximum number of requests per second sent to the Hub (default: {})".format(default_rps or "no limit"))
+    group.add_argument('--max-in-flight', dest='max_in_flight', type=int, default=None,
+                       help="Maximum number of requests waiting on the Hub at any time (default: no limit)")
+    group.add_argument('--target-latency', dest='target_latency', type=float, default=None,
+                       help="Slow down when Hub response times rise above this many seconds and speed up again when they recover")
+
+
+def _retry_after(response):
+    """Seconds to wait according to the Retry-After header, None if absent or unreadable"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RequestScheduler(object):
+    """Enforce a requests-per-second (token bucket) and max-in-flight budget across all threads.
+
+    A 429 or 503 response pauses every request, not just the one that got it, for the time given
+    by its Retry-After header (or an exponential backoff) before the request is retried. With a
+    target latency the rate adapts: it is cut by 30% when the smoothed response time goes above
+    the target and grows again, up to the configured rps, while it stays well below it. After a
+    cut the rate is left alone for COOLDOWN_RESPONSES responses so that the smoothed response
+    time can reflect it, rather than one burst of slow responses cutting it all the way down.
+    """
+    # used as the starting point when adapting to latency without an rps ceiling
+    INITIAL_ADAPTIVE_RATE = 10.0
+    MIN_RATE = 0.5
+    COOLDOWN_RESPONSES = 10
+
+    def __init__(self, rps=None, max_in_flight=None, target_latency=None, max_retries=5):
+        self.max_rate = rps
+        self.rate = rps or (self.INITIAL_ADAPTIVE_RATE if target_latency else None)
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.lock = threading.Lock()
+        self.tokens = 1.0
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.latency = None  # exponentially weighted moving average, in seconds
+        self.since_slow_down = self.COOLDOWN_RESPONSES  # responses observed since the rate was last cut
+        self.stats = {'requests': 0, 'errors': 0, 'throttled': 0, 'request_seconds': 0.0}
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(rps=args.rps, max_in_flight=args.max_in_flight, target_latency=args.target_latency)
+
+    def install(self, session):
+        """Route every request made through session via this scheduler.
+
+        429 and 503 are taken out of the session's own urllib3 retries so that the scheduler sees
+        them and can slow everything down, rather than one request quietly sleeping on its own.
+        """
+        for adapter in session.adapters.values():
+            retry = adapter.max_retries
+            if retry.status_forcelist:
+                adapter.max_retries = retry.new(
+                    status_forcelist=[s for s in retry.status_forcelist if s not in THROTTLE_STATUS_CODES])
+        send = session.request
+
+        def request(method, url, **kwargs):
+            return self.request(send, method, url, **kwargs)
+        session.request = request
+        return session
+
+    def _wait_for_turn(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if not self.rate:
+                        return
+                    self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1.0:
+                        self.tokens -= 1.0
+                        return
+                    wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def _observe(self, elapsed):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['request_seconds'] += elapsed
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            self.since_slow_down += 1
+            if not self.target_latency:
+                return
+            if self.latency > self.target_latency:
+                if self.since_slow_down >= self.COOLDOWN_RESPONSES:
+                    self._slow_down()
+            elif self.latency < 0.8 * self.target_latency and (self.max_rate is None or self.rate < self.max_rate):
+                self.rate = self.rate + 0.1 if self.max_rate is None else min(self.max_rate, self.rate + 0.1)
+
+    def _slow_down(self):
+        self.since_slow_down = 0
+        if self.rate:
+            previous = self.rate
+            self.rate = max(self.MIN_RATE, self.rate * 0.7)
+            if self.rate != previous:
+                logging.debug("Hub latency %.2fs, slowing down to %.2f requests per second", self.latency or 0, self.rate)
+
+    def request(self, send, method, url, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_turn()
+            if self.in_flight:
+                self.in_flight.acquire()
+            start = time.monotonic()
+            try:
+                response = send(method, url, **kwargs)
+            except Exception:
+                with self.lock:
+                    self.stats['errors'] += 1
+                raise
+            finally:
+                if self.in_flight:
+                    self.in_flight.release()
+            self._observe(time.monotonic() - start)
+
+            if response.status_code in THROTTLE_STATUS_CODES and attempt < self.max_retries:
+                delay = _retry_after(response)
+                if delay is None:
+                    delay = min(60.0, 2.0 ** attempt)
+                with self.lock:
+                    self.stats['throttled'] += 1
+                    self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                    self._slow_down()
+                logging.warning("Hub responded %s to %s %s, pausing all requests for %.1f seconds",
+                                response.status_code, method.upper(), url, delay)
+                continue
+            if response.status_code >= 400:
+                with self.lock:
+                    self.stats['errors'] += 1
+            return response
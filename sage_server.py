@@ -0,0 +1,94 @@
+# sage_server.py
+#
+# Keep the latest Sage analysis in memory, refresh it on a schedule and answer queries about it
+# over a local HTTP/JSON API, so dashboards and scripts neither re-read the report nor re-crawl
+# the hub.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+from urllib.parse import unquote, urlparse
+
+
+class SageModel(object):
+    """The data of one analysis, indexed for the queries the server answers. A refresh builds a
+    new model rather than changing this one, so requests never see a half refreshed analysis.
+    """
+
+    def __init__(self, data, totals, findings):
+        self.data = data
+        self.totals = {t: data[t] for t in totals if t in data}
+        for key in ('hub_url', 'time_of_analysis'):
+            if key in data:
+                self.totals[key] = data[key]
+        self.finding_counts = {f: len(data[f]) for f in findings if f in data}
+        self.projects = {}  # project ID and name -> project
+        for project in data.get('projects', []):
+            self.projects[project['url'].rsplit('/', 1)[-1]] = project
+        for project in data.get('projects', []):
+            self.projects.setdefault(project['name'], project)
+
+
+class SageRequestHandler(BaseHTTPRequestHandler):
+    """GET /totals, /findings, /findings/<finding> and /projects/<project ID or name>"""
+
+    def do_GET(self):
+        model = self.server.model
+        parts = [unquote(p) for p in urlparse(self.path).path.split('/') if p]
+        if parts == ['totals']:
+            self._send(200, dict(model.totals, last_refresh=self.server.last_refresh))
+        elif parts == ['findings']:
+            self._send(200, model.finding_counts)
+        elif len(parts) == 2 and parts[0] == 'findings' and parts[1] in model.finding_counts:
+            self._send(200, model.data[parts[1]])
+        elif len(parts) == 2 and parts[0] == 'projects' and parts[1] in model.projects:
+            self._send(200, model.projects[parts[1]])
+        else:
+            self._send(404, {'error': "Not found, try /totals, /findings, /findings/<finding> or /projects/<project ID or name>"})
+
+    def _send(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', "application/json")
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logging.debug("%s %s", self.address_string(), format % args)
+
+
+class SageServer(ThreadingHTTPServer):
+    """Serve the analysis of a BlackDuckSage, refreshing it every refresh_interval seconds (or
+    never, if None) in a background thread. A failed refresh is logged and the previous analysis
+    is served until the next one succeeds.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, sage, refresh_interval=None):
+        super().__init__(address, SageRequestHandler)
+        self.sage = sage
+        self.refresh_interval = refresh_interval
+        self.publish(sage.data)
+
+    def publish(self, data):
+        self.model = SageModel(data, type(self.sage).TOTALS, type(self.sage).FINDINGS)
+        self.last_refresh = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+    def refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            start = time.monotonic()
+            try:
+                self.publish(self.sage.refresh())
+                logging.info("Refreshed the analysis in %.1f seconds", time.monotonic() - start)
+            except Exception:
+                logging.exception("Refreshing the analysis failed, serving the previous one")
+
+    def serve(self):
+        if self.refresh_interval:
+            threading.Thread(target=self.refresh_forever, name="sage-refresh", daemon=True).start()
+        logging.info("Serving the analysis on http://%s:%i/", *self.server_address[:2])
+        self.serve_forever()
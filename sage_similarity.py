@@ -0,0 +1,83 @@
+# sage_similarity.py
+#
+# Cluster near-duplicate names, e.g. codelocation names that differ only by a build number or
+# path, using MinHash signatures and locality-sensitive hashing rather than comparing every pair.
+
+from collections import defaultdict
+import random
+import zlib
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def shingles(name, k=3):
+    """The set of k character substrings of a name"""
+    name = name.lower()
+    if len(name) <= k:
+        return {name}
+    return {name[i:i + k] for i in range(len(name) - k + 1)}
+
+
+class UnionFind(object):
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        parent = self.parent.setdefault(x, x)
+        if parent != x:
+            parent = self.parent[x] = self.find(parent)
+        return parent
+
+    def union(self, x, y):
+        x, y = self.find(x), self.find(y)
+        if x != y:
+            self.parent[y] = x
+
+
+class NameClusterer(object):
+    """Find groups of names whose shingle sets have a Jaccard similarity of about threshold or more.
+
+    Each name gets a MinHash signature of bands * rows values. Names sharing all the values of
+    any one band land in the same bucket and become candidates, which are joined into a cluster
+    when their signatures agree on at least threshold of their values. The defaults make names
+    with a similarity of 0.5 or more likely to become candidates. Signatures are cached per
+    name so the same names can be clustered in several groupings cheaply.
+    """
+
+    def __init__(self, threshold=0.7, bands=16, rows=4, seed=1):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(seed)
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(MERSENNE_PRIME)) for _ in range(bands * rows)]
+        self.signatures = {}
+
+    def signature(self, name):
+        if name not in self.signatures:
+            hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles(name)]
+            self.signatures[name] = tuple(min([(a * h + b) % MERSENNE_PRIME for h in hashes]) for a, b in self.permutations)
+        return self.signatures[name]
+
+    def similarity(self, name1, name2):
+        """Estimated Jaccard similarity of two names"""
+        s1, s2 = self.signature(name1), self.signature(name2)
+        return sum([v1 == v2 for v1, v2 in zip(s1, s2)]) / len(s1)
+
+    def clusters(self, names):
+        """Group the keys of names, a dict of key -> name, into clusters of two or more similar names"""
+        union_find = UnionFind()
+        for band in range(self.bands):
+            start = band * self.rows
+            buckets = defaultdict(list)
+            for key, name in names.items():
+                buckets[self.signature(name)[start:start + self.rows]].append(key)
+            for keys in buckets.values():
+                # comparing with the first of each bucket keeps this linear even when a bucket is large
+                first = keys[0]
+                for key in keys[1:]:
+                    if self.similarity(names[first], names[key]) >= self.threshold:
+                        union_find.union(first, key)
+        clusters = defaultdict(list)
+        for key in names:
+            clusters[union_find.find(key)].append(key)
+        return [keys for keys in clusters.values() if len(keys) > 1]
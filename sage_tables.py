@@ -0,0 +1,129 @@
+# sage_tables.py
+#
+# Normalized CSV tables written by sage.py while it collects data so that CSV reports can be
+# produced without writing, and re-reading, the full JSON output first.
+
+import csv
+import os
+import re
+
+from sage_io import last_id
+
+TABLES = {
+    'projects': [
+        'projectId',
+        'name',
+        'projectOwner',
+        'createdAt',
+        'updatedAt',
+        'num_versions'],
+    'versions': [
+        'versionId',
+        'projectId',
+        'project',
+        'versionName',
+        'phase',
+        'distribution',
+        'createdAt',
+        'createdBy',
+        'settingUpdatedAt',
+        'num_scans',
+        'num_bom_scans'],
+    'codelocations': [
+        'codelocationId',
+        'name',
+        'projectId',
+        'versionId',
+        'mappedProjectVersion',
+        'scanSize',
+        'createdAt',
+        'updatedAt',
+        'num_summaries'],
+    'scan_summaries': [
+        'summaryId',
+        'codelocationId',
+        'createdAt',
+        'updatedAt',
+        'createdByUserName',
+        'status',
+        'scanType',
+        'matchCount',
+        'hostName',
+        'baseDirectory'],
+    'findings': [
+        'finding',
+        'entityType',
+        'entityId',
+        'message'],
+}
+
+ID_PATTERNS = [
+    ('projectId', re.compile(r".*/projects/([^/]+)")),
+    ('versionId', re.compile(r".*/versions/([^/]+)")),
+    ('codelocationId', re.compile(r".*/codelocations/([^/]+)")),
+]
+
+
+def url_ids(url):
+    """Extract the projectId, versionId and codelocationId embedded in a Hub url, '' if absent"""
+    ids = {}
+    for key, pattern in ID_PATTERNS:
+        m = pattern.match(url or "")
+        ids[key] = m.group(1) if m else ""
+    return ids
+
+
+class CsvTables(object):
+    """One CSV file per table in a directory, written row by row as entities are collected"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.files = {}
+        self.writers = {}
+        for table, columns in TABLES.items():
+            f = open(os.path.join(directory, table + ".csv"), 'w', newline='', encoding='utf-8')
+            self.files[table] = f
+            self.writers[table] = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+            self.writers[table].writeheader()
+
+    def _write(self, table, obj, **kwargs):
+        row = {c: obj.get(c, "") for c in TABLES[table]}
+        row.update(kwargs)
+        self.writers[table].writerow(row)
+
+    def write_project(self, project):
+        self._write('projects', project, projectId=last_id(project['url']))
+
+    def write_version(self, version):
+        ids = url_ids(version['url'])
+        self._write('versions', version, versionId=ids['versionId'], projectId=ids['projectId'],
+                    project=version.get('project_name', ""))
+
+    def write_codelocation(self, codelocation):
+        codelocation_id = last_id(codelocation['url'])
+        mapped = url_ids(codelocation.get('mappedProjectVersion'))
+        summaries = codelocation.get('scan_summaries', [])
+        self._write('codelocations', codelocation, codelocationId=codelocation_id,
+                    projectId=mapped['projectId'], versionId=mapped['versionId'], num_summaries=codelocation.get('num_scan_summaries', len(summaries)))
+        for summary in summaries:
+            self._write('scan_summaries', summary, summaryId=last_id(summary['url']), codelocationId=codelocation_id)
+        self.files['scan_summaries'].flush()
+        self.files['codelocations'].flush()
+
+    def write_findings(self, data, findings):
+        """Write one row per entity for each finding, findings maps finding -> (entity type, message key)"""
+        for finding, (entity_type, message_key) in findings.items():
+            for entity in data.get(finding, []):
+                self._write('findings', {}, finding=finding, entityType=entity_type,
+                            entityId=last_id(entity['url']), message=entity.get(message_key, ""))
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+def read_table(directory, table):
+    with open(os.path.join(directory, table + ".csv"), newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            yield row
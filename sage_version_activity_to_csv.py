@@ -14,6 +14,9 @@ import logging
 import os
 from pprint import pprint
 import re
+from sage_io import open_report
+from sage_progress import Progress, add_progress_arguments
+from sage_scheduler import RequestScheduler, add_scheduler_arguments
 import sys
 
 logging.basicConfig(
@@ -127,14 +130,11 @@ def process_project_version(project, version):
     projectId = m.group(1)
     versionId = m.group(2)
 
-    print("  {};  bom:".format(version['versionName']), end='', flush=True)
     if args.skip_bom:
         num_components = "skipped"
     else:
         url = f"/api/projects/{projectId}/versions/{versionId}/components"
         num_components = bd.get_json(url, params={'offset': 0, 'limit': 1})['totalCount']
-    sys.stdout.write(str(num_components))
-    sys.stdout.flush()
 
     # projectOwner
     project_owner = ""
@@ -174,9 +174,6 @@ def process_project_version(project, version):
                 latest_summary_timestamp = ts
 
     # Look at event history for activity
-    sys.stdout.write(";  events:")
-    sys.stdout.flush()
-
     # There is a very nasty bug in the REST-API for this endpoint where if I return all the
     # results using a small page size it returns the correct number but overall incorrect results
     # with occasional duplicate keys.  However, if I use a page size large enough to get everything in
@@ -186,13 +183,10 @@ def process_project_version(project, version):
     url = f"/api/journal/projects/{projectId}/versions/{versionId}"
     params = {'sort': "timestamp ASC"}
     events = list(bd.get_items(url, page_size=1000, params=params))
-
-    sys.stdout.write(str(len(events)))
+    progress.update('versions', events=len(events))
 
     activity = check_for_activity(events)
 
-    sys.stdout.write("\n")
-
     return [
             projectId,
             versionId,
@@ -228,6 +222,8 @@ if __name__ == '__main__':
     parser.add_argument('--timeout', dest='timeout', default=15.0, help="Connection timeout in seconds")
     parser.add_argument('--retries', dest='retries', default=3, help="Maximum number of retries for a single request")
     parser.add_argument('--skip-bom', dest='skip_bom', action='store_true', default=None, help="Skip BOM lookup")
+    add_scheduler_arguments(parser)
+    add_progress_arguments(parser)
 
     group1 = parser.add_argument_group('required arguments')
     group1.add_argument('--input', dest='json_file_input', required=True, help="File containing Sage output e.g. sage_says.json")
@@ -239,7 +235,7 @@ if __name__ == '__main__':
         print("Error, input and output file cannot be the same")
         sys.exit(-1)
 
-    with open(args.json_file_input, 'r') as jf:
+    with open_report(args.json_file_input) as jf:
         logging.info("Loading data from %s...", args.json_file_input)
         sageJson = json.load(jf)
         logging.info("Loaded data for %i codelocations across %i projects", len(sageJson['scans']), len(sageJson['projects']))
@@ -247,6 +243,7 @@ if __name__ == '__main__':
     base_url = sageJson['hub_url']
     verify = False  # TLS certificate verification
     session = HubSession(base_url, timeout=args.timeout, retries=args.retries, verify=verify)
+    RequestScheduler.from_args(args).install(session)
 
     # De-tangle the possibilities of specifying credentials
     if args.token_file:
@@ -305,19 +302,18 @@ if __name__ == '__main__':
             'notableActivityEvents']
     w.writerow(columns)
 
-    projectCount = 0
+    progress = Progress.from_args(args)
+    progress.start('versions', sum([len(versions) for versions in pvDict.values()]))
     pvCount = 0
     for projectId in projectDict:
-        projectCount += 1
         project = projectDict[projectId]
-        print("Project ({}/{}) {}:".format(projectCount, len(projectDict), project['name']))
-
         versions = pvDict[projectId]
         for version in versions:
             row = process_project_version(project, version)
             w.writerow(row)
             f.flush()  # allow tail -f csv file
             pvCount += 1
+    progress.finish('versions')
 
     logging.info("Processing %i project versions complete, output written to: %s", pvCount, args.csv_file_output)
     logging.info("Elapsed time: %s", datetime.now() - start_time)
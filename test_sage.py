@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta, timezone
 import json
+import logging
 import os
 import pytest
 from stat import S_IREAD, S_IRGRP, S_IROTH, S_IWUSR
@@ -7,8 +8,10 @@ import uuid
 
 from unittest.mock import MagicMock
 
+from blackduck import Client
 from blackduck.HubRestApi import HubInstance
 from sage import BlackDuckSage
+from sage_io import load_report
 
 fake_hub_host = "https://my-hub-host"
 fake_bearer_token = "aFakeToken"
@@ -354,3 +357,913 @@ def test_find_high_frequency_scans(mock_hub_instance):
     assert all(map(lambda s: 'message' in s, sage.data['high_frequency_scans']))
 
 
+
+
+class FakeHub(Client):
+    '''A Client whose resources come from memory instead of a Hub server
+
+    resources maps (resource name, parent url) -> list of items, where parent url is None
+    for the root resources.
+    '''
+    def __init__(self, resources):
+        super().__init__(base_url=fake_hub_host, token=made_up_api_token)
+        self.resources = resources
+        self.requested = []
+
+    def get_resource(self, name, parent=None, items=True, **kwargs):
+        key = (name, parent['_meta']['href'] if parent else None)
+        self.requested.append(key)
+        if items:
+            return iter(self.resources.get(key, []))
+        params = kwargs.get('params', {})
+        offset = int(params.get('offset', 0))
+        resource = self.resources.get(key, [])
+        if 'sort' in params:
+            field, order = params['sort'].split()
+            resource = sorted(resource, key=lambda i: i[field], reverse=order == 'DESC')
+        page = resource[offset:offset + int(params.get('limit', 10))]
+        return {'totalCount': len(resource), 'items': page}
+
+    def get_items(self, url, **kwargs):
+        self.requested.append((url, None))
+        return iter(self.resources.get((url, None), []))
+
+    def get_json(self, url, **kwargs):
+        return {'version': hub_version}
+
+
+def fake_hub_resources(num_projects=2, num_versions=2, num_scans=2):
+    '''Build projects -> versions -> codelocations where every codelocation has two scan summaries an hour apart'''
+    url = fake_hub_host + "/api"
+    resources = {('projects', None): [], ('codeLocations', None): [], ('policyRules', None): []}
+    for p in range(num_projects):
+        p_url = "{}/projects/p{}".format(url, p)
+        resources[('projects', None)].append({'name': 'project{}'.format(p), '_meta': {'href': p_url}})
+        resources[('versions', p_url)] = []
+        for v in range(num_versions):
+            v_url = "{}/versions/v{}-{}".format(p_url, p, v)
+            resources[('versions', p_url)].append({
+                'versionName': '{}.0'.format(v), 'phase': 'DEVELOPMENT', '_meta': {'href': v_url}})
+            resources[('codelocations', v_url)] = []
+            for s in range(num_scans):
+                s_url = "{}/codelocations/c{}-{}-{}".format(url, p, v, s)
+                scan = {
+                    'name': 'scan{}-{}-{} scan'.format(p, v, s),
+                    'scanSize': 100 * (s + 1),
+                    'fileCount': 1000 + 100 * p + 10 * v + s,  # so that no two scans have the same content
+                    'createdAt': '2021-01-01T00:00:00.000Z',
+                    'updatedAt': '2021-01-02T00:00:00.000Z',
+                    'mappedProjectVersion': v_url,
+                    '_meta': {'href': s_url}}
+                resources[('codelocations', v_url)].append(dict(scan))
+                resources[('codeLocations', None)].append(dict(scan))
+                resources[('scans', s_url)] = [
+                    {'createdAt': '2021-01-01T0{}:00:00.000Z'.format(d), 'updatedAt': '2021-01-01T0{}:10:00.000Z'.format(d),
+                     'status': 'COMPLETE', 'hostName': 'host{}'.format(p), 'createdByUserName': 'sysadmin',
+                     'scanType': 'SIGNATURE', 'matchCount': 10, '_meta': {'href': "{}/scan-summaries/{}-{}".format(url, s_url[-6:], d)}}
+                    for d in (1, 2)]
+    return resources
+
+
+@pytest.fixture()
+def fake_hub():
+    yield FakeHub(fake_hub_resources())
+    try:
+        os.remove(f_name)
+    except OSError:
+        pass
+
+
+def test_csv_tables(fake_hub, tmp_path):
+    from sage_codelocations_to_csv import codelocation_rows_from_tables
+
+    sage = BlackDuckSage(fake_hub, file=f_name, csv_dir=str(tmp_path), analyze_jobs=False)
+    sage.analyze()
+
+    rows = list(codelocation_rows_from_tables(str(tmp_path)))
+    assert len(rows) == len(sage.data['scans']) == 8
+    by_id = {r[0]: r for r in rows}
+    row = by_id['c1-0-1']
+    assert row[1] == 200
+    assert row[5] == 2
+    assert row[6] is True  # two summaries within 24h
+    assert row[7] == '2021-01-01T02:00:00.000Z'
+    assert row[14] == 'host1'
+    assert row[16:] == ['p1', 'v1-0', 'project1', '0.0', 'scan1-0-1 scan']
+
+
+def test_fleet_merge_reports(tmp_path):
+    from sage_fleet import merge_reports
+
+    results = []
+    for name, num_projects in (('hub1', 1), ('hub2', 3)):
+        report = str(tmp_path / (name + ".json"))
+        BlackDuckSage(FakeHub(fake_hub_resources(num_projects=num_projects)), file=report, analyze_jobs=False).analyze()
+        results.append((name, report, None))
+    results.append(('hub3', None, "SystemError: Authentication credentials not specified"))
+
+    summary = merge_reports(results)
+
+    assert summary['totals']['total_projects'] == 4
+    assert summary['totals']['total_scans'] == 4 * 4
+    assert summary['hubs']['hub2']['total_projects'] == 3
+    assert summary['hubs']['hub3'] == {'error': "SystemError: Authentication credentials not specified"}
+    assert summary['totals']['high_frequency_scans'] == 16
+    assert {r['hub'] for r in summary['findings']['projects_without_an_owner']} == {'hub1', 'hub2'}
+
+
+def test_fleet_analyze_hub_collects_jobs_only_when_asked(tmp_path, monkeypatch):
+    import sage_fleet
+
+    for jobs in (None, True):
+        hub = FakeHub(fake_hub_resources(num_projects=1))
+        monkeypatch.setattr(sage_fleet, 'connect', lambda *args, **kwargs: hub)
+        hub_config = {'name': 'hub1', 'url': fake_hub_host, 'file': str(tmp_path / "hub1.json")}
+        if jobs:
+            hub_config['jobs'] = True
+        assert sage_fleet.analyze_hub(hub_config) == ('hub1', hub_config['file'], None)
+        assert (('/api/job-statistics', None) in hub.requested) == bool(jobs)
+        assert ('job_statistics' in load_report(hub_config['file'])) == bool(jobs)
+
+
+def test_sharded_collection_merges_to_single_run(tmp_path):
+    resources = fake_hub_resources(num_projects=7, num_versions=3, num_scans=4)
+    # make some findings: one project with too many versions, one unmapped scan
+    resources[('codeLocations', None)][5].pop('mappedProjectVersion')
+
+    single = BlackDuckSage(FakeHub(resources), file=str(tmp_path / "single.json"),
+                           max_versions_per_project=2, analyze_jobs=False)
+    single.analyze()
+
+    shard_count = 3
+    shard_files = []
+    for i in range(shard_count):
+        shard_file = str(tmp_path / "shard{}.json".format(i))
+        hub = FakeHub(resources)
+        BlackDuckSage(hub, file=shard_file, max_versions_per_project=2, analyze_jobs=False, shard=(i, shard_count)).analyze()
+        assert ('policyRules', None) in hub.requested if i == 0 else ('policyRules', None) not in hub.requested
+        shard_files.append(shard_file)
+
+    merged = BlackDuckSage(None, file=str(tmp_path / "merged.json"), max_versions_per_project=2)
+    merged.merge(shard_files)
+
+    with open(str(tmp_path / "single.json")) as f:
+        expected = json.load(f)
+    with open(str(tmp_path / "merged.json")) as f:
+        actual = json.load(f)
+    for key in list(BlackDuckSage.FINDINGS) + BlackDuckSage.TOTALS + ['projects', 'scans']:
+        assert actual[key] == expected[key], key
+    assert actual['total_unmapped_scans'] == 1
+
+    with pytest.raises(ValueError):
+        BlackDuckSage(None, file=str(tmp_path / "merged.json")).merge(shard_files[:2])
+
+
+def test_merge_shards_of_a_changing_hub(tmp_path, caplog):
+    resources = fake_hub_resources(num_projects=8)
+    all_projects = resources[('projects', None)]
+    new_projects = [p for p in all_projects if BlackDuckSage._shard_of(p['_meta']['href'], 2) == 1][-2:]
+    resources[('projects', None)] = [p for p in all_projects if p not in new_projects]
+    shard_files = []
+    for i in range(2):
+        if i == 1:
+            # projects created between the two shard runs
+            resources[('projects', None)] = all_projects
+        shard_files.append(str(tmp_path / "shard{}.json".format(i)))
+        BlackDuckSage(FakeHub(resources), file=shard_files[-1], analyze_jobs=False, shard=(i, 2)).analyze()
+
+    merged = BlackDuckSage(None, file=str(tmp_path / "merged.json"))
+    with caplog.at_level(logging.WARNING):
+        merged.merge(shard_files)
+    # in the order of the first listing, followed by the projects it did not have
+    new_urls = [p['_meta']['href'] for p in new_projects]
+    expected = load_report(shard_files[0])['project_urls'] + new_urls
+    collected = [p['url'] for p in merged.data['projects']]
+    assert collected == [url for url in expected if url in collected]
+    assert collected[-2:] == new_urls
+    assert len(collected) == sum(len(load_report(f)['projects']) for f in shard_files)
+    assert "changed while the shards were collected" in caplog.text
+
+
+def test_merge_main_applies_analysis_thresholds(tmp_path):
+    from sage import merge_main
+
+    resources = fake_hub_resources(num_projects=3)
+    options = {'max_scans_per_version': 1, 'high_frequency_window': 0.5, 'max_scan_duration': 5}
+    single = BlackDuckSage(FakeHub(resources), file=str(tmp_path / "single.json"), analyze_jobs=False, **options)
+    single.analyze()
+    shard_files = []
+    for i in range(2):
+        shard_files.append(str(tmp_path / "shard{}.json".format(i)))
+        BlackDuckSage(FakeHub(resources), file=shard_files[-1], analyze_jobs=False, shard=(i, 2), **options).analyze()
+
+    merged = str(tmp_path / "merged.json")
+    merge_main(shard_files + ['-f', merged, '-sv', '1', '--high-frequency-window', '0.5', '--max-scan-duration', '5'])
+
+    expected = load_report(str(tmp_path / "single.json"))
+    actual = load_report(merged)
+    for key in list(BlackDuckSage.FINDINGS) + BlackDuckSage.TOTALS + ['scan_processing']:
+        assert actual[key] == expected[key], key
+    # with the default thresholds every codelocation, scanned twice an hour apart, would be high frequency
+    assert actual['high_frequency_scans'] == []
+    assert len(actual['versions_with_too_many_scans']) == 6
+
+
+@pytest.mark.parametrize("extension,magic", [(".gz", b'\x1f\x8b'), (".xz", b'\xfd7zXZ\x00'), (".bz2", b'BZh'), ("", b'{')])
+def test_compressed_report(fake_hub, tmp_path, extension, magic):
+    report = str(tmp_path / ("sage_says.json" + extension))
+    sage = BlackDuckSage(fake_hub, file=report, analyze_jobs=False)
+    sage.analyze()
+
+    with open(report, 'rb') as f:
+        assert f.read(len(magic)) == magic
+    assert load_report(report) == json.loads(json.dumps(sage.data))
+
+    # a compressed report is detected from its contents, not its name
+    plain_name = str(tmp_path / "renamed.json")
+    os.rename(report, plain_name)
+    assert load_report(plain_name)['total_scans'] == sage.data['total_scans']
+
+
+def test_snapshot_history(tmp_path):
+    from sage_history import SnapshotStore
+    from sage_io import iter_entities
+
+    store = SnapshotStore(str(tmp_path / "history"), checkpoint_every=3)
+    resources = fake_hub_resources(num_projects=2)
+    reports = []
+    for day in range(5):
+        if day == 2:
+            # a new version with one scan in project0 and a scan getting bigger
+            p_url = resources[('projects', None)][0]['_meta']['href']
+            resources[('versions', p_url)].append({'versionName': 'new', '_meta': {'href': p_url + "/versions/new"}})
+        if day == 3:
+            resources[('codeLocations', None)][0]['scanSize'] += 1000
+        if day == 4:
+            del resources[('codeLocations', None)][-1]
+        sage = BlackDuckSage(FakeHub(resources), file=str(tmp_path / "sage_says.json"), analyze_jobs=False)
+        sage.analyze()
+        reports.append(json.loads(json.dumps(sage.data)))
+        store.record(reports[-1])
+
+    snapshots = SnapshotStore(str(tmp_path / "history")).index['snapshots']
+    assert [s['type'] for s in snapshots] == ['full', 'delta', 'delta', 'full', 'delta']
+    assert snapshots[1]['changes']['versions'] == {'added': 0, 'changed': 0, 'removed': 0}
+    assert snapshots[2]['changes']['versions']['added'] == 1
+    assert snapshots[4]['changes']['codelocations']['removed'] == 1
+
+    assert [v[0] for _, v in store.trend(['total_scan_size'])] == [r['total_scan_size'] for r in reports]
+    assert [v for _, _, _, v in store.entity_trend('projects', 'num_versions', 'project0')] == [2, 2, 3, 3, 3]
+
+    for seq in (2, 4):
+        expected = {kind: {} for kind in ('projects', 'versions', 'codelocations')}
+        for kind, entity_id, record in iter_entities(reports[seq]):
+            expected[kind][entity_id] = record
+        assert store.load(seq) == expected
+
+    # loading a snapshot only reads the files since the checkpoint before it
+    for name in os.listdir(str(tmp_path / "history")):
+        if name[:6] in ("000000", "000001", "000002"):
+            with open(str(tmp_path / "history" / name), 'wb') as f:
+                f.write(b"corrupt")
+    assert store.load(4) == expected
+    with pytest.raises(Exception):
+        store.load(2)
+
+
+def test_diff_reports(tmp_path):
+    from sage_diff import diff_reports
+
+    resources = fake_hub_resources(num_projects=3)
+    old_file = str(tmp_path / "old.json.gz")
+    BlackDuckSage(FakeHub(resources), file=old_file, max_scans_per_version=2, analyze_jobs=False).analyze()
+
+    p_url = resources[('projects', None)][2]['_meta']['href']
+    del resources[('projects', None)][2]
+    v_url = resources[('versions', resources[('projects', None)][0]['_meta']['href'])][0]['_meta']['href']
+    new_scan = dict(resources[('codelocations', v_url)][0], name='added scan')
+    new_scan['_meta'] = {'href': fake_hub_host + "/api/codelocations/added"}
+    resources[('codelocations', v_url)].append(new_scan)
+    resources[('codeLocations', None)].append(new_scan)
+    resources[('codeLocations', None)][1]['scanSize'] = 12345
+    new_file = str(tmp_path / "new.json")
+    BlackDuckSage(FakeHub(resources), file=new_file, max_scans_per_version=2, analyze_jobs=False).analyze()
+
+    diff = diff_reports(old_file, new_file, list(BlackDuckSage.FINDINGS), BlackDuckSage.TOTALS)
+
+    assert diff['entities']['projects']['removed'] == [{'id': 'p2', 'name': 'project2'}]
+    assert [v['id'] for v in diff['entities']['versions']['removed']] == ['v2-0', 'v2-1']
+    assert [c['id'] for c in diff['entities']['codelocations']['added']] == ['added']
+    changed = {c['id']: c['fields'] for c in diff['entities']['codelocations']['changed']}
+    assert changed == {'c0-0-1': ['scanSize']}
+    assert diff['findings']['versions_with_too_many_scans'] == {'new': ['v0-0'], 'resolved': []}
+    assert diff['totals']['total_projects'] == {'old': 3, 'new': 2, 'change': -1}
+
+
+def test_request_scheduler(requests_mock):
+    import time
+    from blackduck.Client import HubSession
+    from sage_scheduler import RequestScheduler
+
+    url = fake_hub_host + "/api/projects"
+    requests_mock.get(url, [
+        {'status_code': 429, 'headers': {'Retry-After': '0.3'}},
+        {'status_code': 200, 'json': {'items': []}},
+    ])
+    session = HubSession(fake_hub_host, timeout=15.0, retries=3, verify=False)
+    scheduler = RequestScheduler(rps=20)
+    scheduler.install(session)
+
+    start = time.monotonic()
+    assert session.get("/api/projects").status_code == 200
+    assert time.monotonic() - start >= 0.3
+    assert scheduler.stats['throttled'] == 1
+    assert scheduler.stats['requests'] == 2
+
+    start = time.monotonic()
+    for _ in range(10):
+        session.get("/api/projects")
+    assert time.monotonic() - start >= 9 / 20.0 - 0.05
+    assert scheduler.stats['errors'] == 0
+
+
+def test_delete_versions_resume_and_cascade(requests_mock, tmp_path):
+    from delete_versions import ProgressLog, delete_unmapped_codelocation, delete_version, run_concurrently
+
+    api = fake_hub_host + "/api"
+    requests_mock.post(api + "/tokens/authenticate", json={'bearerToken': fake_bearer_token, 'expiresInMilliseconds': 7200000},
+                       headers={'X-CSRF-TOKEN': 'csrf'})
+    rows = [{'projectId': 'p0', 'versionId': 'v{}'.format(i), 'project': 'project0', 'version': str(i)} for i in range(4)]
+    for i in range(4):
+        v_url = "{}/projects/p0/versions/v{}".format(api, i)
+        requests_mock.get(v_url + "/codelocations", json={'items': [{'_meta': {'href': "{}/codelocations/c{}".format(api, i)}}]})
+        requests_mock.delete(v_url, status_code=404 if i == 3 else 204)
+        requests_mock.delete("{}/codelocations/c{}".format(api, i), status_code=204)
+    requests_mock.get(api + "/codelocations/c0", json={})
+    requests_mock.get(api + "/codelocations/c1", json={'mappedProjectVersion': api + "/projects/p1/versions/v9"})
+    requests_mock.get(api + "/codelocations/c2", status_code=404)
+    requests_mock.get(api + "/codelocations/c3", json={})
+    bd = Client(base_url=fake_hub_host, token=made_up_api_token)
+
+    # an earlier run deleted v0 and died before deleting the codelocation it left unmapped
+    log = str(tmp_path / "versions.csv.progress")
+    progress = ProgressLog(log)
+    progress.record('codelocation', 'c0', 'pending')
+    progress.record('version', 'v0', 'deleted')
+    progress.close()
+
+    progress = ProgressLog(log)
+    todo = [row for row in rows if not progress.is_done('version', row['versionId'])]
+    assert [row['versionId'] for row in todo] == ['v1', 'v2', 'v3']
+    tally = run_concurrently(lambda row: delete_version(bd, fake_hub_host, row, progress, True), todo, 3)
+    assert tally == {'deleted': 2, 'not_found': 1}
+    assert sorted(progress.pending('codelocation')) == ['c0', 'c1', 'c2', 'c3']
+    cl_tally = run_concurrently(lambda cl_id: delete_unmapped_codelocation(bd, fake_hub_host, cl_id, progress),
+                                progress.pending('codelocation'), 3)
+    assert cl_tally == {'deleted': 2, 'remapped': 1, 'not_found': 1}
+    progress.close()
+
+    deletes = sorted(r.url.rsplit('/', 1)[-1] for r in requests_mock.request_history if r.method == 'DELETE')
+    assert deletes == ['c0', 'c3', 'v1', 'v2', 'v3']
+
+    # resuming again has nothing left to do, not even a second look at the remapped codelocation
+    progress = ProgressLog(log)
+    assert [row for row in rows if not progress.is_done('version', row['versionId'])] == []
+    assert progress.pending('codelocation') == []
+    progress.close()
+
+
+def test_request_scheduler_adapts_to_latency():
+    from sage_scheduler import RequestScheduler
+
+    scheduler = RequestScheduler(rps=10, target_latency=1.0)
+    for _ in range(3):
+        scheduler._observe(3.0)
+    assert scheduler.rate < 10
+    slowed = scheduler.rate
+    for _ in range(50):
+        scheduler._observe(0.1)
+    assert slowed < scheduler.rate <= 10
+
+
+def test_request_scheduler_slows_down_once_per_cooldown():
+    from sage_scheduler import RequestScheduler
+
+    scheduler = RequestScheduler(rps=10, target_latency=1.0)
+    # a burst of slow responses cuts the rate once, not once per response
+    for _ in range(RequestScheduler.COOLDOWN_RESPONSES):
+        scheduler._observe(5.0)
+    assert scheduler.rate == pytest.approx(7.0)
+    # while they stay slow it is cut again once every COOLDOWN_RESPONSES responses
+    for _ in range(RequestScheduler.COOLDOWN_RESPONSES):
+        scheduler._observe(5.0)
+    assert scheduler.rate == pytest.approx(4.9)
+    assert scheduler.rate > RequestScheduler.MIN_RATE
+
+
+def test_analyze_scan_processing(fake_hub):
+    sage = BlackDuckSage(fake_hub, file=f_name, top_n=2)
+
+    def summary(start_minute, minutes, status='COMPLETE'):
+        created = datetime(2021, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=start_minute)
+        return {'createdAt': created.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                'updatedAt': (created + timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                'status': status}
+
+    sage.data['scans'] = [
+        {'name': 'quick', 'url': 'u1', 'scanSize': 10, 'scan_summaries': [summary(0, 1), summary(100, 2)]},
+        {'name': 'slow', 'url': 'u2', 'scanSize': 20, 'scan_summaries': [summary(0, 45), summary(100, 50), summary(200, 5, 'ERROR')]},
+        {'name': 'huge', 'url': 'u3', 'scanSize': 6 * 1024 ** 3, 'scan_summaries': [summary(0, 20)]},
+        {'name': 'many files', 'url': 'u4', 'scanSize': 30, 'fileCount': 2000000, 'scan_summaries': []},
+    ]
+    sage._analyze_scan_processing()
+
+    assert [s['name'] for s in sage.data['slow_scans']] == ['slow']
+    assert [s['name'] for s in sage.data['scans_to_split']] == ['huge', 'many files']
+    assert sage.data['scans'][1]['processing_time'] == {'scans': 2, 'total': 95 * 60.0, 'p50': 45 * 60.0, 'p90': 50 * 60.0, 'max': 50 * 60.0}
+    processing = sage.data['scan_processing']
+    assert processing['scans_with_durations'] == 5
+    assert processing['duration_percentiles']['p50'] == 20 * 60.0
+    assert processing['duration_percentiles']['p100'] == 50 * 60.0
+    assert [(s['name'], s['duration']) for s in processing['slowest_scans']] == [('slow', 3000.0), ('slow', 2700.0)]
+    assert [s['name'] for s in processing['busiest_scans']] == ['slow', 'huge']
+    assert [s['name'] for s in processing['largest_scans']] == ['huge', 'many files']
+
+
+def test_analyze_job_statistics(fake_hub, tmp_path):
+    history = str(tmp_path / "jobs.jsonl")
+    sage = BlackDuckSage(fake_hub, file=f_name, job_history=history)
+    sage.data['job_statistics'] = [
+        {'jobType': 'ScanJob', 'totalRuns': 100, 'totalFailures': 10, 'totalInProgress': 60, 'averageRunTime': 30000},
+        {'jobType': 'BomJob', 'totalRuns': 1000, 'totalFailures': 1, 'totalInProgress': 0, 'averageRunTime': 100},
+        {'jobType': 'RarelyRunJob', 'totalRuns': 5, 'totalFailures': 5},
+    ]
+    sage._analyze_job_statistics()
+
+    analysis = sage.data['job_analysis']
+    assert analysis['job_types']['ScanJob']['failure_rate'] == 0.1
+    assert analysis['job_types']['BomJob']['total_run_time'] == 100000
+    assert [b['jobType'] for b in analysis['bottlenecks']] == ['ScanJob']
+    assert len(analysis['bottlenecks'][0]['reasons']) == 3
+    assert 'message' in analysis['trend']
+
+    # a later run on which scan jobs take twice as long
+    with open(history) as f:
+        previous = json.loads(f.readline())
+    previous['time'] = (datetime.now(timezone.utc) - timedelta(hours=2)).isoformat()
+    with open(history, 'w') as f:
+        f.write(json.dumps(previous) + "\n")
+    sage.data['job_statistics'][0].update(totalRuns=120, averageRunTime=60000)
+    sage._analyze_job_statistics()
+
+    trend = sage.data['job_analysis']['trend']
+    assert trend['degraded'] == ['ScanJob']
+    assert round(trend['job_types']['ScanJob']['runs_per_hour']) == 10
+    assert trend['job_types']['ScanJob']['average_run_time_change'] == 1.0
+    with open(history) as f:
+        assert len(f.readlines()) == 2
+
+
+def test_merge_keeps_job_analysis(tmp_path):
+    from sage import merge_main
+
+    resources = fake_hub_resources(num_projects=3)
+    resources[('/api/job-statistics', None)] = [
+        {'jobType': 'ScanJob', 'totalRuns': 100, 'totalFailures': 10, 'totalInProgress': 60, 'averageRunTime': 30000},
+        {'jobType': 'BomJob', 'totalRuns': 1000, 'totalFailures': 1, 'totalInProgress': 0, 'averageRunTime': 100},
+    ]
+    shard_files = []
+    for i in range(2):
+        shard_files.append(str(tmp_path / "shard{}.json".format(i)))
+        hub = FakeHub(resources)
+        BlackDuckSage(hub, file=shard_files[-1], shard=(i, 2)).analyze()
+        # only shard 0 collects the hub-wide job statistics
+        assert (('/api/job-statistics', None) in hub.requested) == (i == 0)
+
+    merged = str(tmp_path / "merged.json")
+    merge_main(shard_files + ['-f', merged])
+
+    shard0 = load_report(shard_files[0])
+    report = load_report(merged)
+    assert report['job_statistics'] == resources[('/api/job-statistics', None)]
+    assert report['job_analysis'] == shard0['job_analysis']
+    assert [b['jobType'] for b in report['job_analysis']['bottlenecks']] == ['ScanJob']
+
+
+def test_analyze_scan_load(fake_hub):
+    sage = BlackDuckSage(fake_hub, file=f_name, top_n=3)
+
+    def summary(day, hour, host, user='ci'):
+        created = datetime(2021, 1, 4 + day, hour, 30, tzinfo=timezone.utc)  # 2021-01-04 was a Monday
+        return {'createdAt': created.strftime("%Y-%m-%dT%H:%M:%S.%fZ"), 'hostName': host, 'createdByUserName': user}
+
+    burst = [summary(0, 10, 'ci-1') for _ in range(8)] + [summary(0, 10, 'ci-2') for _ in range(2)]
+    spread = [summary(day, hour, 'dev-laptop', 'alice') for day, hour in [(1, 9), (2, 14), (5, 3)]]
+    sage.data['scans'] = [{'name': 'a', 'url': 'u1', 'scan_summaries': burst}, {'name': 'b', 'url': 'u2', 'scan_summaries': spread}]
+    sage._analyze_scan_load()
+
+    load = sage.data['scan_load']
+    assert load['total_scan_submissions'] == 13
+    assert load['heatmap']['Monday'][10] == 10
+    assert load['heatmap']['Saturday'][3] == 1
+    assert load['peak_hours'] == [{'hour': 'Monday 10:00', 'scans': 10}]
+    assert [(h['name'], h['scans'], h['peak_scans']) for h in load['hosts']] == [('ci-1', 8, 8), ('ci-2', 2, 2), ('dev-laptop', 3, 0)]
+    assert [r.get('host', r.get('user')) for r in load['recommendations']] == ['ci-1', 'ci-2', 'ci']
+    assert 'Monday 00:00' in load['recommendations'][0]['message']
+
+
+def test_progress(tmp_path, caplog):
+    from sage_progress import Progress
+
+    caplog.set_level(logging.INFO)
+    progress_file = str(tmp_path / "progress.json")
+    progress = Progress(interval=3600, progress_file=progress_file)
+    progress.start('projects', 4)
+    progress.update('projects', versions=3)
+    assert not os.path.exists(progress_file)  # nothing is reported before the interval is up
+
+    progress.interval = 0
+    progress.update('projects', versions=2)
+    with open(progress_file) as f:
+        status = json.load(f)
+    projects = status['stages']['projects']
+    assert (projects['done'], projects['total'], projects['counts']) == (2, 4, {'versions': 5})
+    assert 'eta_seconds' in projects
+    assert "projects 2/4 (50.0%)" in caplog.text
+
+    caplog.clear()
+    quiet = Progress(interval=0, quiet=True)
+    quiet.start('codelocations')
+    quiet.update('codelocations')
+    quiet.finish('codelocations')
+    assert caplog.text == ""
+    assert quiet.status()['stages']['codelocations']['finished']
+
+
+def test_preflight(tmp_path):
+    report = str(tmp_path / "preflight.json")
+    hub = FakeHub(fake_hub_resources(num_projects=3, num_versions=2, num_scans=2))
+    sage = BlackDuckSage(hub, file=report, max_recommended_projects=2, seed=1)
+    sage.preflight()
+
+    preflight = sage.data['preflight']
+    assert (preflight['total_projects'], preflight['total_codelocations'], preflight['total_policies']) == (3, 12, 0)
+    assert preflight['samples']['versions_per_project'] == [2, 2, 2]
+    assert preflight['estimated_versions'] == 6
+    assert preflight['estimated_scan_summaries'] == 24
+    # 1 page of projects, 3 of versions, 6 of version codelocations, 1 of policies, 1 of codelocations and 12 of summaries
+    assert preflight['estimated_requests']['total'] == 24
+    assert len(preflight['warnings']) == 1
+    assert preflight['recommended_shards'] == 1
+    assert load_report(report)['preflight'] == preflight
+
+
+def test_sample_estimates(tmp_path):
+    import subprocess
+    import sys
+
+    hub = FakeHub(fake_hub_resources(num_projects=10, num_versions=2, num_scans=2))
+    # every codelocation of the first two projects is unmapped
+    for scan in hub.resources[('codeLocations', None)][:8]:
+        del scan['mappedProjectVersion']
+    sage = BlackDuckSage(hub, file=str(tmp_path / "sample.json"), sample=4, seed=3, analyze_jobs=False)
+    sage.analyze()
+
+    sample = sage.data['sample']
+    assert sample['projects'] == {'population': 10, 'sampled': 4}
+    assert sample['codelocations'] == {'population': 40, 'sampled': 4}
+    # sampling one codelocation from each quarter of the listing finds exactly one unmapped one
+    unmapped = sample['estimates']['unmapped_scans']
+    assert (unmapped['sampled'], unmapped['estimate']) == (1, 10)
+    assert unmapped['low'] < 10 < unmapped['high']
+    # every project has 2 versions so the estimate is exact
+    assert sample['estimates']['total_versions'] == {'sampled': 8, 'estimate': 20, 'low': 20, 'high': 20}
+    assert (sage.data['total_projects'], sage.data['total_scans'], sage.data['total_unmapped_scans']) == (10, 40, 10)
+    assert sage.data['total_scan_size'] == 40 * 150
+
+    # the estimates would scale the in-scope part of a sample up to the whole hub
+    for scope in (['--phases', 'RELEASED'], ['--include-projects', 'payments']):
+        result = subprocess.run([sys.executable, "sage.py", fake_hub_host, made_up_api_token, "--sample", "5"] + scope,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        assert result.returncode == 2 and "collection scope" in result.stderr
+
+
+def test_find_similar_scan_names(fake_hub):
+    sage = BlackDuckSage(fake_hub, file=f_name)
+    names = ["jenkins/workspace/myapp-build-{}/src/myapp/1.0 scan".format(n) for n in (101, 102, 1034)]
+    names += ["payments-service/2.3 bom", "frontend/web-ui/4.1 signature"]
+    scans = [{'name': name, 'url': 'u{}'.format(i), 'scanSize': 100 * (i + 1), 'updatedAt': '2021-01-0{}'.format(i + 1)}
+             for i, name in enumerate(names)]
+    version = {'project_name': 'myapp', 'versionName': '1.0', 'scans': scans}
+    sage.data = {'scans': scans, 'projects': [{'versions': [version]}]}
+    sage._find_similar_scan_names()
+
+    assert sage.data['similar_scan_names']['clusters'] == [{
+        'names': names[:3], 'urls': ['u0', 'u1', 'u2'], 'keep': names[2], 'scanSize': 600, 'wasted_scan_size': 300}]
+    assert sage.data['versions_with_similar_scans'] == [version]
+    assert "300 bytes" in version['similar_scans_message']
+
+
+def test_find_redundant_scans(fake_hub):
+    sage = BlackDuckSage(fake_hub, file=f_name)
+
+    def scan(name, updated_at, size=1000, base_directory='/build/app', processing_time=600):
+        return {'name': name, 'url': name, 'scanSize': size, 'fileCount': 10, 'updatedAt': updated_at,
+                'processing_time': {'total': processing_time},
+                'scan_summaries': [{'createdAt': '2021-01-01', 'matchCount': 5, 'baseDirectory': base_directory}]}
+
+    sage.data['scans'] = [
+        scan('app 1.0', '2021-01-01'), scan('app 1.1', '2021-03-01'), scan('app 1.2', '2021-02-01'),
+        scan('other dir', '2021-01-01', base_directory='/build/other'),
+        scan('empty', '2021-01-01', size=0), scan('empty too', '2021-01-01', size=0),
+    ]
+    sage._find_redundant_scans()
+
+    duplicates = sage.data['duplicate_scans']
+    assert len(duplicates['groups']) == 1
+    assert duplicates['groups'][0]['keep']['name'] == 'app 1.1'
+    assert [c['name'] for c in duplicates['groups'][0]['copies']] == ['app 1.0', 'app 1.2']
+    assert (duplicates['wasted_scan_size'], duplicates['wasted_processing_time']) == (2000, 1200)
+    assert [s['name'] for s in sage.data['redundant_scans']] == ['app 1.0', 'app 1.2']
+    assert "same content (1000 bytes, 10 files) as app 1.1" in sage.data['redundant_scans'][0]['redundant_scan_message']
+
+
+def test_unmapped_scan_ages_and_manifest(fake_hub, tmp_path):
+    from delete_versions import read_manifest
+
+    manifest = str(tmp_path / "unmapped.txt")
+    sage = BlackDuckSage(fake_hub, file=f_name, max_age_unmapped_scans=100, unmapped_manifest=manifest)
+    now = datetime(2022, 1, 1)
+    sage.data['time_of_analysis'] = now.isoformat()
+
+    def scan(n, age, size):
+        return {'name': 'scan{}'.format(n), 'url': fake_hub_host + "/api/codelocations/c{}".format(n), 'scanSize': size,
+                'updatedAt': (now - timedelta(days=age)).astimezone(timezone.utc).isoformat()}
+
+    sage.data['scans'] = [scan(0, 10, 1), scan(1, 400, 2), scan(2, 150, 4), scan(3, 1000, 8),
+                          dict(scan(4, 5000, 16), mappedProjectVersion='pv')]
+    sage._find_unmapped_scans()
+
+    ages = sage.data['unmapped_scan_ages']
+    assert [(b['age'], b['scans'], b['scanSize']) for b in ages['buckets'] if b['scans']] == [
+        ('0-30 days', 1, 1), ('100-180 days', 1, 4), ('365-730 days', 1, 2), ('over 730 days', 1, 8)]
+    assert ages['reclaimable_scan_size'] == 14
+    assert [s['name'] for s in sage.data['old_unmapped_scans']] == ['scan1', 'scan2', 'scan3']
+    assert sage._unmapped_older_than(365) == (['c1', 'c3'], 10)
+
+    sage._write_results()
+    assert read_manifest(manifest) == ['c2', 'c1', 'c3']
+
+
+def test_find_projects_with_version_churn(fake_hub):
+    sage = BlackDuckSage(fake_hub, file=f_name)
+
+    def versions(minutes_apart, phases):
+        start = datetime(2021, 1, 1, tzinfo=timezone.utc)
+        return [{'createdAt': (start + timedelta(minutes=m)).isoformat(), 'phase': phase} for m, phase in zip(minutes_apart, phases)]
+
+    ci_builds = {'name': 'ci builds', 'versions': versions([0, 10, 20, 30, 200, 210], ['DEVELOPMENT'] * 6)}
+    releases = {'name': 'releases', 'versions': versions([0, 10, 5000, 9000], ['RELEASED', 'RELEASED', 'DEVELOPMENT', 'RELEASED'])}
+    big_burst = {'name': 'big burst', 'versions': versions(range(0, 60, 10), ['RELEASED'] * 6)}
+    sage.data['projects'] = [ci_builds, releases, big_burst, {'name': 'no versions', 'versions': []}]
+    sage._find_projects_with_version_churn()
+
+    assert [p['name'] for p in sage.data['projects_with_version_churn']] == ['ci builds', 'big burst']
+    assert ci_builds['version_churn'] == {'versions_in_bursts': 6, 'largest_burst': 4, 'released_ratio': 0.0}
+    assert big_burst['version_churn']['largest_burst'] == 6
+    assert 'version_churn' not in releases
+
+
+def test_reanalyze_from_report_and_snapshot(tmp_path):
+    import subprocess
+    import sys
+    from sage import load_collected_data
+    from sage_history import SnapshotStore
+
+    report = str(tmp_path / "collected.json")
+    BlackDuckSage(FakeHub(fake_hub_resources()), file=report, analyze_jobs=False).analyze()
+    SnapshotStore(str(tmp_path / "history")).record(load_report(report))
+    assert load_report(report)['projects_with_too_many_versions'] == []
+
+    for source in (report, str(tmp_path / "history")):
+        reanalyzed = str(tmp_path / "reanalyzed.json")
+        sage = BlackDuckSage(None, file=reanalyzed, max_versions_per_project=1, max_scans_per_version=1)
+        sage.reanalyze(load_collected_data(source))
+        assert [p['name'] for p in sage.data['projects_with_too_many_versions']] == ['project0', 'project1']
+        assert len(sage.data['versions_with_too_many_scans']) == 4
+        assert sage.data['total_scan_size'] == load_report(report)['total_scan_size']
+        assert load_report(reanalyzed)['total_versions'] == 4
+
+    # re-analyzing needs neither a hub nor the blackduck library
+    code = "import sys, sage; sys.exit('blackduck' in sys.modules)"
+    assert subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__))).returncode == 0
+
+
+def test_reanalyze_and_merge_never_overwrite_their_input(tmp_path):
+    import subprocess
+    import sys
+    from sage import merge_main
+
+    report = str(tmp_path / "sage_says.json")
+    BlackDuckSage(FakeHub(fake_hub_resources()), file=report, analyze_jobs=False).analyze()
+    with open(report) as f:
+        collected = f.read()
+
+    # opening the output file to check it can be written leaves an existing report alone
+    BlackDuckSage(None, file=report)
+    code = subprocess.run([sys.executable, "sage.py", "--from-report", report, "-f", report, "-vp", "1"],
+                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True).returncode
+    assert code == 2
+    with pytest.raises(SystemExit):
+        merge_main([report, "-f", report])
+    with open(report) as f:
+        assert f.read() == collected
+
+
+def test_sweep(fake_hub, tmp_path):
+    report = str(tmp_path / "collected.json")
+    BlackDuckSage(fake_hub, file=report, analyze_jobs=False).analyze()
+    sage = BlackDuckSage(None, file=os.devnull)
+    sage.data = load_report(report)
+    # give project1 a third version with one scan
+    project = sage.data['projects'][1]
+    project['versions'].append(dict(project['versions'][0], scans=project['versions'][0]['scans'][:1], num_scans=1))
+    project['num_versions'] = 3
+
+    results = sage.sweep({'max_versions_per_project': [1, 2, 3], 'max_scans_per_version': [0, 1],
+                          'high_frequency_window': [0.5, 1, 2]})
+
+    assert results['max_versions_per_project'] == [(1, 2, 1300), (2, 1, 700), (3, 0, 0)]
+    assert results['max_scans_per_version'] == [(0, 5, 1300), (1, 4, 1200)]
+    # every codelocation was scanned twice, one hour apart
+    assert results['high_frequency_window'] == [(0.5, 0, 0), (1, 0, 0), (2, 8, 1200)]
+
+
+def test_collection_scope():
+    resources = fake_hub_resources(num_projects=3)
+    for n, project in enumerate(resources[('projects', None)]):
+        project['updatedAt'] = '2021-0{}-01T00:00:00.000Z'.format(n + 1)
+    resources[('versions', resources[('projects', None)][1]['_meta']['href'])][1]['phase'] = 'RELEASED'
+    unmapped = dict(resources[('codeLocations', None)][0], name='unmapped', updatedAt='2021-06-01T00:00:00.000Z',
+                    _meta={'href': fake_hub_host + "/api/codelocations/unmapped"})
+    del unmapped['mappedProjectVersion']
+    resources[('codeLocations', None)].append(unmapped)
+
+    hub = FakeHub(resources)
+    sage = BlackDuckSage(hub, file=f_name, analyze_jobs=False, exclude_projects="0$", phases=['RELEASED'])
+    sage.analyze()
+    assert [p['name'] for p in sage.data['projects']] == ['project1', 'project2']
+    assert [v['versionName'] for p in sage.data['projects'] for v in p['versions']] == ['1.0']
+    assert [s['name'] for s in sage.data['scans']] == ['scan1-1-0 scan', 'scan1-1-1 scan']
+    # no requests for the codelocations of excluded projects and versions, nor for excluded scans' summaries
+    assert not [r for r in hub.requested if 'p0' in (r[1] or '') or 'v1-0' in (r[1] or '')]
+    assert len([r for r in hub.requested if r[0] == 'scans']) == 2
+
+    sage = BlackDuckSage(FakeHub(resources), file=f_name, analyze_jobs=False, updated_since='2021-02-15')
+    sage.analyze()
+    assert [p['name'] for p in sage.data['projects']] == ['project2']
+    assert sage.data['scans'][-1]['name'] == 'unmapped'
+    os.remove(f_name)
+
+
+def test_metrics_file(fake_hub, tmp_path):
+    from sage_metrics import report_metrics
+    from sage_scheduler import RequestScheduler
+
+    metrics_file = str(tmp_path / "sage.prom")
+    scheduler = RequestScheduler()
+    scheduler.stats.update(requests=42, errors=1)
+    sage = BlackDuckSage(fake_hub, file=f_name, analyze_jobs=False, metrics_file=metrics_file, scheduler=scheduler,
+                         max_scans_per_version=1)
+    sage.analyze()
+
+    with open(metrics_file) as f:
+        lines = f.read().splitlines()
+    hub = 'hub="{}"'.format(fake_hub_host)
+    assert 'sage_total_projects{{{}}} 2'.format(hub) in lines
+    assert 'sage_total_scan_size_bytes{{{}}} 1200'.format(hub) in lines
+    assert 'sage_findings{{finding="versions_with_too_many_scans",{}}} 4'.format(hub) in lines
+    assert 'sage_run_requests{{{}}} 42'.format(hub) in lines
+    assert 'sage_run_in_progress{{{}}} 0'.format(hub) in lines
+    assert [line for line in lines if line.startswith('sage_run_duration_seconds')][1].startswith(
+        'sage_run_duration_seconds{{{},phase="collection"}}'.format(hub))
+    assert lines.index('# TYPE sage_total_projects gauge') == lines.index('# HELP sage_total_projects Sage report total projects') + 1
+    assert lines[-1] == "# EOF"
+
+    totals, finding_counts, labels = report_metrics(f_name, BlackDuckSage.TOTALS, BlackDuckSage.FINDINGS)
+    assert totals == {t: sage.data[t] for t in BlackDuckSage.TOTALS}
+    assert finding_counts['versions_with_too_many_scans'] == 4
+    assert labels == {'hub': fake_hub_host}
+
+
+def test_serve_and_refresh(tmp_path):
+    import threading
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+    from sage_server import SageServer
+
+    resources = fake_hub_resources()
+    hub = FakeHub(resources)
+    sage = BlackDuckSage(hub, file=str(tmp_path / "sage.json"), analyze_jobs=False, max_scans_per_version=1)
+    sage.analyze()
+    server = SageServer(('127.0.0.1', 0), sage)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    def get(path):
+        with urlopen(url + path) as response:
+            return json.load(response)
+
+    try:
+        assert get("/totals")['total_projects'] == 2
+        assert get("/findings")['versions_with_too_many_scans'] == 4
+        assert len(get("/findings/versions_with_too_many_scans")) == 4
+        assert get("/projects/project1")['url'] == get("/projects/p1")['url'] == fake_hub_host + "/api/projects/p1"
+        with pytest.raises(HTTPError) as e:
+            get("/projects/nope")
+        assert e.value.code == 404
+
+        # only the codelocation updated since the last collection has its summaries fetched again
+        for scan in resources[('codeLocations', None)]:
+            if scan['_meta']['href'].endswith('c1-1-1'):
+                scan['updatedAt'] = '2021-01-03T00:00:00.000Z'
+        hub.requested.clear()
+        server.publish(sage.refresh())
+        assert [r[1] for r in hub.requested if r[0] == 'scans'] == [fake_hub_host + "/api/codelocations/c1-1-1"]
+        assert get("/totals")['total_scans'] == 8
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_latest_summaries(tmp_path):
+    resources = fake_hub_resources(num_projects=1, num_versions=2)
+    times = [
+        # the newest two are a day apart but 5 scans in 72 hours means some two were less than 24 hours apart
+        ['2021-01-01T0{}:00:00.000Z'.format(h) for h in (1, 2, 3)] + ['2021-01-02T12:00:00.000Z', '2021-01-04T00:00:00.000Z'],
+        # the newest two are an hour apart
+        ['2021-01-0{}T00:00:00.000Z'.format(d) for d in range(2, 5)] + ['2021-01-07T00:00:00.000Z', '2021-01-07T01:00:00.000Z'],
+        # daily
+        ['2021-01-0{}T00:00:00.000Z'.format(d) for d in range(2, 7)],
+        # an hour apart long ago, then once a week: missed, as only the newest two are collected
+        ['2021-01-01T01:00:00.000Z', '2021-01-01T02:00:00.000Z', '2021-01-08T00:00:00.000Z', '2021-01-15T00:00:00.000Z'],
+    ]
+    for scan, scan_times in zip(resources[('codeLocations', None)], times):
+        s_url = scan['_meta']['href']
+        resources[('scans', s_url)] = [
+            {'createdAt': t, 'updatedAt': t, 'status': 'COMPLETE', '_meta': {'href': "{}/scan-summaries/{}".format(s_url, n)}}
+            for n, t in enumerate(scan_times)]
+
+    hub = FakeHub(resources)
+    sage = BlackDuckSage(hub, file=str(tmp_path / "sage.json"), analyze_jobs=False, latest_summaries=2)
+    sage.analyze()
+
+    scans = sage.data['scans']
+    assert [ss['createdAt'] for ss in scans[2]['scan_summaries']] == times[2][:2:-1]
+    assert [s['num_scan_summaries'] for s in scans] == [5, 5, 5, 4]
+    # one request per codelocation
+    assert [r[1] for r in hub.requested if r[0] == 'scans'] == [s['url'] for s in scans]
+    assert [s['url'] for s in sage.data['high_frequency_scans']] == [s['url'] for s in scans[:2]]
+    assert 'out of 5' in scans[0]['high_freq_scan_message']
+
+
+def test_filter_activity_where():
+    from filter_activity import Filter, FilterSyntaxError
+
+    fieldnames = ['createdAt', 'phase', 'events', 'latestNotableActivity']
+    rows = [
+        ['2019-01-01T00:00:00.000Z', 'DEVELOPMENT', '5', ''],
+        ['2099-01-01T00:00:00.000Z', 'RELEASED', '50', '2099-02-01T00:00:00.000Z'],
+        ['', 'ARCHIVED', '', ''],
+    ]
+
+    def matches(where):
+        row_filter = Filter(where)
+        column_index = {name: fieldnames.index(name) for name in row_filter.column_types}
+        return row_filter.evaluate(row_filter.make_batch(rows, column_index))
+
+    # column types come from how the columns are used
+    assert Filter("now - createdAt > 100d and events > 10").column_types == {'createdAt': 'date', 'events': 'number'}
+    assert Filter("latestNotableActivity is null").column_types == {'latestNotableActivity': 'string'}
+    assert matches("createdAt < date('2020-01')") == [True, False, False]
+    assert matches("now - createdAt > 100d") == [True, False, False]
+    assert matches("phase not in ('RELEASED', 'ARCHIVED') or events >= 50") == [True, True, False]
+    # comparisons with empty cells are false, whichever way round they are
+    assert matches("events < 100") == [True, True, False]
+    assert matches("not events < 100") == [False, False, True]
+    assert matches("latestNotableActivity is null and phase != 'RELEASED'") == [True, False, True]
+    # constant sub-expressions are folded when the filter is compiled
+    assert matches("createdAt < now - 100d") == [True, False, False]
+    assert matches("createdAt + 100d < now") == [True, False, False]
+    assert matches("1 + 1 > 1") == [True, True, True]
+    assert matches("now < date('2000-01-01')") == [False, False, False]
+    assert matches("1 in (1, 2)") == [True, True, True]
+    assert matches("'a' not in ('b', 'c')") == [True, True, True]
+    assert matches("now - 1d in (1, 2)") == [False, False, False]
+    assert matches("now is null") == [False, False, False]
+    assert matches("now is not null and events > 10") == [False, True, False]
+
+    for where in ("createdAt <", "phase in ()", "events > 1 1", "(events > 1", "events + 1",
+                  "createdAt > 1 and createdAt < now", "events + phase > 1"):
+        with pytest.raises(FilterSyntaxError):
+            Filter(where)